@@ -5,7 +5,8 @@ threads = 2
 backlog = 512
 daemon = False
 chdir = '/www/wwwroot/AI-attendance-system/backend'
-access_log_format = '%(t)s %(p)s %(h)s "%(r)s" %(s)s %(L)s %(b)s %(f)s" "%(a)s"'
+# %(U)s is the path without the query string, so nothing passed as ?param= is written to the log
+access_log_format = '%(t)s %(p)s %(h)s "%(m)s %(U)s %(H)s" %(s)s %(L)s %(b)s %(f)s" "%(a)s"'
 loglevel = 'info'
 #worker_class = 'geventwebsocket.gunicorn.workers.GeventWebSocketWorker'
 worker_class = "uvicorn.workers.UvicornWorker"
@@ -0,0 +1,65 @@
+"""
+Apply pending data migrations, then reconcile MongoDB indexes.
+The API does the same on startup (migrations in the background); run this
+by hand before a deploy so large migrations are done before the new code
+serves traffic, or with --check to see missing indexes and uncovered query
+shapes.
+
+Run:
+    cd backend
+    python migrate_database.py          # apply migrations + build indexes
+    python migrate_database.py --check  # report only, change nothing
+"""
+
+import asyncio
+import sys
+
+from server import MigrationLocked, client, ensure_indexes, run_migrations
+
+
+async def migrate(dry_run: bool):
+    # Migrations first: some indexes (unique attendance slots, unique payroll rows) can only be
+    # built once the migrations have cleaned up the data
+    try:
+        migrations = await run_migrations(dry_run=dry_run)
+    except MigrationLocked as e:
+        print(f"{e} - try again once it has finished.")
+        client.close()
+        return 1
+    if not migrations:
+        print("No pending migrations.")
+    for migration in migrations:
+        print(f"Migration {migration['id']}: {migration['outcome']}")
+
+    report = await ensure_indexes(dry_run=dry_run)
+
+    print(f"Indexes created:   {len(report['created'])}")
+    for label in report["created"]:
+        print(f"  + {label}")
+    print(f"Indexes rebuilt:   {len(report['rebuilt'])}")
+    for label in report["rebuilt"]:
+        print(f"  ~ {label}")
+    if report["dropped"]:
+        print(f"Indexes dropped:   {len(report['dropped'])}")
+        for label in report["dropped"]:
+            print(f"  - {label}")
+    print(f"Indexes unchanged: {len(report['unchanged'])}")
+    if report["failed"]:
+        print(f"Indexes failed:    {len(report['failed'])}")
+        for label in report["failed"]:
+            print(f"  ! {label}")
+    if report["unmanaged"]:
+        print(f"Unmanaged indexes (left in place): {len(report['unmanaged'])}")
+        for label in report["unmanaged"]:
+            print(f"  ? {label}")
+    if report["uncovered"]:
+        print(f"Query shapes with no index: {len(report['uncovered'])}")
+        for shape in report["uncovered"]:
+            print(f"  ! {shape}")
+
+    client.close()
+    return 1 if report["failed"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(migrate(dry_run="--check" in sys.argv)))
@@ -0,0 +1,34 @@
+"""
+Recompute payroll_aggregates from raw attendance.
+Aggregates are normally kept current on every attendance write; run this after
+editing attendance directly in the database or if payroll totals look off.
+
+Run:
+    cd backend
+    python rebuild_payroll_aggregates.py                        # everything
+    python rebuild_payroll_aggregates.py --company <company_id>
+    python rebuild_payroll_aggregates.py --month 2025-11
+"""
+
+import argparse
+import asyncio
+
+from server import client, rebuild_all_payroll_aggregates
+
+
+async def rebuild(company_id, month):
+    rebuilt = await rebuild_all_payroll_aggregates(company_id, month)
+
+    for entry in rebuilt:
+        print(f"  {entry['company_id']} {entry['month']}: {entry['employees']} employee(s)")
+    print(f"Rebuilt {len(rebuilt)} company month(s)")
+
+    client.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Rebuild payroll aggregates from attendance")
+    parser.add_argument("--company", help="Only this company id")
+    parser.add_argument("--month", help="Only this month (YYYY-MM)")
+    args = parser.parse_args()
+    asyncio.run(rebuild(args.company, args.month))
@@ -1,19 +1,25 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Depends, status, UploadFile, File, Form
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, status, UploadFile, File, Form, Request, Response
+from fastapi.responses import StreamingResponse
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
 import os
+import asyncio
 import logging
 import base64
+import re
 from pathlib import Path
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from pydantic import BaseModel, Field, ConfigDict
-from typing import List, Optional
+from typing import List, Optional, Union
 import uuid
 from datetime import datetime, timezone, timedelta
 import jwt
 import random
-import requests
+import httpx
+from cachetools import TTLCache, LRUCache
 from passlib.context import CryptContext
 import pytz
 
@@ -111,6 +117,7 @@ class User(BaseModel):
     allowances: float = 0.0
     join_date: Optional[str] = None
     profile_pic: Optional[str] = None
+    profile_pic_variants: Optional[dict] = None  # thumbnail size ("64", "128", "512") -> blob URL
     start_time: Optional[str] = None
     finish_time: Optional[str] = None
     fixed_salary: bool = False
@@ -387,7 +394,13 @@ class TrackingSession(BaseModel):
     start_time: str
     end_time: Optional[str] = None
     status: str = "active"  # active, stopped
-    locations: List[LocationPoint] = []
+    # Points live in db.location_points (hourly buckets), the session only keeps a summary
+    point_count: int = 0
+    first_point_at: Optional[str] = None
+    last_point_at: Optional[str] = None
+    last_location: Optional[LocationPoint] = None
+    points_inside: int = 0  # points inside one of the company's geofences
+    route: Optional[dict] = None  # distance/dwell/bbox summary and simplified polyline, see summarize_route
     created_at: str = Field(default_factory=lambda: datetime.now(timezone.utc).isoformat())
 
 class LocationUpdate(BaseModel):
@@ -396,6 +409,16 @@ class LocationUpdate(BaseModel):
     longitude: float
     accuracy: Optional[float] = None
 
+class BufferedLocation(BaseModel):
+    latitude: float
+    longitude: float
+    accuracy: Optional[float] = None
+    client_ts: str  # ISO time the fix was taken on the device
+
+class LocationBatch(BaseModel):
+    session_id: str
+    points: List[BufferedLocation]  # oldest first
+
 class AttendanceWithLocation(BaseModel):
     employee_id: Optional[str] = None
     date: str
@@ -407,7 +430,7 @@ class AttendanceWithLocation(BaseModel):
     longitude: float
     accuracy: Optional[float] = None
     address: Optional[str] = None
-    map_snapshot: Optional[str] = None  # base64 encoded image
+    map_snapshot: Optional[str] = None  # base64 data URL, moved to the blob store on save
 
 
 # ============= DEVICE IMPORT MODELS =============
@@ -429,9 +452,21 @@ class DeviceImportMapping(BaseModel):
 class DeviceImportRequest(BaseModel):
     company_id: str
     mappings: List[DeviceImportMapping]
-    parsed_records: List[ParsedDeviceRecord]
+    import_id: Optional[str] = None  # Records staged by /attendance/device-import/upload
+    parsed_records: List[ParsedDeviceRecord] = []  # Records sent by the client (Excel imports)
     duplicate_action: str  # "skip" or "overwrite"
 
+class FingerprintDeviceCreate(BaseModel):
+    name: str
+
+class DevicePunch(BaseModel):
+    seq: int  # Per-device sequence number, increases with every punch the device buffers
+    fingerprint_id: str
+    device_timestamp: Union[int, str]  # Unix seconds (UTC) or naive ISO datetime in Sri Lanka time
+
+class DevicePunchBatch(BaseModel):
+    punches: List[DevicePunch]
+
 
 # ============= HELPER FUNCTIONS =============
 def create_access_token(data: dict):
@@ -475,115 +510,349 @@ async def get_effective_salary(employee_id: str, company_id: str, for_month: str
     # Otherwise, return current salary
     return current_salary
 
-def send_sms(mobile: str, message: str, company_id: Optional[str] = None):
-    """Send SMS via configured gateway"""
+async def get_effective_salaries(employees: List[dict], company_id: str, for_month: str) -> dict:
+    """
+    Bulk version of get_effective_salary for a list of already-loaded employees
+    Resolves the latest increment per employee with a single aggregation
+
+    Returns:
+        Map of employee id -> effective salary for that month
+    """
+    employee_ids = [emp["id"] for emp in employees]
+    latest_increments = await db.increments.aggregate([
+        {"$match": {
+            "company_id": company_id,
+            "employee_id": {"$in": employee_ids},
+            "effective_from": {"$lte": for_month}
+        }},
+        {"$sort": {"effective_from": -1}},
+        {"$group": {"_id": "$employee_id", "new_salary": {"$first": "$new_salary"}}}
+    ]).to_list(length=None)
+
+    increment_map = {inc["_id"]: inc["new_salary"] for inc in latest_increments}
+    return {
+        emp["id"]: increment_map.get(emp["id"], emp.get("basic_salary", 0.0))
+        for emp in employees
+    }
+
+# ============= PAGINATION =============
+# List endpoints page with an opaque keyset cursor over (sort field, id). The body stays a plain
+# list; the cursor for the next page and the optional total travel in X-Next-Cursor / X-Total-Count.
+# A request without cursor or limit gets the whole list, as before paging existed.
+PAGE_SIZE_MAX = 1000
+
+def encode_cursor(value, last_id: str) -> str:
+    import json
+    is_datetime = isinstance(value, datetime)
+    payload = [value.isoformat() if is_datetime else value, last_id, is_datetime]
+    return base64.urlsafe_b64encode(json.dumps(payload).encode()).decode().rstrip("=")
+
+def decode_cursor(cursor: str) -> tuple:
+    import json
     try:
-        if company_id:
-            company_doc = db.companies.find_one({"id": company_id})
-            if not company_doc or not company_doc.get("sms_enabled"):
-                return False
-            
-            gateway = company_doc.get("sms_gateway", "textit")
-            
-            if gateway == "textit":
-                username = company_doc.get("sms_username") or DEFAULT_SMS_USERNAME
-                password = company_doc.get("sms_password") or DEFAULT_SMS_PASSWORD
-                url = "https://www.textit.biz/sendmsg"
-                params = {"id": username, "pw": password, "to": mobile, "text": message}
-                response = requests.get(url, params=params, timeout=10)
-                return response.status_code == 200
-            
-            elif gateway == "dialog":
-                import hashlib
-                username = company_doc.get("dialog_username")
-                password = company_doc.get("dialog_password")
-                mask = company_doc.get("dialog_mask")
-                
-                if not all([username, password, mask]):
-                    logging.error("Dialog SMS: Missing credentials")
-                    return False
-                
-                digest = hashlib.md5(password.encode()).hexdigest()
-                url = "https://bulksms.dialog.lk/api/v2/send"
-                payload = {
-                    "user": username,
-                    "digest": digest,
-                    "mask": mask,
-                    "destination": mobile,
-                    "message": message
-                }
-                response = requests.post(url, json=payload, timeout=10)
-                return response.status_code == 200
-            
-            elif gateway == "hutch":
-                access_token = company_doc.get("hutch_access_token")
-                if not access_token:
-                    logging.error("Hutch SMS: Missing access token")
-                    return False
-                
-                url = "https://bsms.hutch.lk/api/sms/send"
-                headers = {"Authorization": f"Bearer {access_token}"}
-                payload = {
-                    "recipient": mobile,
-                    "message": message
-                }
-                response = requests.post(url, json=payload, headers=headers, timeout=10)
-                
-                # If token expired, try to refresh
-                if response.status_code == 401:
-                    refresh_token = company_doc.get("hutch_refresh_token")
-                    if refresh_token:
-                        refresh_url = "https://bsms.hutch.lk/api/token/accessToken"
-                        refresh_headers = {"Authorization": f"Bearer {refresh_token}"}
-                        refresh_response = requests.post(refresh_url, headers=refresh_headers, timeout=10)
-                        
-                        if refresh_response.status_code == 200:
-                            new_token = refresh_response.json().get("accessToken")
-                            # Update token in database
-                            db.companies.update_one(
-                                {"id": company_id},
-                                {"$set": {"hutch_access_token": new_token}}
-                            )
-                            # Retry send
-                            headers["Authorization"] = f"Bearer {new_token}"
-                            response = requests.post(url, json=payload, headers=headers, timeout=10)
-                
-                return response.status_code == 200
-            
-            elif gateway == "mobitel":
-                app_id = company_doc.get("mobitel_app_id")
-                app_key = company_doc.get("mobitel_app_key")
-                client_id = company_doc.get("mobitel_client_id")
-                
-                if not all([app_id, app_key, client_id]):
-                    logging.error("Mobitel SMS: Missing credentials")
-                    return False
-                
-                url = "https://apphub.mobitel.lk/mobext/mapi/mspacesms/send"
-                headers = {
-                    "x-ibm-client-id": client_id,
-                    "content-type": "application/json"
-                }
-                payload = {
+        value, last_id, is_datetime = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        return (datetime.fromisoformat(value) if is_datetime else value), last_id
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+def keyset_filter(sort_field: str, direction: int, value, last_id: str) -> dict:
+    """Documents that sort strictly after (value, last_id) for the given direction"""
+    op = "$lt" if direction < 0 else "$gt"
+    tie = {sort_field: value, "id": {op: last_id}}
+    # Missing/null sort values come first ascending and last descending
+    if value is None:
+        return tie if direction < 0 else {"$or": [tie, {sort_field: {"$ne": None}}]}
+    clauses = [{sort_field: {op: value}}, tie]
+    if direction < 0:
+        clauses.append({sort_field: None})
+    return {"$or": clauses}
+
+async def fetch_page(collection, query: dict, sort_field: str, direction: int = -1,
+                     cursor: Optional[str] = None, limit: Optional[int] = None, include_total: bool = False) -> dict:
+    """
+    Fetch one page of a collection ordered by (sort_field, id)
+    With neither cursor nor limit every matching document is returned in one page
+
+    Returns:
+        {"items": [...], "next_cursor": str or None, "total": int or None}
+    """
+    if cursor is None and limit is None:
+        items = await collection.find(query, {"_id": 0}).sort([(sort_field, direction), ("id", direction)]).to_list(length=None)
+        return {"items": items, "next_cursor": None, "total": len(items) if include_total else None}
+    
+    limit = min(max(limit or PAGE_SIZE_MAX, 1), PAGE_SIZE_MAX)
+    page_query = query
+    if cursor:
+        value, last_id = decode_cursor(cursor)
+        page_query = {"$and": [query, keyset_filter(sort_field, direction, value, last_id)]}
+    
+    find_page = collection.find(page_query, {"_id": 0}).sort([(sort_field, direction), ("id", direction)]).to_list(limit + 1)
+    if include_total:
+        items, total = await asyncio.gather(find_page, collection.count_documents(query))
+    else:
+        items, total = await find_page, None
+    
+    next_cursor = None
+    if len(items) > limit:
+        items = items[:limit]
+        next_cursor = encode_cursor(items[-1].get(sort_field), items[-1].get("id"))
+    return {"items": items, "next_cursor": next_cursor, "total": total}
+
+def set_page_headers(response: Response, page: dict):
+    if page["next_cursor"]:
+        response.headers["X-Next-Cursor"] = page["next_cursor"]
+    if page["total"] is not None:
+        response.headers["X-Total-Count"] = str(page["total"])
+
+# ============= SMS DISPATCH =============
+# Messages are written to db.sms_outbox and delivered by sms_outbox_worker() in the
+# background, so request handlers never wait on an SMS gateway. Messages queued with an
+# expires_at (OTPs) are dropped once it passes and have their text redacted when they finish;
+# finished messages are removed after SMS_OUTBOX_RETENTION_DAYS (TTL index on finished_at).
+SMS_GATEWAYS = ["textit", "dialog", "hutch", "mobitel"]
+SMS_MAX_ATTEMPTS = 5
+SMS_RETRY_BASE_SECONDS = 15
+SMS_RETRY_MAX_SECONDS = 900
+SMS_WORKER_BATCH = 10
+SMS_WORKER_IDLE_SECONDS = 5
+SMS_SENDING_TIMEOUT_MINUTES = 5
+SMS_OUTBOX_RETENTION_DAYS = 7
+SMS_REDACTED = "[redacted]"
+
+sms_clients = {}
+sms_outbox_wakeup = asyncio.Event()
+
+def get_sms_client(gateway: str) -> httpx.AsyncClient:
+    """Pooled HTTP client per SMS gateway (keeps TLS connections alive between messages)"""
+    if gateway not in sms_clients:
+        sms_clients[gateway] = httpx.AsyncClient(
+            timeout=httpx.Timeout(10.0),
+            limits=httpx.Limits(max_connections=20, max_keepalive_connections=5)
+        )
+    return sms_clients[gateway]
+
+async def close_sms_clients():
+    for sms_client in sms_clients.values():
+        await sms_client.aclose()
+    sms_clients.clear()
+
+async def deliver_sms(mobile: str, message: str, company_id: Optional[str] = None) -> str:
+    """
+    Send one SMS via the configured gateway
+
+    Returns:
+        "sent", "failed" (worth retrying) or "skipped" (SMS disabled / not configured)
+    """
+    try:
+        if not company_id:
+            # System-wide gateway (for LOGIN OTP)
+            response = await get_sms_client("textit").get(
+                "https://www.textit.biz/sendmsg",
+                params={"id": DEFAULT_SMS_USERNAME, "pw": DEFAULT_SMS_PASSWORD, "to": mobile, "text": message}
+            )
+            return "sent" if response.status_code == 200 else "failed"
+
+        company_doc = await db.companies.find_one({"id": company_id}, {"_id": 0})
+        if not company_doc or not company_doc.get("sms_enabled"):
+            return "skipped"
+
+        gateway = company_doc.get("sms_gateway", "textit")
+        if gateway not in SMS_GATEWAYS:
+            return "skipped"
+        http = get_sms_client(gateway)
+
+        if gateway == "textit":
+            username = company_doc.get("sms_username") or DEFAULT_SMS_USERNAME
+            password = company_doc.get("sms_password") or DEFAULT_SMS_PASSWORD
+            response = await http.get(
+                "https://www.textit.biz/sendmsg",
+                params={"id": username, "pw": password, "to": mobile, "text": message}
+            )
+
+        elif gateway == "dialog":
+            import hashlib
+            username = company_doc.get("dialog_username")
+            password = company_doc.get("dialog_password")
+            mask = company_doc.get("dialog_mask")
+
+            if not all([username, password, mask]):
+                logging.error("Dialog SMS: Missing credentials")
+                return "skipped"
+
+            digest = hashlib.md5(password.encode()).hexdigest()
+            response = await http.post("https://bulksms.dialog.lk/api/v2/send", json={
+                "user": username,
+                "digest": digest,
+                "mask": mask,
+                "destination": mobile,
+                "message": message
+            })
+
+        elif gateway == "hutch":
+            access_token = company_doc.get("hutch_access_token")
+            if not access_token:
+                logging.error("Hutch SMS: Missing access token")
+                return "skipped"
+
+            url = "https://bsms.hutch.lk/api/sms/send"
+            payload = {"recipient": mobile, "message": message}
+            response = await http.post(url, json=payload, headers={"Authorization": f"Bearer {access_token}"})
+
+            # If token expired, try to refresh
+            if response.status_code == 401:
+                refresh_token = company_doc.get("hutch_refresh_token")
+                if refresh_token:
+                    refresh_response = await http.post(
+                        "https://bsms.hutch.lk/api/token/accessToken",
+                        headers={"Authorization": f"Bearer {refresh_token}"}
+                    )
+                    if refresh_response.status_code == 200:
+                        new_token = refresh_response.json().get("accessToken")
+                        await db.companies.update_one(
+                            {"id": company_id},
+                            {"$set": {"hutch_access_token": new_token}}
+                        )
+                        # Retry send
+                        response = await http.post(url, json=payload, headers={"Authorization": f"Bearer {new_token}"})
+
+        else:  # mobitel
+            app_id = company_doc.get("mobitel_app_id")
+            app_key = company_doc.get("mobitel_app_key")
+            client_id = company_doc.get("mobitel_client_id")
+
+            if not all([app_id, app_key, client_id]):
+                logging.error("Mobitel SMS: Missing credentials")
+                return "skipped"
+
+            response = await http.post(
+                "https://apphub.mobitel.lk/mobext/mapi/mspacesms/send",
+                json={
                     "recipientMask": mobile,
                     "message": message,
                     "characterEncoding": "ascii",
                     "appID": app_id,
                     "appKey": app_key
-                }
-                response = requests.post(url, json=payload, headers=headers, timeout=10)
-                return response.status_code == 200
-            
-        else:
-            # System-wide gateway (for LOGIN OTP)
-            url = "https://www.textit.biz/sendmsg"
-            params = {"id": DEFAULT_SMS_USERNAME, "pw": DEFAULT_SMS_PASSWORD, "to": mobile, "text": message}
-            response = requests.get(url, params=params, timeout=10)
-            return response.status_code == 200
-            
+                },
+                headers={"x-ibm-client-id": client_id, "content-type": "application/json"}
+            )
+
+        return "sent" if response.status_code == 200 else "failed"
+
     except Exception as e:
         logging.error(f"SMS send error: {str(e)}")
-        return False
+        return "failed"
+
+async def send_sms(mobile: str, message: str, company_id: Optional[str] = None, expires_at: Optional[datetime] = None) -> str:
+    """
+    Queue an SMS for background delivery and return its outbox id (company_id None = system gateway)
+    expires_at: don't deliver after this time, and redact the text once finished (for OTPs)
+    """
+    now = datetime.now(timezone.utc).isoformat()
+    outbox_doc = {
+        "id": str(uuid.uuid4()),
+        "mobile": mobile,
+        "message": message,
+        "company_id": company_id,
+        "status": "pending",  # pending, sending, sent, failed, skipped, expired
+        "attempts": 0,
+        "next_attempt_at": now,
+        "expires_at": expires_at.isoformat() if expires_at else None,
+        "last_error": None,
+        "created_at": now
+    }
+    await db.sms_outbox.insert_one(outbox_doc)
+    sms_outbox_wakeup.set()
+    return outbox_doc["id"]
+
+async def process_sms_outbox() -> int:
+    """Claim and deliver up to SMS_WORKER_BATCH due messages; returns how many were claimed"""
+    now = datetime.now(timezone.utc)
+    claimed = []
+    for _ in range(SMS_WORKER_BATCH):
+        outbox_doc = await db.sms_outbox.find_one_and_update(
+            {"status": "pending", "next_attempt_at": {"$lte": now.isoformat()}},
+            {"$set": {"status": "sending", "locked_at": now.isoformat()}},
+            sort=[("next_attempt_at", 1)],
+            projection={"_id": 0}
+        )
+        if not outbox_doc:
+            break
+        claimed.append(outbox_doc)
+
+    if not claimed:
+        return 0
+
+    async def deliver(doc: dict) -> str:
+        if doc.get("expires_at") and doc["expires_at"] <= now.isoformat():
+            return "expired"
+        return await deliver_sms(doc["mobile"], doc["message"], doc.get("company_id"))
+
+    outcomes = await asyncio.gather(*[deliver(doc) for doc in claimed])
+
+    for outbox_doc, outcome in zip(claimed, outcomes):
+        attempts = outbox_doc.get("attempts", 0) + (outcome != "expired")
+        update = {"attempts": attempts, "last_attempt_at": datetime.now(timezone.utc).isoformat()}
+
+        if outcome in ("sent", "skipped", "expired"):
+            update["status"] = outcome
+        elif attempts >= SMS_MAX_ATTEMPTS:
+            update["status"] = "failed"
+            update["last_error"] = "Gateway rejected or unreachable"
+            logging.error(f"SMS to {outbox_doc['mobile']} failed after {attempts} attempts")
+        else:
+            # Exponential backoff: 15s, 30s, 60s, ... capped
+            delay = min(SMS_RETRY_BASE_SECONDS * (2 ** (attempts - 1)), SMS_RETRY_MAX_SECONDS)
+            update["status"] = "pending"
+            update["last_error"] = "Gateway rejected or unreachable"
+            update["next_attempt_at"] = (datetime.now(timezone.utc) + timedelta(seconds=delay)).isoformat()
+
+        if update["status"] != "pending":
+            update["finished_at"] = datetime.now(timezone.utc)
+            if outbox_doc.get("expires_at"):
+                update["message"] = SMS_REDACTED
+
+        await db.sms_outbox.update_one({"id": outbox_doc["id"]}, {"$set": update, "$unset": {"locked_at": ""}})
+
+    return len(claimed)
+
+async def sms_outbox_worker():
+    """Background loop draining db.sms_outbox; started on app startup"""
+    while True:
+        try:
+            # Release messages left in "sending" by a worker that died mid-delivery
+            stale_before = (datetime.now(timezone.utc) - timedelta(minutes=SMS_SENDING_TIMEOUT_MINUTES)).isoformat()
+            await db.sms_outbox.update_many(
+                {"status": "sending", "locked_at": {"$lt": stale_before}},
+                {"$set": {"status": "pending"}, "$unset": {"locked_at": ""}}
+            )
+
+            while await process_sms_outbox():
+                pass
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.error(f"SMS outbox worker error: {str(e)}")
+
+        sms_outbox_wakeup.clear()
+        try:
+            await asyncio.wait_for(sms_outbox_wakeup.wait(), timeout=SMS_WORKER_IDLE_SECONDS)
+        except asyncio.TimeoutError:
+            pass
+
+# Decoded users keyed by (user_id, impersonation claims) - saves a users lookup on every request.
+# Endpoints that change a user call invalidate_user_cache(); the TTL bounds staleness across workers
+USER_CACHE_TTL_SECONDS = 30
+user_cache = TTLCache(maxsize=5000, ttl=USER_CACHE_TTL_SECONDS)
+user_cache_stats = {"hits": 0, "misses": 0}
+
+def invalidate_user_cache(user_id: Optional[str] = None):
+    """Drop cached entries for a user (all entries when user_id is None)"""
+    invalidate_fingerprint_user(user_id)
+    if user_id is None:
+        user_cache.clear()
+        return
+    for key in [key for key in list(user_cache.keys()) if key[0] == user_id]:
+        user_cache.pop(key, None)
 
 async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
     try:
@@ -596,6 +865,13 @@ async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(s
         # Check if this is an impersonation token
         is_impersonating = payload.get("is_impersonating", False)
         
+        cache_key = (user_id, bool(is_impersonating), payload.get("company_id"), bool(payload.get("can_edit", False)))
+        cached_user = user_cache.get(cache_key)
+        if cached_user is not None:
+            user_cache_stats["hits"] += 1
+            return cached_user.model_copy()
+        user_cache_stats["misses"] += 1
+        
         if is_impersonating:
             # For impersonation, we create a temporary user object with company context
             original_user = await db.users.find_one({"id": user_id}, {"_id": 0})
@@ -611,18 +887,28 @@ async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(s
                 "original_user_id": user_id,
                 "can_edit_in_impersonation": payload.get("can_edit", False)
             })
-            return impersonation_user
+            user_cache[cache_key] = impersonation_user
+            return impersonation_user.model_copy()
         else:
             user = await db.users.find_one({"id": user_id}, {"_id": 0})
             if user is None:
                 raise HTTPException(status_code=401, detail="User not found")
-            return User(**user)
+            user_cache[cache_key] = User(**user)
+            return user_cache[cache_key].model_copy()
     except jwt.ExpiredSignatureError:
         raise HTTPException(status_code=401, detail="Token expired")
     except Exception as e:
         logging.error(f"Token validation error: {str(e)}")
         raise HTTPException(status_code=401, detail="Invalid token")
 
+# Activity logs are buffered in memory and written in batches by flush_activity_logs()
+ACTIVITY_LOG_BATCH_SIZE = 200
+ACTIVITY_LOG_FLUSH_SECONDS = 2
+ACTIVITY_LOG_MAX_BUFFER = 10000
+
+activity_log_buffer = []
+activity_log_flushes = set()
+
 async def log_activity(company_id: str, user_id: str, user_name: str, action: str, details: str):
     log = ActivityLog(
         company_id=company_id,
@@ -631,7 +917,101 @@ async def log_activity(company_id: str, user_id: str, user_name: str, action: st
         action=action,
         details=details
     )
-    await db.activity_logs.insert_one(log.model_dump())
+    activity_log_buffer.append(log.model_dump())
+    
+    # Size threshold reached - write in the background, the request never waits on log I/O
+    if len(activity_log_buffer) >= ACTIVITY_LOG_BATCH_SIZE:
+        flush_task = asyncio.create_task(flush_activity_logs())
+        activity_log_flushes.add(flush_task)
+        flush_task.add_done_callback(activity_log_flushes.discard)
+
+async def flush_activity_logs() -> int:
+    """Write all buffered activity logs with one unordered insert_many; returns how many were written"""
+    global activity_log_buffer
+    if not activity_log_buffer:
+        return 0
+    
+    # Swap the buffer first so logs added while the insert is in flight go to the next batch
+    batch = activity_log_buffer
+    activity_log_buffer = []
+    
+    from pymongo.errors import BulkWriteError
+    try:
+        await db.activity_logs.insert_many(batch, ordered=False)
+        return len(batch)
+    except BulkWriteError as e:
+        # Unordered insert - the rest of the batch was still written
+        inserted = e.details.get("nInserted", 0)
+        logging.error(f"Activity log flush: {len(batch) - inserted} of {len(batch)} logs rejected")
+        return inserted
+    except Exception as e:
+        logging.error(f"Activity log flush failed: {str(e)}")
+        # Keep the batch for the next flush, dropping the oldest entries if the database stays down
+        activity_log_buffer = (batch + activity_log_buffer)[-ACTIVITY_LOG_MAX_BUFFER:]
+        return 0
+
+async def activity_log_flusher():
+    """Background loop flushing buffered activity logs on the time threshold; started on app startup"""
+    while True:
+        await asyncio.sleep(ACTIVITY_LOG_FLUSH_SECONDS)
+        try:
+            await flush_activity_logs()
+        except Exception as e:
+            logging.error(f"Activity log flusher error: {str(e)}")
+
+# ============= BACKGROUND JOBS =============
+# Long-running work (payroll generation, imports) runs as an asyncio task. Progress is kept
+# in db.jobs so the client can poll GET /jobs/{job_id} on any worker.
+running_jobs = set()
+
+async def create_job(job_type: str, company_id: Optional[str], created_by: str, details: Optional[dict] = None) -> dict:
+    job = {
+        "id": str(uuid.uuid4()),
+        "type": job_type,
+        "company_id": company_id,
+        "status": "queued",  # queued, running, completed, failed
+        "total": 0,
+        "processed": 0,
+        "details": details or {},
+        "result": None,
+        "error": None,
+        "created_by": created_by,
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "started_at": None,
+        "finished_at": None
+    }
+    await db.jobs.insert_one(job)
+    job.pop("_id", None)
+    return job
+
+async def update_job(job_id: str, **fields):
+    await db.jobs.update_one({"id": job_id}, {"$set": fields})
+
+def start_job(job: dict, worker):
+    """Run `await worker(job)` in the background; its return value becomes the job's result"""
+    async def run():
+        await update_job(job["id"], status="running", started_at=datetime.now(timezone.utc).isoformat())
+        try:
+            result = await worker(job)
+            await update_job(job["id"], status="completed", result=result, finished_at=datetime.now(timezone.utc).isoformat())
+        except asyncio.CancelledError:
+            await update_job(job["id"], status="failed", error="Interrupted by server shutdown", finished_at=datetime.now(timezone.utc).isoformat())
+            raise
+        except Exception as e:
+            logging.error(f"Job {job['id']} ({job['type']}) failed: {str(e)}")
+            await update_job(job["id"], status="failed", error=str(e), finished_at=datetime.now(timezone.utc).isoformat())
+    
+    task = asyncio.create_task(run())
+    running_jobs.add(task)
+    task.add_done_callback(running_jobs.discard)
+
+@api_router.get("/jobs/{job_id}")
+async def get_job(job_id: str, current_user: User = Depends(get_current_user)):
+    """Status and progress of a background job"""
+    job = await db.jobs.find_one({"id": job_id, "company_id": current_user.company_id}, {"_id": 0})
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
 
 # ============= AUTH ENDPOINTS =============
 @api_router.post("/auth/send-otp")
@@ -644,11 +1024,12 @@ async def send_otp(request: OTPRequest):
         raise HTTPException(status_code=404, detail="User not found")
     
     otp_code = str(random.randint(100000, 999999))
+    expires_at = datetime.now(timezone.utc) + timedelta(minutes=5)
     
     otp_doc = {
         "mobile": request.mobile,
         "otp": otp_code,
-        "expires_at": (datetime.now(timezone.utc) + timedelta(minutes=5)).isoformat(),
+        "expires_at": expires_at.isoformat(),
         "verified": False,
         "created_at": datetime.now(timezone.utc).isoformat()
     }
@@ -656,7 +1037,7 @@ async def send_otp(request: OTPRequest):
     
     # Send SMS - LOGIN OTP always uses system-wide gateway (not company-specific)
     message = f"Your OTP for IT Signature ERP is: {otp_code}. Valid for 5 minutes."
-    sms_sent = send_sms(request.mobile, message, None)  # None = use default system gateway
+    await send_sms(request.mobile, message, None, expires_at=expires_at)  # None = use default system gateway (queued, delivered in background)
     
     # Log activity - OTP sent
     if user.get("company_id"):
@@ -668,7 +1049,7 @@ async def send_otp(request: OTPRequest):
             f"OTP sent to mobile {request.mobile}"
         )
     
-    return {"message": "OTP sent successfully", "sms_sent": sms_sent}
+    return {"message": "OTP sent successfully", "sms_sent": True}
 
 @api_router.post("/auth/verify-otp")
 async def verify_otp(request: OTPVerify):
@@ -792,10 +1173,11 @@ async def create_company(company: CompanyCreate, current_user: User = Depends(ge
         join_date=datetime.now(timezone.utc).date().isoformat()
     )
     await db.users.insert_one(admin_user.model_dump())
+    await adjust_company_stats(company_obj.id, employees=1, active=1)
     
     # Send SMS
     message = f"Welcome to IT Signature ERP! Your company '{company.name}' has been created. Login with mobile {company.admin_mobile}. URL: https://admin-sms-portal.preview.emergentagent.com"
-    send_sms(company.admin_mobile, message)
+    await send_sms(company.admin_mobile, message)
     
     await log_activity("SUPER_ADMIN", current_user.id, current_user.name, "CREATE_COMPANY", f"Created company: {company.name}")
     
@@ -891,6 +1273,7 @@ async def update_company_short_code(company_id: str, data: dict, current_user: U
         {"id": company_id},
         {"$set": {"short_code": short_code}}
     )
+    invalidate_fingerprint_company(company_id)
     
     if result.matched_count == 0:
         raise HTTPException(status_code=404, detail="Company not found")
@@ -935,10 +1318,7 @@ async def resend_company_url(company_id: str, admin_id: str, current_user: User
     
     # Send SMS using default system gateway (same as OTP)
     message = f"Your company portal: {company['name']}. Login with mobile {admin['office_mobile']} at: https://admin-sms-portal.preview.emergentagent.com"
-    sms_sent = send_sms(admin['office_mobile'], message, None)  # None = use default system gateway
-
-    if not sms_sent:
-        raise HTTPException(status_code=500, detail="Failed to send SMS")
+    await send_sms(admin['office_mobile'], message, None)  # None = use default system gateway
 
     await log_activity(
         "SUPER_ADMIN",
@@ -1009,26 +1389,113 @@ async def delete_super_admin(admin_id: str, current_user: User = Depends(get_cur
         raise HTTPException(status_code=404, detail="Super admin not found")
     
     await db.users.delete_one({"id": admin_id})
+    invalidate_user_cache(admin_id)
     await log_activity("SUPER_ADMIN", current_user.id, current_user.name, "DELETE_SUPER_ADMIN", f"Deleted super admin: {admin['name']}")
     
     return {"message": "Super admin deleted successfully"}
 
+@api_router.get("/superadmin/cache/stats")
+async def get_cache_stats(current_user: User = Depends(get_current_user)):
+    """Hit/miss counters for the authenticated-user cache (per worker process)"""
+    if current_user.role != "super_admin":
+        raise HTTPException(status_code=403, detail="Super admin access required")
+    
+    lookups = user_cache_stats["hits"] + user_cache_stats["misses"]
+    return {
+        "user_cache": {
+            "hits": user_cache_stats["hits"],
+            "misses": user_cache_stats["misses"],
+            "hit_rate": round(user_cache_stats["hits"] / lookups, 4) if lookups else 0,
+            "size": len(user_cache),
+            "max_size": user_cache.maxsize,
+            "ttl_seconds": USER_CACHE_TTL_SECONDS
+        }
+    }
+
+# db.company_stats keeps one document per company with its user counts, adjusted with $inc by
+# the user create/delete/reactivate paths so the super admin dashboard never counts users per company
+def is_active_employee(user: dict) -> bool:
+    """Same test as active_employee_count in refresh_company_stats()"""
+    return user.get("is_active", True) is not False and user.get("status", 1) != 0
+
+async def adjust_company_stats(company_id: Optional[str], employees: int = 0, active: int = 0):
+    if not company_id or (not employees and not active):
+        return
+    await db.company_stats.update_one(
+        {"company_id": company_id},
+        {
+            "$inc": {"employee_count": employees, "active_employee_count": active},
+            "$set": {"updated_at": datetime.now(timezone.utc).isoformat()}
+        },
+        upsert=True
+    )
+
+async def refresh_company_stats(company_ids: Optional[List[str]] = None) -> dict:
+    """Recount users per company with one $group and store the result; returns company id -> stats"""
+    from pymongo import UpdateOne
+    match = {"company_id": {"$ne": None}}
+    if company_ids is not None:
+        match["company_id"] = {"$in": company_ids}
+    
+    counts = await db.users.aggregate([
+        {"$match": match},
+        {"$group": {
+            "_id": "$company_id",
+            "employee_count": {"$sum": 1},
+            "active_employee_count": {"$sum": {"$cond": [
+                {"$and": [{"$ne": ["$is_active", False]}, {"$ne": ["$status", 0]}]}, 1, 0
+            ]}}
+        }}
+    ]).to_list(length=None)
+    
+    stats = {company_id: {"company_id": company_id, "employee_count": 0, "active_employee_count": 0} for company_id in (company_ids or [])}
+    for row in counts:
+        stats[row["_id"]] = {"company_id": row["_id"], "employee_count": row["employee_count"], "active_employee_count": row["active_employee_count"]}
+    
+    now = datetime.now(timezone.utc).isoformat()
+    operations = [
+        UpdateOne({"company_id": company_id}, {"$set": {**company_stats, "updated_at": now}}, upsert=True)
+        for company_id, company_stats in stats.items()
+    ]
+    if operations:
+        await db.company_stats.bulk_write(operations, ordered=False)
+    return stats
+
 @api_router.get("/superadmin/dashboard/stats")
-async def get_superadmin_stats(current_user: User = Depends(get_current_user)):
+async def get_superadmin_stats(page: int = 1, page_size: int = 100, current_user: User = Depends(get_current_user)):
     if current_user.role != "super_admin":
         raise HTTPException(status_code=403, detail="Super admin access required")
     
-    total_companies = await db.companies.count_documents({})
-    active_companies = await db.companies.count_documents({"status": "active"})
-    pending_companies = await db.companies.count_documents({"status": "pending"})
-    total_employees = await db.users.count_documents({"role": {"$ne": "super_admin"}})
+    page = max(page, 1)
+    page_size = min(max(page_size, 1), 500)
+    
+    # Company status totals, employee total and one page of companies (with their stats) - concurrently
+    status_counts, employee_totals, companies = await asyncio.gather(
+        db.companies.aggregate([
+            {"$group": {"_id": "$status", "count": {"$sum": 1}}}
+        ]).to_list(length=None),
+        db.company_stats.aggregate([
+            {"$group": {"_id": None, "total": {"$sum": "$employee_count"}}}
+        ]).to_list(length=None),
+        db.companies.aggregate([
+            {"$sort": {"created_at": -1}},
+            {"$skip": (page - 1) * page_size},
+            {"$limit": page_size},
+            {"$lookup": {"from": "company_stats", "localField": "id", "foreignField": "company_id", "as": "stats"}},
+            {"$project": {"_id": 0}}
+        ]).to_list(length=None)
+    )
     
-    # Get companies with stats
-    companies = await db.companies.find({}, {"_id": 0}).sort("created_at", -1).to_list(100)
-    company_stats = []
+    by_status = {row["_id"]: row["count"] for row in status_counts}
+    total_companies = sum(by_status.values())
     
+    # Companies created before company_stats existed get counted once here
+    missing_ids = [company["id"] for company in companies if not company.get("stats")]
+    refreshed = await refresh_company_stats(missing_ids) if missing_ids else {}
+    
+    company_stats = []
     for company in companies:
-        emp_count = await db.users.count_documents({"company_id": company["id"]})
+        stats = company["stats"][0] if company.get("stats") else refreshed.get(company["id"], {})
         
         company_stats.append({
             "company_id": company["id"],
@@ -1036,7 +1503,7 @@ async def get_superadmin_stats(current_user: User = Depends(get_current_user)):
             "admin_name": company["admin_name"],
             "admin_mobile": company["admin_mobile"],
             "status": company["status"],
-            "employee_count": emp_count,
+            "employee_count": stats.get("employee_count", 0),
             "last_login": company.get("last_login"),
             "sms_enabled": company.get("sms_enabled", False),
             "invoicing_enabled": company.get("invoicing_enabled", False),
@@ -1046,10 +1513,13 @@ async def get_superadmin_stats(current_user: User = Depends(get_current_user)):
     
     return {
         "total_companies": total_companies,
-        "active_companies": active_companies,
-        "pending_companies": pending_companies,
-        "total_employees": total_employees,
-        "company_stats": company_stats
+        "active_companies": by_status.get("active", 0),
+        "pending_companies": by_status.get("pending", 0),
+        "total_employees": employee_totals[0]["total"] if employee_totals else 0,
+        "company_stats": company_stats,
+        "page": page,
+        "page_size": page_size,
+        "total_pages": (total_companies + page_size - 1) // page_size
     }
 
 @api_router.post("/superadmin/impersonate/{company_id}")
@@ -1063,7 +1533,8 @@ async def impersonate_company(company_id: str, current_user: User = Depends(get_
     if not company:
         raise HTTPException(status_code=404, detail="Company not found")
     
-    # Get super admin's full access permission
+    # Get super admin's full access permission (fresh lookup, so drop any cached copy too)
+    invalidate_user_cache(current_user.id)
     super_admin_user = await db.users.find_one({"id": current_user.id}, {"_id": 0})
     can_edit = super_admin_user.get("can_full_access_companies", False)
     
@@ -1106,6 +1577,8 @@ async def exit_impersonation(current_user: User = Depends(get_current_user)):
     if not original_user:
         raise HTTPException(status_code=404, detail="Original user not found")
     
+    invalidate_user_cache(original_user_id)
+    
     # Log the exit
     await log_activity(
         current_user.company_id,
@@ -1146,6 +1619,7 @@ async def update_super_admin(admin_id: str, updates: dict, current_user: User =
             {"id": admin_id},
             {"$set": update_data}
         )
+        invalidate_user_cache(admin_id)
     
     # Log the update
     details = f"Updated super admin: {admin['name']}"
@@ -1170,6 +1644,7 @@ class CompanySettings(BaseModel):
     saturday_end_time: str = "14:00"
     working_days_per_month: int = 26
     holidays: List[dict] = []
+    geofences: List[dict] = []
     invoice_address: Optional[str] = None
     invoice_mobile: Optional[str] = None
     invoice_hotline: Optional[str] = None
@@ -1208,6 +1683,15 @@ class Holiday(BaseModel):
     name: str
     type: str = "public"
 
+class Geofence(BaseModel):
+    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    name: str
+    type: str = "circle"  # circle, polygon
+    latitude: Optional[float] = None  # circle centre
+    longitude: Optional[float] = None
+    radius_m: Optional[float] = None
+    points: List[List[float]] = []  # polygon vertices as [latitude, longitude]
+
 # ============= COMPANY ENDPOINTS =============
 @api_router.get("/company/info")
 async def get_company_info(current_user: User = Depends(get_current_user)):
@@ -1307,109 +1791,128 @@ async def get_activity_logs(
     return logs
 
 # ============= DASHBOARD ENDPOINTS =============
-@api_router.get("/dashboard/stats")
-async def get_dashboard_stats(current_user: User = Depends(get_current_user)):
-    if current_user.role == "super_admin":
-        raise HTTPException(status_code=400, detail="Not applicable for super admin")
+# Admin dashboard stats are the same for every admin of a company - cache them briefly
+DASHBOARD_STATS_TTL_SECONDS = 10
+dashboard_stats_cache = TTLCache(maxsize=2000, ttl=DASHBOARD_STATS_TTL_SECONDS)
+
+def facet_count(facet_result: List[dict], name: str) -> int:
+    rows = facet_result[0].get(name, []) if facet_result else []
+    return rows[0]["count"] if rows else 0
+
+async def build_company_dashboard_stats(company_id: str) -> dict:
+    """
+    Admin dashboard numbers in one round trip per collection (run concurrently)
+    instead of a count_documents per figure and per day
+    """
+    from datetime import timedelta
+    today = datetime.now(timezone.utc).date()
+    today_str = today.isoformat()
+    last_7_days = [(today - timedelta(days=i)).isoformat() for i in range(6, -1, -1)]
+    
+    # Current month salary summary
+    current_month = datetime.now(timezone.utc).strftime("%B")
+    current_year = datetime.now(timezone.utc).year
+    
+    def recent_and_pending(sort_field: str) -> List[dict]:
+        return [
+            {"$match": {"company_id": company_id}},
+            {"$facet": {
+                "pending": [{"$match": {"status": "pending"}}, {"$count": "count"}],
+                "recent": [{"$sort": {sort_field: -1}}, {"$limit": 5}, {"$project": {"_id": 0}}]
+            }}
+        ]
     
-    if current_user.role in ["admin", "manager", "accountant"]:
-        # Admin/Manager/Accountant stats
-        # Get all active employees (status=1 or not set, is_active=True) - without date filter yet
-        today_str = datetime.now(timezone.utc).date().isoformat()
-        all_active_employees = await db.users.find({
-            "company_id": current_user.company_id,
+    # Get all active employees (status=1 or not set, is_active=True) - without date filter yet
+    all_active_employees, leaves_facet, advances_facet, payroll_totals, attendance_by_date = await asyncio.gather(
+        db.users.find({
+            "company_id": company_id,
             "role": {"$ne": "super_admin"},  # Exclude only super_admin, include all company users
             "$or": [
                 {"is_active": True},  # is_active = True
                 {"is_active": {"$exists": False}}  # or is_active field doesn't exist (default active)
             ]
-        }).to_list(length=None)
-        
+        }, {"_id": 0, "id": 1, "status": 1, "join_date": 1}).to_list(length=None),
+        db.leaves.aggregate(recent_and_pending("applied_date")).to_list(length=None),
+        db.advances.aggregate(recent_and_pending("request_date")).to_list(length=None),
+        db.payroll.aggregate([
+            {"$match": {"company_id": company_id, "month": current_month, "year": current_year}},
+            {"$group": {
+                "_id": None,
+                "total_expected": {"$sum": "$expected_salary"},
+                "total_calculated": {"$sum": "$calculated_salary"},
+                "total_net": {"$sum": "$net_salary"},
+                "count": {"$sum": 1}
+            }}
+        ]).to_list(length=None),
+        # Count ALL attendance per day for the last 7 days (regardless of employee status),
+        # keeping today's employee ids to count active employees present today
+        db.attendance.aggregate([
+            {"$match": {"company_id": company_id, "date": {"$in": last_7_days}}},
+            {"$group": {
+                "_id": "$date",
+                "count": {"$sum": 1},
+                "employee_ids": {"$push": {"$cond": [{"$eq": ["$date", today_str]}, "$employee_id", "$$REMOVE"]}}
+            }}
+        ]).to_list(length=None)
+    )
+    
+    def active_on(date: str) -> List[dict]:
         # Filter out employees with status=0 (deleted) and check join_date
-        active_employees_today = [
+        return [
             emp for emp in all_active_employees
             if emp.get("status", 1) != 0  # Exclude status=0 (deleted)
-            and (not emp.get("join_date") or emp.get("join_date", "") <= today_str)  # Check join_date
+            and (not emp.get("join_date") or emp.get("join_date", "") <= date)  # Check join_date
         ]
-        
-        total_employees = len(active_employees_today)
-        active_employee_ids = [emp["id"] for emp in active_employees_today]
-        
-        # Count attendance only for active employees who have joined
-        total_attendance_today = await db.attendance.count_documents({
-            "company_id": current_user.company_id,
-            "date": today_str,
-            "employee_id": {"$in": active_employee_ids}
-        })
-        
-        pending_leaves = await db.leaves.count_documents({"company_id": current_user.company_id, "status": "pending"})
-        pending_advances = await db.advances.count_documents({"company_id": current_user.company_id, "status": "pending"})
-        
-        # Recent activities
-        recent_leaves = await db.leaves.find({"company_id": current_user.company_id}, {"_id": 0}).sort("applied_date", -1).limit(5).to_list(5)
-        recent_advances = await db.advances.find({"company_id": current_user.company_id}, {"_id": 0}).sort("request_date", -1).limit(5).to_list(5)
-        
-        # Current month salary summary
-        current_month = datetime.now(timezone.utc).strftime("%B")
-        current_year = datetime.now(timezone.utc).year
-        
-        monthly_payrolls = await db.payroll.find({
-            "company_id": current_user.company_id,
+    
+    active_employees_today = active_on(today_str)
+    active_employee_ids = set(emp["id"] for emp in active_employees_today)
+    attendance_counts = {row["_id"]: row for row in attendance_by_date}
+    
+    # Count attendance only for active employees who have joined
+    total_attendance_today = len([
+        emp_id for emp_id in attendance_counts.get(today_str, {}).get("employee_ids", [])
+        if emp_id in active_employee_ids
+    ])
+    
+    # Total employees per day is the count who had joined by that date
+    attendance_summary = [{
+        "date": date,
+        "count": attendance_counts.get(date, {}).get("count", 0),
+        "total_employees": len(active_on(date))
+    } for date in last_7_days]
+    
+    payroll_summary = payroll_totals[0] if payroll_totals else {}
+    
+    return {
+        "total_employees": len(active_employees_today),
+        "attendance_today": total_attendance_today,
+        "pending_leaves": facet_count(leaves_facet, "pending"),
+        "pending_advances": facet_count(advances_facet, "pending"),
+        "recent_leaves": leaves_facet[0].get("recent", []) if leaves_facet else [],
+        "recent_advances": advances_facet[0].get("recent", []) if advances_facet else [],
+        "monthly_salary_summary": {
             "month": current_month,
-            "year": current_year
-        }, {"_id": 0}).to_list(1000)
-        
-        # Calculate monthly stats
-        total_expected_salary = sum(p.get("expected_salary", 0) for p in monthly_payrolls)
-        total_calculated_salary = sum(p.get("calculated_salary", 0) for p in monthly_payrolls)
-        total_net_salary = sum(p.get("net_salary", 0) for p in monthly_payrolls)
-        
-        # Current month attendance summary (last 7 days)
-        # Count only active employees who have joined
-        from datetime import timedelta
-        today = datetime.now(timezone.utc).date()
-        last_7_days = [(today - timedelta(days=i)).isoformat() for i in range(6, -1, -1)]
-        
-        attendance_summary = []
-        for date in last_7_days:
-            # Get employees who had joined by this specific date and are active (status != 0)
-            employees_by_date = [
-                emp for emp in all_active_employees 
-                if emp.get("status", 1) != 0  # Exclude status=0 (deleted)
-                and (not emp.get("join_date") or emp.get("join_date", "") <= date)  # Check join_date
-            ]
-            
-            # Count ALL attendance for this date (for this company)
-            # This shows actual attendance recorded regardless of employee status
-            count = await db.attendance.count_documents({
-                "company_id": current_user.company_id,
-                "date": date
-            })
-            
-            # Total employees is the count who had joined by this date
-            attendance_summary.append({
-                "date": date,
-                "count": count,
-                "total_employees": len(employees_by_date)
-            })
-        
-        return {
-            "total_employees": total_employees,
-            "attendance_today": total_attendance_today,
-            "pending_leaves": pending_leaves,
-            "pending_advances": pending_advances,
-            "recent_leaves": recent_leaves,
-            "recent_advances": recent_advances,
-            "monthly_salary_summary": {
-                "month": current_month,
-                "year": current_year,
-                "total_expected": total_expected_salary,
-                "total_calculated": total_calculated_salary,
-                "total_net": total_net_salary,
-                "employee_count": len(monthly_payrolls)
-            },
-            "attendance_summary": attendance_summary
-        }
+            "year": current_year,
+            "total_expected": payroll_summary.get("total_expected", 0),
+            "total_calculated": payroll_summary.get("total_calculated", 0),
+            "total_net": payroll_summary.get("total_net", 0),
+            "employee_count": payroll_summary.get("count", 0)
+        },
+        "attendance_summary": attendance_summary
+    }
+
+@api_router.get("/dashboard/stats")
+async def get_dashboard_stats(current_user: User = Depends(get_current_user)):
+    if current_user.role == "super_admin":
+        raise HTTPException(status_code=400, detail="Not applicable for super admin")
+    
+    if current_user.role in ["admin", "manager", "accountant"]:
+        # Admin/Manager/Accountant stats (shared by everyone in the company for a few seconds)
+        cached_stats = dashboard_stats_cache.get(current_user.company_id)
+        if cached_stats is None:
+            cached_stats = await build_company_dashboard_stats(current_user.company_id)
+            dashboard_stats_cache[current_user.company_id] = cached_stats
+        return cached_stats
     else:
         # Employee/Staff stats
         my_attendance = await db.attendance.count_documents({"company_id": current_user.company_id, "employee_id": current_user.id})
@@ -1435,7 +1938,15 @@ async def get_dashboard_stats(current_user: User = Depends(get_current_user)):
 
 # ============= EMPLOYEE ENDPOINTS =============
 @api_router.get("/employees")
-async def get_employees(include_pending_increments: bool = False, include_deleted: bool = False, current_user: User = Depends(get_current_user)):
+async def get_employees(
+    response: Response,
+    include_pending_increments: bool = False,
+    include_deleted: bool = False,
+    cursor: Optional[str] = None,
+    limit: Optional[int] = None,
+    include_total: bool = False,
+    current_user: User = Depends(get_current_user)
+):
     if current_user.role == "super_admin":
         raise HTTPException(status_code=403, detail="Super admin cannot access company employees")
     
@@ -1458,7 +1969,9 @@ async def get_employees(include_pending_increments: bool = False, include_delete
             {"is_active": False}
         ]
     
-    employees = await db.users.find(query, {"_id": 0}).to_list(1000)
+    page = await fetch_page(db.users, query, "created_at", 1, cursor, limit, include_total)
+    set_page_headers(response, page)
+    employees = page["items"]
     
     # Optionally include pending increments
     if include_pending_increments:
@@ -1474,6 +1987,9 @@ async def get_employees(include_pending_increments: bool = False, include_delete
         for emp in employees:
             emp["pending_increment"] = pending_map.get(emp["id"])
     
+    for emp in employees:
+        emp["profile_pic"] = profile_thumbnail(emp)
+    
     return employees
 
 @api_router.post("/employees")
@@ -1513,6 +2029,8 @@ async def create_employee(employee: UserCreate, current_user: User = Depends(get
     )
     
     await db.users.insert_one(new_employee.model_dump())
+    await adjust_company_stats(current_user.company_id, employees=1, active=1)
+    await invalidate_company_month_totals(current_user.company_id)
     await log_activity(current_user.company_id, current_user.id, current_user.name, "CREATE_EMPLOYEE", f"Created employee: {capitalize_name(employee.name)}, Role: {employee.role}, Office Mobile: {employee.office_mobile}, Department: {employee.department or 'N/A'}")
     
     return new_employee
@@ -1527,12 +2045,22 @@ async def update_employee(employee_id: str, updates: dict, current_user: User =
     if not employee:
         raise HTTPException(status_code=404, detail="Employee not found")
     
-    # Update employee
-    await db.users.update_one(
+    # Update employee - the document as it was just before this update decides the stats change
+    from pymongo import ReturnDocument
+    before = await db.users.find_one_and_update(
         {"id": employee_id},
-        {"$set": updates}
+        {"$set": updates},
+        projection={"_id": 0, "is_active": 1, "status": 1},
+        return_document=ReturnDocument.BEFORE
     )
-    
+    invalidate_user_cache(employee_id)
+    if before is not None:
+        was_active = is_active_employee(before)
+        now_active = is_active_employee({**before, **{k: v for k, v in updates.items() if k in ("is_active", "status")}})
+        if was_active != now_active:
+            await adjust_company_stats(current_user.company_id, active=1 if now_active else -1)
+    
+    await invalidate_company_month_totals(current_user.company_id)
     await log_activity(current_user.company_id, current_user.id, current_user.name, "UPDATE_EMPLOYEE", f"Updated employee: {employee['name']}. Changes: {', '.join([f'{k}={v}' for k, v in updates.items() if k not in ['_id', 'created_at']])}")
     
     return {"message": "Employee updated successfully"}
@@ -1552,7 +2080,11 @@ async def delete_employee(employee_id: str, current_user: User = Depends(get_cur
         {"id": employee_id},
         {"$set": {"is_active": False}}
     )
+    invalidate_user_cache(employee_id)
+    if is_active_employee(employee):
+        await adjust_company_stats(current_user.company_id, active=-1)
     
+    await invalidate_company_month_totals(current_user.company_id)
     await log_activity(current_user.company_id, current_user.id, current_user.name, "DELETE_EMPLOYEE", f"Deleted employee: {employee['name']}, ID: {employee.get('employee_id', 'N/A')}, Role: {employee.get('role', 'N/A')}")
     
     return {"message": "Employee deleted successfully"}
@@ -1574,7 +2106,11 @@ async def reactivate_employee(employee_id: str, current_user: User = Depends(get
         {"id": employee_id},
         {"$set": {"status": 1, "is_active": True}}
     )
+    invalidate_user_cache(employee_id)
+    if not is_active_employee(employee):
+        await adjust_company_stats(current_user.company_id, active=1)
     
+    await invalidate_company_month_totals(current_user.company_id)
     await log_activity(
         current_user.company_id, 
         current_user.id, 
@@ -1720,6 +2256,7 @@ async def bulk_import_employees(data: BulkEmployeeImportRequest, current_user: U
                 )
                 
                 await db.users.insert_one(new_employee.model_dump())
+                await adjust_company_stats(current_user.company_id, employees=1, active=1)
                 imported_count += 1
                 
                 # Log activity
@@ -1734,6 +2271,9 @@ async def bulk_import_employees(data: BulkEmployeeImportRequest, current_user: U
             except Exception as e:
                 errors.append({"index": idx, "name": emp_data.get("name"), "error": str(e)})
         
+        if imported_count:
+            await invalidate_company_month_totals(current_user.company_id)
+        
         return {
             "message": f"Successfully imported {imported_count} employees",
             "imported_count": imported_count,
@@ -1797,10 +2337,13 @@ async def add_increment(employee_id: str, increment_data: dict, current_user: Us
             {"id": employee_id},
             {"$set": {"basic_salary": new_salary}}
         )
+        invalidate_user_cache(employee_id)
         status_text = "Applied immediately"
     else:
         status_text = f"Scheduled for {effective_month}"
     
+    await invalidate_company_month_totals(current_user.company_id)
+    
     # Log activity with detailed information
     await log_activity(
         current_user.company_id,
@@ -1892,6 +2435,7 @@ async def activate_pending_increments(current_user: User = Depends(get_current_u
             {"id": increment["employee_id"]},
             {"$set": {"basic_salary": increment["new_salary"]}}
         )
+        invalidate_user_cache(increment["employee_id"])
         
         # Mark increment as active
         await db.increments.update_one(
@@ -1910,6 +2454,9 @@ async def activate_pending_increments(current_user: User = Depends(get_current_u
         
         activated_count += 1
     
+    if activated_count:
+        await invalidate_company_month_totals(current_user.company_id)
+    
     return {
         "message": f"Activated {activated_count} pending increment(s)",
         "activated_count": activated_count
@@ -1948,6 +2495,7 @@ async def create_loan(loan_data: dict, current_user: User = Depends(get_current_
     }
     
     await db.loans.insert_one(loan)
+    await invalidate_company_month_totals(current_user.company_id)
     
     # Log activity
     await log_activity(
@@ -1961,16 +2509,24 @@ async def create_loan(loan_data: dict, current_user: User = Depends(get_current_
     return loan
 
 @api_router.get("/loans")
-async def get_loans(employee_id: Optional[str] = None, current_user: User = Depends(get_current_user)):
+async def get_loans(
+    response: Response,
+    employee_id: Optional[str] = None,
+    cursor: Optional[str] = None,
+    limit: Optional[int] = None,
+    include_total: bool = False,
+    current_user: User = Depends(get_current_user)
+):
     """Get all loans or loans for a specific employee"""
     query = {"company_id": current_user.company_id}
     
     if employee_id:
         query["employee_id"] = employee_id
     
-    loans = await db.loans.find(query, {"_id": 0}).sort("created_at", -1).to_list(length=None)
+    page = await fetch_page(db.loans, query, "created_at", -1, cursor, limit, include_total)
+    set_page_headers(response, page)
     
-    return loans
+    return page["items"]
 
 @api_router.put("/loans/{loan_id}/status")
 async def update_loan_status(loan_id: str, status_data: dict, current_user: User = Depends(get_current_user)):
@@ -1990,6 +2546,7 @@ async def update_loan_status(loan_id: str, status_data: dict, current_user: User
         {"id": loan_id, "company_id": current_user.company_id},
         {"$set": {"status": status_data["status"]}}
     )
+    await invalidate_company_month_totals(current_user.company_id)
     
     # Log activity
     await log_activity(
@@ -2017,6 +2574,7 @@ async def delete_loan(loan_id: str, current_user: User = Depends(get_current_use
         raise HTTPException(status_code=404, detail="Loan not found")
     
     await db.loans.delete_one({"id": loan_id, "company_id": current_user.company_id})
+    await invalidate_company_month_totals(current_user.company_id)
     
     # Log activity
     await log_activity(
@@ -2114,6 +2672,7 @@ async def update_advance(advance_id: str, advance_data: dict, current_user: User
         {"id": advance_id, "company_id": current_user.company_id},
         {"$set": update_data}
     )
+    await invalidate_month_totals(current_user.company_id, advance.get("request_date"))
 
     # Log activity
     await log_activity(
@@ -2141,6 +2700,7 @@ async def delete_advance(advance_id: str, current_user: User = Depends(get_curre
         raise HTTPException(status_code=404, detail="Advance not found")
 
     await db.advances.delete_one({"id": advance_id, "company_id": current_user.company_id})
+    await invalidate_month_totals(current_user.company_id, advance.get("request_date"))
 
     # Log activity
     await log_activity(
@@ -2309,6 +2869,7 @@ async def create_extra_payment(payment_data: dict, current_user: User = Depends(
     }
     
     await db.extra_payments.insert_one(payment)
+    await invalidate_month_totals(current_user.company_id, payment["month"])
     
     # Log activity
     await log_activity(
@@ -2359,6 +2920,7 @@ async def update_extra_payment(payment_id: str, payment_data: dict, current_user
         {"id": payment_id, "company_id": current_user.company_id},
         {"$set": update_data}
     )
+    await invalidate_month_totals(current_user.company_id, payment.get("month"))
     
     # Log activity
     await log_activity(
@@ -2386,6 +2948,7 @@ async def delete_extra_payment(payment_id: str, current_user: User = Depends(get
         raise HTTPException(status_code=404, detail="Extra payment not found")
     
     await db.extra_payments.delete_one({"id": payment_id, "company_id": current_user.company_id})
+    await invalidate_month_totals(current_user.company_id, payment.get("month"))
     
     # Log activity
     await log_activity(
@@ -2429,7 +2992,14 @@ async def create_customer(customer_data: dict, current_user: User = Depends(get_
     return customer.model_dump()
 
 @api_router.get("/customers")
-async def get_customers(include_deleted: bool = False, current_user: User = Depends(get_current_user)):
+async def get_customers(
+    response: Response,
+    include_deleted: bool = False,
+    cursor: Optional[str] = None,
+    limit: Optional[int] = None,
+    include_total: bool = False,
+    current_user: User = Depends(get_current_user)
+):
     """Get all customers for company"""
     if current_user.role not in ["admin", "manager", "accountant", "employee", "staff_member"]:
         raise HTTPException(status_code=403, detail="Access denied")
@@ -2438,8 +3008,9 @@ async def get_customers(include_deleted: bool = False, current_user: User = Depe
     if not include_deleted:
         query["deleted"] = {"$ne": True}
     
-    customers = await db.customers.find(query, {"_id": 0}).sort("created_at", -1).to_list(length=None)
-    return customers
+    page = await fetch_page(db.customers, query, "created_at", -1, cursor, limit, include_total)
+    set_page_headers(response, page)
+    return page["items"]
 
 @api_router.put("/customers/{customer_id}")
 async def update_customer(customer_id: str, customer_data: dict, current_user: User = Depends(get_current_user)):
@@ -2549,7 +3120,14 @@ async def create_product(product_data: dict, current_user: User = Depends(get_cu
     return product.model_dump()
 
 @api_router.get("/products")
-async def get_products(include_deleted: bool = False, current_user: User = Depends(get_current_user)):
+async def get_products(
+    response: Response,
+    include_deleted: bool = False,
+    cursor: Optional[str] = None,
+    limit: Optional[int] = None,
+    include_total: bool = False,
+    current_user: User = Depends(get_current_user)
+):
     """Get all products for company"""
     if current_user.role not in ["admin", "manager", "accountant", "employee", "staff_member"]:
         raise HTTPException(status_code=403, detail="Access denied")
@@ -2558,8 +3136,9 @@ async def get_products(include_deleted: bool = False, current_user: User = Depen
     if not include_deleted:
         query["deleted"] = {"$ne": True}
     
-    products = await db.products.find(query, {"_id": 0}).sort("name", 1).to_list(length=None)
-    return products
+    page = await fetch_page(db.products, query, "name", 1, cursor, limit, include_total)
+    set_page_headers(response, page)
+    return page["items"]
 
 @api_router.put("/products/{product_id}")
 async def update_product(product_id: str, product_data: dict, current_user: User = Depends(get_current_user)):
@@ -2772,9 +3351,13 @@ async def update_invoice(invoice_id: str, invoice_data: dict, current_user: User
 
 @api_router.get("/invoices")
 async def get_invoices(
+    response: Response,
     status: Optional[str] = None,
     customer_id: Optional[str] = None,
     include_deleted: bool = False,
+    cursor: Optional[str] = None,
+    limit: Optional[int] = None,
+    include_total: bool = False,
     current_user: User = Depends(get_current_user)
 ):
     """Get all invoices for company"""
@@ -2789,8 +3372,9 @@ async def get_invoices(
     if customer_id:
         query["customer_id"] = customer_id
     
-    invoices = await db.invoices.find(query, {"_id": 0}).sort("created_at", -1).to_list(length=None)
-    return invoices
+    page = await fetch_page(db.invoices, query, "created_at", -1, cursor, limit, include_total)
+    set_page_headers(response, page)
+    return page["items"]
 
 @api_router.get("/invoices/{invoice_id}")
 async def get_invoice(invoice_id: str, current_user: User = Depends(get_current_user)):
@@ -2994,7 +3578,14 @@ async def create_estimate(estimate_data: dict, current_user: User = Depends(get_
     return estimate.model_dump()
 
 @api_router.get("/estimates")
-async def get_estimates(include_deleted: bool = False, current_user: User = Depends(get_current_user)):
+async def get_estimates(
+    response: Response,
+    include_deleted: bool = False,
+    cursor: Optional[str] = None,
+    limit: Optional[int] = None,
+    include_total: bool = False,
+    current_user: User = Depends(get_current_user)
+):
     """Get all estimates for company"""
     if current_user.role not in ["admin", "manager", "accountant", "employee", "staff_member"]:
         raise HTTPException(status_code=403, detail="Access denied")
@@ -3003,8 +3594,9 @@ async def get_estimates(include_deleted: bool = False, current_user: User = Depe
     if not include_deleted:
         query["deleted"] = {"$ne": True}
     
-    estimates = await db.estimates.find(query, {"_id": 0}).sort("created_at", -1).to_list(length=None)
-    return estimates
+    page = await fetch_page(db.estimates, query, "created_at", -1, cursor, limit, include_total)
+    set_page_headers(response, page)
+    return page["items"]
 
 @api_router.get("/estimates/{estimate_id}")
 async def get_estimate(estimate_id: str, current_user: User = Depends(get_current_user)):
@@ -3472,8 +4064,8 @@ async def get_attendance(
     
     # Enrich with employee profile pictures
     employee_ids = list(set([att.get("employee_id") for att in attendance if att.get("employee_id")]))
-    employees = await db.users.find({"id": {"$in": employee_ids}}, {"id": 1, "profile_pic": 1, "_id": 0}).to_list(length=None)
-    employee_profile_map = {emp["id"]: emp.get("profile_pic") for emp in employees}
+    employees = await db.users.find({"id": {"$in": employee_ids}}, {"id": 1, "profile_pic": 1, "profile_pic_variants": 1, "_id": 0}).to_list(length=None)
+    employee_profile_map = {emp["id"]: profile_thumbnail(emp) for emp in employees}
     
     for att in attendance:
         att["has_history"] = att["id"] in history_map
@@ -3503,20 +4095,7 @@ async def add_manual_attendance(attendance_data: dict, current_user: User = Depe
     if not employee:
         raise HTTPException(status_code=404, detail="Employee not found")
     
-    # Check how many attendance records exist for this date (allow up to 10 per day)
-    existing_count = await db.attendance.count_documents({
-        "company_id": current_user.company_id,
-        "employee_id": attendance_data["employee_id"],
-        "date": attendance_data["date"]
-    })
-    
-    if existing_count >= 10:
-        raise HTTPException(
-            status_code=400, 
-            detail=f"Daily limit exceeded. Maximum 10 attendance records per day allowed. Current count: {existing_count}"
-        )
-    
-    # Create attendance record
+    # Create attendance record (insert_attendance enforces the 10 records per day limit)
     # Combine date with times to create ISO datetime strings
     check_in_datetime = None
     check_out_datetime = None
@@ -3541,10 +4120,7 @@ async def add_manual_attendance(attendance_data: dict, current_user: User = Depe
         "created_at": datetime.now(timezone.utc).isoformat()
     }
     
-    # Store a copy for response before inserting (to avoid _id field)
-    attendance_response = new_attendance.copy()
-    
-    await db.attendance.insert_one(new_attendance)
+    attendance_response = await insert_attendance(new_attendance)
     await log_activity(current_user.company_id, current_user.id, current_user.name, "ADD_ATTENDANCE", f"Added attendance for {capitalize_name(employee['name'])} on {attendance_data['date']}, Status: {attendance_data.get('status', 'present')}, Check-in: {attendance_data.get('check_in', 'N/A')}, Check-out: {attendance_data.get('check_out', 'N/A')}")
     
     return {"message": "Attendance added successfully", "attendance": attendance_response}
@@ -3587,10 +4163,8 @@ async def update_attendance(attendance_id: str, attendance_data: dict, current_u
         update_data["leave_type"] = attendance_data["leave_type"]
     
     if update_data:
-        await db.attendance.update_one(
-            {"id": attendance_id},
-            {"$set": update_data}
-        )
+        if not await update_attendance_record(attendance, update_data):
+            raise HTTPException(status_code=404, detail="Attendance not found")
         
         # Save edit history
         if changes:
@@ -3624,14 +4198,23 @@ async def update_attendance(attendance_id: str, attendance_data: dict, current_u
     return {"message": "Attendance updated successfully"}
 
 @api_router.get("/attendance/{attendance_id}/history")
-async def get_attendance_history(attendance_id: str, current_user: User = Depends(get_current_user)):
+async def get_attendance_history(
+    attendance_id: str,
+    response: Response,
+    cursor: Optional[str] = None,
+    limit: Optional[int] = None,
+    include_total: bool = False,
+    current_user: User = Depends(get_current_user)
+):
     """Get edit history for an attendance record"""
-    history = await db.attendance_history.find(
+    page = await fetch_page(
+        db.attendance_history,
         {"attendance_id": attendance_id, "company_id": current_user.company_id},
-        {"_id": 0}
-    ).sort("edited_at", -1).to_list(length=None)
+        "edited_at", -1, cursor, limit, include_total
+    )
+    set_page_headers(response, page)
     
-    return history
+    return page["items"]
 
 
 @api_router.put("/attendance/{attendance_id}/status")
@@ -3672,10 +4255,7 @@ async def update_attendance_status(attendance_id: str, status_data: dict, curren
     await db.attendance_history.insert_one(history_entry)
     
     # Update attendance
-    await db.attendance.update_one(
-        {"id": attendance_id},
-        {"$set": {"status": new_status}}
-    )
+    await update_attendance_record(attendance, {"status": new_status})
     
     # Log activity
     await log_activity(
@@ -3694,21 +4274,28 @@ async def delete_attendance(attendance_id: str, current_user: User = Depends(get
         raise HTTPException(status_code=403, detail="Admin, manager or accountant access required")
     
     # Check if attendance exists and belongs to same company
-    attendance = await db.attendance.find_one({"id": attendance_id, "company_id": current_user.company_id})
+    attendance = await db.attendance.find_one({"id": attendance_id, "company_id": current_user.company_id}, {"_id": 0})
     if not attendance:
         raise HTTPException(status_code=404, detail="Attendance record not found")
     
-    # Store in deleted_attendance collection
+    # Store in deleted_attendance collection first, so a failed archive never loses the record
     deleted_record = {
         **attendance,
         "deleted_by": current_user.id,
         "deleted_by_name": current_user.name,
         "deleted_at": datetime.now(timezone.utc).isoformat()
     }
-    await db.deleted_attendance.insert_one(deleted_record)
+    archived = await db.deleted_attendance.insert_one(deleted_record)
     
-    # Delete from attendance
-    await db.attendance.delete_one({"id": attendance_id})
+    # Delete from attendance - if another request removed it first, its archive copy is the one kept
+    deleted = await delete_attendance_record(attendance_id, current_user.company_id)
+    if not deleted:
+        await db.deleted_attendance.delete_one({"_id": archived.inserted_id})
+        raise HTTPException(status_code=404, detail="Attendance record not found")
+    if deleted != attendance:
+        # Edited in between - archive the version that was actually deleted
+        await db.deleted_attendance.update_one({"_id": archived.inserted_id}, {"$set": deleted})
+    attendance = deleted
     await log_activity(current_user.company_id, current_user.id, current_user.name, "DELETE_ATTENDANCE", f"Deleted attendance for {attendance.get('employee_name', 'employee')} on {attendance.get('date', 'N/A')}, Status: {attendance.get('status', 'N/A')}, Check-in: {attendance.get('check_in', 'N/A')}")
     
     return {"message": "Attendance deleted successfully"}
@@ -3722,7 +4309,7 @@ async def get_attendance_by_date(date: str, current_user: User = Depends(get_cur
     # Get all employees in company with salary info
     employees = await db.users.find(
         {"company_id": current_user.company_id, "role": {"$in": ["admin", "employee", "manager", "accountant", "staff_member"]}},
-        {"_id": 0, "id": 1, "name": 1, "employee_id": 1, "profile_pic": 1, "basic_salary": 1, "allowances": 1, "fixed_salary": 1}
+        {"_id": 0, "id": 1, "name": 1, "employee_id": 1, "profile_pic": 1, "profile_pic_variants": 1, "basic_salary": 1, "allowances": 1, "fixed_salary": 1}
     ).to_list(length=None)
     
     # Get attendance for the date
@@ -3748,12 +4335,9 @@ async def get_attendance_by_date(date: str, current_user: User = Depends(get_cur
     
     # Get settings for holidays and Saturday configuration
     db_settings = await db.settings.find_one({"company_id": current_user.company_id})
-    holidays = db_settings.get("holidays", []) if db_settings else []
-    saturday_enabled = db_settings.get("saturday_enabled", True) if db_settings else True
-    saturday_type = db_settings.get("saturday_type", "full") if db_settings else "full"
     
     # Calculate working days for this month
-    working_days_result = calculate_working_days(year_int, month_int, holidays, saturday_enabled, saturday_type)
+    working_days_result = company_working_days(current_user.company_id, year_int, month_int, db_settings)
     working_days = working_days_result["working_days"]
     
     # Calculate expected minutes per day
@@ -3784,7 +4368,7 @@ async def get_attendance_by_date(date: str, current_user: User = Depends(get_cur
         if employee["id"] in attendance_map:
             # Add salary and earnings to existing attendance record
             record = attendance_map[employee["id"]]
-            record["profile_pic"] = emp_data.get("profile_pic")
+            record["profile_pic"] = profile_thumbnail(emp_data)
             record["employee_id_display"] = emp_data.get("employee_id")
             
             # Calculate earnings for this day
@@ -3829,7 +4413,7 @@ async def get_attendance_by_date(date: str, current_user: User = Depends(get_cur
                 "employee_id": employee["id"],
                 "employee_name": employee["name"],
                 "employee_id_display": emp_data.get("employee_id"),
-                "profile_pic": emp_data.get("profile_pic"),
+                "profile_pic": profile_thumbnail(emp_data),
                 "company_id": current_user.company_id,
                 "date": date,
                 "status": "absent",
@@ -3847,135 +4431,930 @@ async def get_attendance_by_date(date: str, current_user: User = Depends(get_cur
     }
 
 @api_router.get("/attendance/deleted")
-async def get_deleted_attendance(current_user: User = Depends(get_current_user)):
+async def get_deleted_attendance(
+    response: Response,
+    cursor: Optional[str] = None,
+    limit: Optional[int] = None,
+    include_total: bool = False,
+    current_user: User = Depends(get_current_user)
+):
     if current_user.role not in ["admin", "manager", "accountant"]:
         raise HTTPException(status_code=403, detail="Admin, manager or accountant access required")
     
-    deleted_records = await db.deleted_attendance.find(
-        {"company_id": current_user.company_id},
-        {"_id": 0}
-    ).sort("deleted_at", -1).to_list(1000)
+    page = await fetch_page(db.deleted_attendance, {"company_id": current_user.company_id}, "deleted_at", -1, cursor, limit, include_total)
+    set_page_headers(response, page)
+    
+    return page["items"]
+
+# ============= PAYROLL AGGREGATES =============
+# db.payroll_aggregates holds one document per (company, employee, month) with the attendance
+# totals payroll needs, kept current by record_attendance_change() on every attendance write.
+# Late minutes depend on the company start time, so each aggregate remembers the start_time it
+# was built with; an aggregate for another start time is treated as missing and rebuilt.
+#
+# Writers and rebuilds must not double count or lose a write. Before touching attendance a writer
+# calls begin_aggregate_write(), which bumps "version" and "pending" on the aggregates it will
+# change; record_attendance_change() applies its $inc and releases them. A rebuild only stores
+# its result when no write was in flight and the version is unchanged since it started reading.
+# Anything that cannot be applied safely marks the aggregate "stale" and the next read rebuilds it.
+ATTENDANCE_STATUS_COUNTERS = {
+    "present": "present_days",
+    "leave": "leave_days",
+    "half_day": "half_days",
+    "allowed_leave": "allowed_leaves",
+    "allowed_half_day": "allowed_half_days"
+}
+AGGREGATE_COUNTERS = list(ATTENDANCE_STATUS_COUNTERS.values()) + ["completed_minutes", "late_minutes", "records"]
+AGGREGATE_WRITE_LEASE = timedelta(minutes=5)  # a write pending longer than this is treated as abandoned
+
+def group_by_employee(rows: List[dict]) -> dict:
+    """Group documents by their employee_id field"""
+    grouped = defaultdict(list)
+    for row in rows:
+        grouped[row.get("employee_id")].append(row)
+    return grouped
+
+def attendance_contribution(record: Optional[dict], start_time: str) -> dict:
+    """What one attendance row adds to its employee's monthly aggregate"""
+    counters = dict.fromkeys(AGGREGATE_COUNTERS, 0)
+    if not record:
+        return counters
+    
+    counters["records"] = 1
+    status_counter = ATTENDANCE_STATUS_COUNTERS.get(record.get("status"))
+    if status_counter:
+        counters[status_counter] = 1
+    
+    # Completed sessions only - an open session is added live from today's rows
+    if record.get("check_in") and record.get("check_out"):
+        try:
+            checkin_dt = datetime.fromisoformat(record["check_in"])
+            checkout_dt = datetime.fromisoformat(record["check_out"])
+            counters["completed_minutes"] = int((checkout_dt - checkin_dt).total_seconds() / 60)
+        except:
+            pass
     
-    return deleted_records
-
-# ============= PAYROLL ENDPOINTS =============
-@api_router.post("/payroll/generate")
-async def generate_payroll(payroll_data: dict, current_user: User = Depends(get_current_user)):
-    """Generate payroll for a specific month"""
-    if current_user.role not in ["admin", "manager", "accountant"]:
-        raise HTTPException(status_code=403, detail="Admin, Manager or Accountant access required")
+    if record.get("check_in") and record.get("status") == "present":
+        try:
+            expected_checkin = datetime.strptime(start_time, "%H:%M").time()
+            checkin_time = datetime.fromisoformat(record["check_in"]).time()
+            late = (checkin_time.hour * 60 + checkin_time.minute) - (expected_checkin.hour * 60 + expected_checkin.minute)
+            counters["late_minutes"] = max(late, 0)
+        except:
+            pass
     
-    month = payroll_data["month"]  # Format: "YYYY-MM"
-    year, month_num = month.split("-")
+    return counters
+
+def summarize_attendance(records: List[dict], start_time: str) -> dict:
+    summary = dict.fromkeys(AGGREGATE_COUNTERS, 0)
+    for record in records:
+        for field, value in attendance_contribution(record, start_time).items():
+            summary[field] += value
+    return summary
+
+async def get_company_start_time(company_id: str) -> str:
+    settings = await db.settings.find_one({"company_id": company_id}, {"_id": 0, "start_time": 1})
+    return (settings or {}).get("start_time", "09:00")
+
+def aggregate_keys(*records) -> set:
+    """(employee_id, month) aggregates that attendance records fall in"""
+    return {(r["employee_id"], r["date"][:7]) for r in records if r and r.get("employee_id") and r.get("date")}
+
+async def begin_aggregate_write(company_id: str, keys: set):
+    """Mark aggregates as being written, before the attendance write itself"""
+    from pymongo import UpdateOne
+    from pymongo.errors import BulkWriteError
+    if not keys:
+        return
+    update = {"$inc": {"pending": 1, "version": 1}, "$set": {"pending_at": datetime.now(timezone.utc).isoformat()}}
+    filters = [{"company_id": company_id, "employee_id": employee_id, "month": month} for employee_id, month in keys]
+    try:
+        await db.payroll_aggregates.bulk_write([UpdateOne(f, update, upsert=True) for f in filters], ordered=False)
+    except BulkWriteError as e:
+        # Lost a concurrent upsert of a new aggregate - it exists now, so mark those again
+        failed = [filters[error["index"]] for error in e.details.get("writeErrors", [])]
+        await db.payroll_aggregates.bulk_write([UpdateOne(f, update, upsert=True) for f in failed], ordered=False)
+
+async def end_aggregate_write(company_id: str, keys: set, stale: bool = False):
+    """Release aggregates marked by begin_aggregate_write(); stale=True makes the next read rebuild them"""
+    from pymongo import UpdateOne
+    if not keys:
+        return
+    update = {"$inc": {"pending": -1}}
+    if stale:
+        update["$set"] = {"stale": True}
+    await db.payroll_aggregates.bulk_write([
+        UpdateOne({"company_id": company_id, "employee_id": employee_id, "month": month}, update)
+        for employee_id, month in keys
+    ], ordered=False)
+
+async def rebuild_payroll_aggregates(company_id: str, month: str, employee_ids: Optional[List[str]] = None,
+                                     start_time: Optional[str] = None) -> dict:
+    """
+    Recompute aggregates for (company, month) from raw attendance and store them
+    employee_ids=None rebuilds every employee with attendance that month
+    An aggregate that an attendance write touched meanwhile is returned but not stored
+
+    Returns:
+        Dict of employee id -> aggregate
+    """
+    from pymongo import UpdateOne
+    from pymongo.errors import BulkWriteError
+    if start_time is None:
+        start_time = await get_company_start_time(company_id)
+    
+    # Read the write guards before the rows: a write that starts later bumps the version
+    guard_query = {"company_id": company_id, "month": month}
+    if employee_ids is not None:
+        guard_query["employee_id"] = {"$in": employee_ids}
+    guards = {
+        guard["employee_id"]: guard
+        for guard in await db.payroll_aggregates.find(
+            guard_query, {"_id": 0, "employee_id": 1, "version": 1, "pending": 1, "pending_at": 1}
+        ).to_list(length=None)
+    }
+    lease_cutoff = (datetime.now(timezone.utc) - AGGREGATE_WRITE_LEASE).isoformat()
     
-    # Get all employees for the company
-    employees = await db.users.find({
-        "company_id": current_user.company_id,
-        "role": {"$in": ["employee", "staff_member", "manager"]}
-    }).to_list(length=None)
+    query = {"company_id": company_id, "date": {"$regex": f"^{month}"}}
+    if employee_ids is not None:
+        query["employee_id"] = {"$in": employee_ids}
+    rows = await db.attendance.find(
+        query, {"_id": 0, "employee_id": 1, "date": 1, "check_in": 1, "check_out": 1, "status": 1}
+    ).to_list(length=None)
+    grouped = group_by_employee(rows)
+    
+    aggregates = {}
+    operations = []
+    now = datetime.now(timezone.utc).isoformat()
+    for employee_id in (employee_ids if employee_ids is not None else list(grouped)):
+        aggregate = {
+            "company_id": company_id,
+            "employee_id": employee_id,
+            "month": month,
+            "start_time": start_time,
+            **summarize_attendance(grouped.get(employee_id, []), start_time),
+            "stale": False,
+            "updated_at": now
+        }
+        aggregates[employee_id] = aggregate
+        
+        key = {"company_id": company_id, "employee_id": employee_id, "month": month}
+        guard = guards.get(employee_id)
+        if guard is None:
+            # Only create it - a writer that created it meanwhile owns it
+            operations.append(UpdateOne(key, {"$setOnInsert": {**aggregate, "pending": 0, "version": 0}}, upsert=True))
+        elif (guard.get("pending") or 0) <= 0 or (guard.get("pending_at") or "") < lease_cutoff:
+            operations.append(UpdateOne(
+                {**key, "version": guard.get("version")},
+                {"$set": {**aggregate, "pending": 0}}
+            ))
+        # else: a write is in flight; it releases the aggregate and a later read rebuilds if needed
+    
+    if operations:
+        try:
+            await db.payroll_aggregates.bulk_write(operations, ordered=False)
+        except BulkWriteError as e:
+            logging.error(f"Storing payroll aggregates for {company_id} {month} failed: {e.details.get('writeErrors')}")
+    return aggregates
+
+async def rebuild_all_payroll_aggregates(company_id: Optional[str] = None, month: Optional[str] = None) -> List[dict]:
+    """
+    Rebuild aggregates from raw attendance for every (company, month) that has attendance,
+    optionally limited to one company and/or month. Aggregates with no attendance left are removed.
+
+    Returns:
+        List of {"company_id", "month", "employees"} per rebuilt (company, month)
+    """
+    match = {}
+    if company_id:
+        match["company_id"] = company_id
+    if month:
+        match["date"] = {"$regex": f"^{month}"}
     
-    payroll_records = []
+    groups = await db.attendance.aggregate([
+        {"$match": match},
+        {"$group": {"_id": {"company_id": "$company_id", "month": {"$substr": ["$date", 0, 7]}}}},
+        {"$sort": {"_id.company_id": 1, "_id.month": 1}}
+    ]).to_list(length=None)
     
-    for employee in employees:
-        # Get effective salary for this month (considers increment history)
-        effective_salary = await get_effective_salary(
-            employee["id"], 
-            current_user.company_id, 
-            month
+    rebuilt = []
+    for group in groups:
+        group_company, group_month = group["_id"]["company_id"], group["_id"]["month"]
+        aggregates = await rebuild_payroll_aggregates(group_company, group_month)
+        # Drop aggregates for employees whose attendance for the month is gone
+        await db.payroll_aggregates.delete_many({
+            "company_id": group_company,
+            "month": group_month,
+            "employee_id": {"$nin": list(aggregates)},
+            "pending": {"$not": {"$gt": 0}}
+        })
+        rebuilt.append({"company_id": group_company, "month": group_month, "employees": len(aggregates)})
+    
+    # (company, month) pairs with no attendance at all
+    stale_match = {}
+    if company_id:
+        stale_match["company_id"] = company_id
+    if month:
+        stale_match["month"] = month
+    live_pairs = [{"company_id": r["company_id"], "month": r["month"]} for r in rebuilt]
+    if live_pairs:
+        stale_match["$nor"] = live_pairs
+    stale_match["pending"] = {"$not": {"$gt": 0}}
+    await db.payroll_aggregates.delete_many(stale_match)
+    
+    return rebuilt
+
+async def record_attendance_change(company_id: str, old_record: Optional[dict] = None, new_record: Optional[dict] = None,
+                                   start_time: Optional[str] = None, guarded: Optional[set] = None):
+    """
+    Apply one attendance write to payroll_aggregates with $inc and wake live payroll
+    Pass old_record=None for an insert and new_record=None for a delete
+    guarded: the (employee_id, month) keys begin_aggregate_write() marked for this write - all are
+    released here. A change to an unguarded aggregate cannot be applied safely and marks it stale.
+    """
+    guarded = set(guarded or ())
+    deltas = defaultdict(lambda: dict.fromkeys(AGGREGATE_COUNTERS, 0))
+    released = set()
+    try:
+        if start_time is None:
+            start_time = await get_company_start_time(company_id)
+        
+        # A write can move a row between months (date change), so diff per (employee, month)
+        for record, sign in ((old_record, -1), (new_record, 1)):
+            if record and record.get("date") and record.get("employee_id"):
+                key = (record["employee_id"], record["date"][:7])
+                for field, value in attendance_contribution(record, start_time).items():
+                    deltas[key][field] += sign * value
+        
+        for key in set(deltas) | guarded:
+            employee_id, month = key
+            increments = {field: value for field, value in deltas[key].items() if value}
+            if increments:
+                await invalidate_month_totals(company_id, month)
+            
+            if key in guarded and increments:
+                result = await db.payroll_aggregates.update_one(
+                    {"company_id": company_id, "employee_id": employee_id, "month": month,
+                     "start_time": start_time, "stale": {"$ne": True}},
+                    {"$inc": {**increments, "pending": -1}, "$set": {"updated_at": datetime.now(timezone.utc).isoformat()}}
+                )
+                if not result.matched_count:
+                    # Not built yet, built for an old start time, or already stale - the read path rebuilds it
+                    await end_aggregate_write(company_id, {key}, stale=True)
+                released.add(key)
+            elif key in guarded:
+                await end_aggregate_write(company_id, {key})
+                released.add(key)
+            elif increments:
+                await db.payroll_aggregates.update_one(
+                    {"company_id": company_id, "employee_id": employee_id, "month": month},
+                    {"$set": {"stale": True}},
+                    upsert=True
+                )
+    except Exception as e:
+        # Never fail the attendance write over aggregates - mark them stale so the next read rebuilds
+        logging.error(f"Payroll aggregate update failed for {company_id}: {str(e)}")
+        try:
+            await end_aggregate_write(company_id, guarded - released, stale=True)
+            for employee_id, month in set(deltas) - guarded:
+                await db.payroll_aggregates.update_one(
+                    {"company_id": company_id, "employee_id": employee_id, "month": month},
+                    {"$set": {"stale": True}},
+                    upsert=True
+                )
+        except Exception as e:
+            logging.error(f"Marking payroll aggregates stale failed for {company_id}: {str(e)}")
+    
+    notify_live_payroll(company_id)
+
+async def load_attendance_summaries(company_id: str, month: str, employee_ids: List[str], start_time: str) -> dict:
+    """Aggregates for the given employees, rebuilding any that are missing or stale"""
+    aggregates = await db.payroll_aggregates.find({
+        "company_id": company_id,
+        "employee_id": {"$in": employee_ids},
+        "month": month
+    }, {"_id": 0}).to_list(length=None)
+    summaries = {a["employee_id"]: a for a in aggregates if a.get("start_time") == start_time and not a.get("stale")}
+    
+    stale_ids = [emp_id for emp_id in employee_ids if emp_id not in summaries]
+    if stale_ids:
+        summaries.update(await rebuild_payroll_aggregates(company_id, month, stale_ids, start_time))
+    return summaries
+
+
+# ============= ATTENDANCE WRITES =============
+# Every attendance write goes through these primitives. Records carry a per-day slot "seq" and
+# (company_id, employee_id, date, seq) is unique, so "first punch of the day" is enforced by the
+# index instead of a read followed by a write, and two inserts racing for the same day collide
+# on their slot, so the loser re-checks the daily cap. Slots only grow (the highest seq is the
+# latest record of the day), so the cap counts the stored records, not the slot number. Each
+# primitive also updates the payroll aggregates from the record as it was actually stored.
+ATTENDANCE_MAX_PER_DAY = 10
+
+def attendance_day(record: dict) -> dict:
+    return {"company_id": record["company_id"], "employee_id": record["employee_id"], "date": record["date"]}
+
+async def insert_attendance(record: dict, max_per_day: int = ATTENDANCE_MAX_PER_DAY, start_time: Optional[str] = None) -> dict:
+    """Insert an attendance record into the slot after the employee's latest one for that day"""
+    from pymongo.errors import DuplicateKeyError
+    day = attendance_day(record)
+    keys = aggregate_keys(record)
+    await begin_aggregate_write(record["company_id"], keys)
+    
+    try:
+        while True:
+            count, last = await asyncio.gather(
+                db.attendance.count_documents(day),
+                db.attendance.find_one(day, {"_id": 0, "seq": 1}, sort=[("seq", -1)])
+            )
+            if count >= max_per_day:
+                raise HTTPException(
+                    status_code=400,
+                    detail=f"Daily limit exceeded. Maximum {max_per_day} attendance records per day allowed. Current count: {count}"
+                )
+            seq = (last.get("seq") or 0) + 1 if last else 1
+            try:
+                await db.attendance.insert_one({**record, "seq": seq})
+                break
+            except DuplicateKeyError:
+                # A concurrent writer took this slot - count again
+                continue
+    except Exception:
+        await end_aggregate_write(record["company_id"], keys)
+        raise
+    
+    record["seq"] = seq
+    await record_attendance_change(record["company_id"], new_record=record, start_time=start_time, guarded=keys)
+    return record
+
+async def open_attendance_day(record: dict, start_time: Optional[str] = None) -> Optional[dict]:
+    """
+    Insert record as the employee's first attendance of the day unless one already exists
+    Returns the existing (latest) record for the day, or None when record was inserted
+    """
+    from pymongo.errors import DuplicateKeyError
+    day = attendance_day(record)
+    keys = aggregate_keys(record)
+    await begin_aggregate_write(record["company_id"], keys)
+    
+    try:
+        try:
+            existing = await db.attendance.find_one_and_update(
+                day,
+                {"$setOnInsert": {**{key: value for key, value in record.items() if key not in day}, "seq": 1}},
+                upsert=True,
+                sort=[("seq", -1)],
+                projection={"_id": 0}
+            )
+        except DuplicateKeyError:
+            # Lost the race for slot 1 - the winner's record is the existing one
+            existing = await db.attendance.find_one(day, {"_id": 0}, sort=[("seq", -1)])
+    except Exception:
+        await end_aggregate_write(record["company_id"], keys)
+        raise
+    
+    if existing is None:
+        record["seq"] = 1
+        await record_attendance_change(record["company_id"], new_record=record, start_time=start_time, guarded=keys)
+    else:
+        await end_aggregate_write(record["company_id"], keys)
+    return existing
+
+async def update_attendance_record(attendance: dict, changes: dict, expected: Optional[dict] = None,
+                                   start_time: Optional[str] = None) -> Optional[dict]:
+    """
+    Atomically $set changes on an attendance record
+    expected: conditions the stored record must still meet, e.g. {"check_out": None}
+    Returns the record as it was before the update, or None when it no longer matched
+    """
+    keys = aggregate_keys(attendance, {**attendance, **changes})
+    await begin_aggregate_write(attendance["company_id"], keys)
+    try:
+        before = await db.attendance.find_one_and_update(
+            {"id": attendance["id"], "company_id": attendance["company_id"], **(expected or {})},
+            {"$set": changes},
+            projection={"_id": 0}
         )
-        
-        # Get attendance for this employee for this month
-        attendance_records = await db.attendance.find({
-            "employee_id": employee["id"],
-            "company_id": current_user.company_id,
-            "date": {"$regex": f"^{month}"}
-        }).to_list(length=None)
-        
-        # Calculate attendance metrics
-        present_days = len([a for a in attendance_records if a.get("status") == "present"])
-        leave_days = len([a for a in attendance_records if a.get("status") == "leave"])
-        half_days = len([a for a in attendance_records if a.get("status") == "half_day"])
-        
-        # Calculate total hours worked
-        total_hours = 0
-        for record in attendance_records:
-            if record.get("check_in") and record.get("check_out"):
-                try:
-                    check_in = datetime.fromisoformat(record["check_in"])
-                    check_out = datetime.fromisoformat(record["check_out"])
-                    hours = (check_out - check_in).total_seconds() / 3600
-                    total_hours += hours
-                except:
-                    pass
-        
-        # Get company settings for working hours
-        settings = await db.settings.find_one({"company_id": current_user.company_id})
-        expected_hours_per_day = 8  # default
-        if settings:
+    except Exception:
+        await end_aggregate_write(attendance["company_id"], keys)
+        raise
+    
+    if before:
+        await record_attendance_change(before["company_id"], before, {**before, **changes}, start_time, guarded=keys)
+    else:
+        await end_aggregate_write(attendance["company_id"], keys)
+    return before
+
+async def delete_attendance_record(attendance_id: str, company_id: str) -> Optional[dict]:
+    """Atomically delete an attendance record; returns it, or None when it was already gone"""
+    current = await db.attendance.find_one({"id": attendance_id, "company_id": company_id}, {"_id": 0, "employee_id": 1, "date": 1})
+    if not current:
+        return None
+    keys = aggregate_keys(current)
+    await begin_aggregate_write(company_id, keys)
+    try:
+        deleted = await db.attendance.find_one_and_delete({"id": attendance_id, "company_id": company_id}, projection={"_id": 0})
+    except Exception:
+        await end_aggregate_write(company_id, keys)
+        raise
+    
+    if not deleted:
+        await end_aggregate_write(company_id, keys)
+    else:
+        await record_attendance_change(company_id, old_record=deleted, guarded=keys)
+        if deleted.get("location"):
+            await refresh_location_rollup(company_id, deleted["employee_id"], deleted["date"])
+    return deleted
+
+ATTENDANCE_WRITE_BATCH = 1000
+
+async def bulk_apply_attendance(company_id: str, inserts: List[dict], updates: List[tuple],
+                                start_time: Optional[str] = None, on_progress=None) -> dict:
+    """
+    Apply many attendance writes with chunked unordered bulk_write, then rebuild the payroll
+    aggregates of every touched (employee, month) once instead of once per record
+    - inserts: new records for days with no attendance (they take slot 1)
+    - updates: (stored record, changes) pairs
+    - on_progress: optional async callback(writes done)
+
+    Returns:
+        {"inserted": n, "updated": n, "conflicts": [inserted records whose day was filled meanwhile], "errors": [...]}
+    """
+    from pymongo import InsertOne, UpdateOne
+    from pymongo.errors import BulkWriteError
+    
+    writes = [(InsertOne({**record, "seq": 1}), record) for record in inserts]
+    writes += [(UpdateOne({"id": record["id"], "company_id": company_id}, {"$set": changes}), record) for record, changes in updates]
+    
+    # Guard every aggregate the writes can touch; they are released stale and rebuilt below
+    keys = aggregate_keys(*inserts, *[r for record, changes in updates for r in (record, {**record, **changes})])
+    await begin_aggregate_write(company_id, keys)
+    
+    failed = set()
+    conflicts = []
+    errors = []
+    try:
+        for offset in range(0, len(writes), ATTENDANCE_WRITE_BATCH):
+            chunk = writes[offset:offset + ATTENDANCE_WRITE_BATCH]
             try:
-                start = datetime.strptime(settings.get("start_time", "09:00"), "%H:%M")
-                finish = datetime.strptime(settings.get("finish_time", "17:00"), "%H:%M")
-                expected_hours_per_day = (finish - start).total_seconds() / 3600
+                await db.attendance.bulk_write([operation for operation, _ in chunk], ordered=False)
+            except BulkWriteError as e:
+                for error in e.details.get("writeErrors", []):
+                    record = chunk[error["index"]][1]
+                    failed.add(offset + error["index"])
+                    if error.get("code") == 11000:
+                        conflicts.append(record)
+                    else:
+                        errors.append(f"Error writing {record['employee_id']} on {record['date']}: {error.get('errmsg')}")
+            if on_progress:
+                await on_progress(min(offset + ATTENDANCE_WRITE_BATCH, len(writes)))
+    finally:
+        await end_aggregate_write(company_id, keys, stale=True)
+    
+    touched = defaultdict(set)
+    for index, (_, record) in enumerate(writes):
+        if index not in failed:
+            touched[record["date"][:7]].add(record["employee_id"])
+    
+    if start_time is None:
+        start_time = await get_company_start_time(company_id)
+    for month, employee_ids in touched.items():
+        await invalidate_month_totals(company_id, month)
+        await rebuild_payroll_aggregates(company_id, month, list(employee_ids), start_time)
+    if touched:
+        notify_live_payroll(company_id)
+    
+    return {
+        "inserted": sum(1 for index in range(len(inserts)) if index not in failed),
+        "updated": sum(1 for index in range(len(inserts), len(writes)) if index not in failed),
+        "conflicts": conflicts,
+        "errors": errors
+    }
+
+# ============= PAYROLL ENGINE =============
+
+async def load_payroll_inputs(company_id: str, month: str, employees: List[dict], start_time: str, today: str) -> dict:
+    """
+    Load everything payroll needs for (company, month) in a fixed number of queries
+    Each collection is read once with $in over the employee ids and grouped in memory,
+    instead of one round trip per employee per collection. Attendance comes from
+    payroll_aggregates plus today's raw rows (for open sessions), not the whole month.
+
+    Returns:
+        Dict with "salaries" (employee id -> effective salary), "summaries" (employee id -> aggregate)
+        and "today_attendance", "advances", "extra_payments", "loans" (employee id -> list of docs)
+    """
+    employee_ids = [emp["id"] for emp in employees]
+    if not employee_ids:
+        return {"salaries": {}, "summaries": {}, "today_attendance": {}, "advances": {}, "extra_payments": {}, "loans": {}}
+
+    async def load_today_attendance():
+        if not today.startswith(month):
+            return []
+        return await db.attendance.find({
+            "company_id": company_id,
+            "employee_id": {"$in": employee_ids},
+            "date": today
+        }, {"_id": 0, "employee_id": 1, "date": 1, "check_in": 1, "check_out": 1, "status": 1}).to_list(length=None)
+
+    salaries, summaries, today_attendance, advances, extra_payments, loans = await asyncio.gather(
+        get_effective_salaries(employees, company_id, month),
+        load_attendance_summaries(company_id, month, employee_ids, start_time),
+        load_today_attendance(),
+        db.advances.find({
+            "company_id": company_id,
+            "employee_id": {"$in": employee_ids},
+            "status": "approved",
+            "request_date": {"$regex": f"^{month}"}
+        }, {"_id": 0, "employee_id": 1, "amount": 1}).to_list(length=None),
+        db.extra_payments.find({
+            "company_id": company_id,
+            "employee_id": {"$in": employee_ids},
+            "month": month
+        }, {"_id": 0, "employee_id": 1, "amount": 1}).to_list(length=None),
+        db.loans.find({
+            "company_id": company_id,
+            "employee_id": {"$in": employee_ids},
+            "status": "active"
+        }, {"_id": 0, "employee_id": 1, "start_month": 1, "monthly_deduction": 1}).to_list(length=None)
+    )
+
+    return {
+        "salaries": salaries,
+        "summaries": summaries,
+        "today_attendance": group_by_employee(today_attendance),
+        "advances": group_by_employee(advances),
+        "extra_payments": group_by_employee(extra_payments),
+        "loans": group_by_employee(loans)
+    }
+
+def compute_payroll_record(
+    employee: dict,
+    basic_salary: float,
+    attendance_summary: dict,
+    today_records: List[dict],
+    advances: List[dict],
+    extra_payments: List[dict],
+    active_loans: List[dict],
+    month: str,
+    now: datetime,
+    working_days: float,
+    working_hours_per_day: float,
+    start_time: str,
+    is_current_month: bool
+):
+    """
+    Compute one employee's salary breakdown for a month (no DB access)
+    attendance_summary is the employee's payroll_aggregates document for the month and
+    today_records are today's raw attendance rows (used for open sessions and today's earnings)
+
+    Returns:
+        (record, today_earnings) - today_earnings uses Sri Lanka time for the live "today" figure
+    """
+    import calendar
+
+    # Calculate attendance metrics
+    present_days = attendance_summary.get("present_days", 0)
+    leave_days = attendance_summary.get("leave_days", 0)
+    half_days = attendance_summary.get("half_days", 0)
+    allowed_leaves = attendance_summary.get("allowed_leaves", 0)
+    allowed_half_days = attendance_summary.get("allowed_half_days", 0)
+
+    # Completed sessions come pre-summed; only today's rows are looked at individually
+    total_attendance_minutes = attendance_summary.get("completed_minutes", 0)
+    today_minutes = 0
+    today_str = now.strftime("%Y-%m-%d")
+    has_open_session = False
+
+    for record in today_records:
+        record_date = record.get("date", "")
+
+        # Today's completed sessions (already in the summary's total)
+        if record.get("check_in") and record.get("check_out"):
+            try:
+                checkin_dt = datetime.fromisoformat(record["check_in"])
+                checkout_dt = datetime.fromisoformat(record["check_out"])
+                if record_date == today_str:
+                    today_minutes += int((checkout_dt - checkin_dt).total_seconds() / 60)
             except:
                 pass
+        # For today's ongoing attendance (checked in but not out yet) - only if viewing current month
+        elif record_date == today_str and record.get("check_in") and not record.get("check_out") and month == now.strftime("%Y-%m"):
+            try:
+                checkin_dt = datetime.fromisoformat(record["check_in"])
+                # Use naive datetime - compare local to local
+                total_attendance_minutes += int((now - checkin_dt).total_seconds() / 60)
+                has_open_session = True
+                # Server is in UTC, check-ins are in Sri Lanka time (UTC+5:30)
+                now_srilanka = now + timedelta(hours=5, minutes=30)
+                today_minutes += int((now_srilanka - checkin_dt).total_seconds() / 60)
+            except:
+                pass
+
+    # For allowed leaves, add full day minutes (counts as worked)
+    minutes_per_day = working_hours_per_day * 60
+    total_attendance_minutes += (allowed_leaves * minutes_per_day)
+    total_attendance_minutes += (allowed_half_days * minutes_per_day * 0.5)
+
+    # Calculate late minutes and deduction
+    late_minutes = 0
+    late_deduction = 0
+
+    if not employee.get("fixed_salary", False):  # Only if NOT fixed salary
+        late_minutes = attendance_summary.get("late_minutes", 0)
+
+        if late_minutes > 0 and working_days > 0:
+            salary_per_day = basic_salary / working_days
+            salary_per_hour = salary_per_day / working_hours_per_day
+            late_deduction = late_minutes * (salary_per_hour / 60)
+
+    total_advances = sum([adv.get("amount", 0) for adv in advances])
+    other_deductions = employee.get("deductions", 0)
+    allowances = employee.get("allowances", 0)
+    total_extra_payment = sum([ep.get("amount", 0) for ep in extra_payments])
+
+    # Loan deduction for this month (only loans that have started)
+    loan_deduction = 0
+    for loan in active_loans:
+        if loan.get("start_month", month) <= month:
+            loan_deduction += loan.get("monthly_deduction", 0)
+
+    # Calculate earnings and gross based on salary type
+    salary_per_minute = (basic_salary / working_days / working_hours_per_day / 60) if working_days > 0 else 0
+
+    # How fast earnings/allowances grow from "now" - lets live clients interpolate between snapshots
+    earnings_per_second = 0
+    allowances_per_second = 0
+
+    if employee.get("fixed_salary", False):
+        if is_current_month:
+            # For current month: pro-rate based on time passed
+            year, month_num = month.split("-")
+            days_in_month = calendar.monthrange(int(year), int(month_num))[1]
+            hours_in_month = days_in_month * 24
+            hours_passed = (now.day - 1) * 24 + now.hour + now.minute / 60 + now.second / 3600
+
+            earnings = (basic_salary / hours_in_month) * hours_passed
+            allowances_to_add = (allowances / hours_in_month) * hours_passed
+            earnings_per_second = basic_salary / hours_in_month / 3600
+            allowances_per_second = allowances / hours_in_month / 3600
+        else:
+            # For past completed months: full salary regardless of attendance
+            earnings = basic_salary
+            allowances_to_add = allowances
+    else:
+        # Non-fixed salary: based on actual attendance minutes
+        earnings = total_attendance_minutes * salary_per_minute
+        allowances_to_add = allowances
+        if has_open_session:
+            earnings_per_second = salary_per_minute / 60
+
+    # Gross = Earnings + Extra payments (WITHOUT allowances)
+    gross_salary = earnings + total_extra_payment
+
+    # Net = Gross + Allowances - Deductions (WITH allowances)
+    total_deductions = late_deduction + total_advances + other_deductions + loan_deduction
+    net_salary = gross_salary + allowances_to_add - total_deductions
+
+    record = {
+        "employee_id": employee["id"],
+        "employee_name": employee["name"],
+        "position": employee.get("position", "Staff"),
+        "profile_picture": profile_thumbnail(employee),
+        "basic_salary": round(basic_salary, 2),
+        "allowances": round(allowances_to_add, 2),
+        "earnings": round(earnings, 2),
+        "working_days": working_days,
+        "present_days": present_days,
+        "leave_days": leave_days,
+        "half_days": half_days,
+        "allowed_leaves": allowed_leaves,
+        "allowed_half_days": allowed_half_days,
+        "total_attendance_minutes": total_attendance_minutes,
+        "late_minutes": late_minutes,
+        "late_deduction": round(late_deduction, 2),
+        "advances": round(total_advances, 2),
+        "other_deductions": round(other_deductions, 2),
+        "loan_deduction": round(loan_deduction, 2),
+        "extra_payment": round(total_extra_payment, 2),
+        "gross_salary": round(gross_salary, 2),
+        "total_deductions": round(total_deductions, 2),
+        "net_salary": round(net_salary, 2),
+        "fixed_salary": employee.get("fixed_salary", False),
+        "salary_per_minute": round(salary_per_minute, 2),
+        "earnings_per_second": earnings_per_second,
+        "allowances_per_second": allowances_per_second
+    }
+    # Today's earnings only apply to non-fixed salaries
+    today_earnings = today_minutes * salary_per_minute if not employee.get("fixed_salary", False) else 0
+
+    return record, today_earnings
+
+async def compute_company_payroll(company_id: str, month: str, employees: List[dict], now: datetime,
+                                  working_days: float, working_hours_per_day: float, start_time: str,
+                                  is_current_month: bool):
+    """
+    Compute payroll records for all given employees in one pass
+
+    Returns:
+        (records, today_total_earnings)
+    """
+    inputs = await load_payroll_inputs(company_id, month, employees, start_time, now.strftime("%Y-%m-%d"))
+
+    detailed_records = []
+    today_total_earnings = 0
+
+    for employee in employees:
+        emp_id = employee["id"]
+        record, today_earnings = compute_payroll_record(
+            employee,
+            inputs["salaries"].get(emp_id, 0.0),
+            inputs["summaries"].get(emp_id, {}),
+            inputs["today_attendance"].get(emp_id, []),
+            inputs["advances"].get(emp_id, []),
+            inputs["extra_payments"].get(emp_id, []),
+            inputs["loans"].get(emp_id, []),
+            month,
+            now,
+            working_days,
+            working_hours_per_day,
+            start_time,
+            is_current_month
+        )
+        detailed_records.append(record)
+        today_total_earnings += today_earnings
+
+    return detailed_records, today_total_earnings
+
+async def snapshot_month_totals(company_id: str, month: str, source: str = "closed") -> dict:
+    """
+    Persist a closed month's payroll totals in db.payroll_month_totals so /payroll/months
+    doesn't recompute it. source is "closed" (first read after month end) or "generated".
+    Edits to that month's attendance, advances or extra payments drop the snapshot; employee,
+    loan, increment and settings changes drop every snapshot of the company.
+    """
+    detailed = await build_detailed_payroll(company_id, month)
+    records = detailed["employees"]
+    totals = {
+        "company_id": company_id,
+        "month": month,
+        "total_gross": round(sum([r["gross_salary"] for r in records]), 2),
+        "total_net": round(sum([r["net_salary"] for r in records]), 2),
+        "total_deductions": round(sum([r["total_deductions"] for r in records]), 2),
+        "total_allowances": round(sum([r["allowances"] for r in records]), 2),
+        "employee_count": len(records),
+        "source": source,
+        "snapshotted_at": datetime.now(timezone.utc).isoformat()
+    }
+    await db.payroll_month_totals.update_one(
+        {"company_id": company_id, "month": month},
+        {"$set": totals},
+        upsert=True
+    )
+    return totals
+
+async def invalidate_month_totals(company_id: str, month: Optional[str]):
+    """A closed month's inputs changed - drop its snapshot so it is recomputed on next read"""
+    if month:
+        await db.payroll_month_totals.delete_one({"company_id": company_id, "month": month[:7]})
+
+async def invalidate_company_month_totals(company_id: str):
+    """
+    Inputs every month is computed from changed (employees and their salaries, loans,
+    increments, working days, start time) - drop all of the company's snapshots
+    """
+    await db.payroll_month_totals.delete_many({"company_id": company_id})
+
+# ============= PAYROLL ENDPOINTS =============
+PAYROLL_WRITE_BATCH = 1000
+
+async def run_payroll_generation(job: dict) -> dict:
+    """
+    Background worker for POST /payroll/generate
+    Inputs are loaded in bulk and the rows are upserted by (company, employee, month),
+    so re-running a month replaces it
+    """
+    from pymongo import UpdateOne
+    
+    company_id = job["company_id"]
+    month = job["details"]["month"]
+    
+    # Get all employees for the company
+    employees = await db.users.find({
+        "company_id": company_id,
+        "role": {"$in": ["employee", "staff_member", "manager"]}
+    }, {"_id": 0, "id": 1, "name": 1, "basic_salary": 1, "allowances": 1, "deductions": 1}).to_list(length=None)
+    await update_job(job["id"], total=len(employees))
+    
+    if employees:
+        employee_ids = [employee["id"] for employee in employees]
+        start_time = await get_company_start_time(company_id)
         
-        # Calculate late days (simplified - you can enhance this)
-        late_days = 0
-        
-        # Calculate deductions
-        deductions = employee.get("deductions", 0)
-        
-        # Calculate allowances
-        allowances = employee.get("allowances", 0)
-        
-        # Calculate gross salary (using effective salary for this month)
-        gross_salary = effective_salary
-        
-        # Calculate net salary
-        net_salary = gross_salary + allowances - deductions
+        # Effective salaries (considers increment history) and attendance totals for everyone
+        salaries, summaries = await asyncio.gather(
+            get_effective_salaries(employees, company_id, month),
+            load_attendance_summaries(company_id, month, employee_ids, start_time)
+        )
         
-        # Create payroll record
-        payroll_record = {
-            "id": str(uuid.uuid4()),
-            "company_id": current_user.company_id,
-            "employee_id": employee["id"],
-            "employee_name": employee["name"],
-            "month": month,
-            "basic_salary": effective_salary,  # This is the key - uses effective salary
-            "allowances": allowances,
-            "deductions": deductions,
-            "gross_salary": gross_salary,
-            "net_salary": net_salary,
-            "present_days": present_days,
-            "leave_days": leave_days,
-            "half_days": half_days,
-            "late_days": late_days,
-            "total_hours": round(total_hours, 2),
-            "generated_by": current_user.name,
-            "generated_at": datetime.now(timezone.utc).isoformat()
-        }
+        generated_at = datetime.now(timezone.utc).isoformat()
+        operations = []
+        for employee in employees:
+            summary = summaries.get(employee["id"], {})
+            effective_salary = float(salaries.get(employee["id"], 0.0))
+            allowances = float(employee.get("allowances") or 0)
+            deductions = float(employee.get("deductions") or 0)
+            
+            # Calculate gross and net salary (gross uses effective salary for this month)
+            gross_salary = effective_salary
+            net_salary = gross_salary + allowances - deductions
+            
+            payroll_record = {
+                "company_id": company_id,
+                "employee_id": employee["id"],
+                "employee_name": employee["name"],
+                "month": month,
+                "basic_salary": effective_salary,
+                "allowances": allowances,
+                "deductions": deductions,
+                "gross_salary": gross_salary,
+                "net_salary": net_salary,
+                "present_days": summary.get("present_days", 0),
+                "leave_days": summary.get("leave_days", 0),
+                "half_days": summary.get("half_days", 0),
+                "late_days": 0,
+                "late_minutes": int(summary.get("late_minutes", 0)),
+                "total_hours": round(summary.get("completed_minutes", 0) / 60, 2),
+                "generated_by": job["details"]["generated_by"],
+                "generated_at": generated_at
+            }
+            operations.append(UpdateOne(
+                {"company_id": company_id, "employee_id": employee["id"], "month": month},
+                {"$set": payroll_record, "$setOnInsert": {"id": str(uuid.uuid4())}},
+                upsert=True
+            ))
         
-        # Save to database
-        await db.payroll.insert_one(payroll_record)
-        payroll_records.append(payroll_record)
+        for offset in range(0, len(operations), PAYROLL_WRITE_BATCH):
+            await db.payroll.bulk_write(operations[offset:offset + PAYROLL_WRITE_BATCH], ordered=False)
+            await update_job(job["id"], processed=min(offset + PAYROLL_WRITE_BATCH, len(operations)))
+    
+    # Freeze the month's totals for /payroll/months once it has closed
+    if month < datetime.now(timezone.utc).strftime("%Y-%m"):
+        await snapshot_month_totals(company_id, month, source="generated")
     
     # Log activity
     await log_activity(
+        company_id,
+        job["created_by"],
+        job["details"]["generated_by"],
+        "GENERATE_PAYROLL",
+        f"Generated payroll for {month} - {len(employees)} employee(s)"
+    )
+    
+    return {"month": month, "employee_count": len(employees)}
+
+@api_router.post("/payroll/generate")
+async def generate_payroll(payroll_data: dict, current_user: User = Depends(get_current_user)):
+    """Start payroll generation for a specific month; poll GET /jobs/{job_id} for progress"""
+    if current_user.role not in ["admin", "manager", "accountant"]:
+        raise HTTPException(status_code=403, detail="Admin, Manager or Accountant access required")
+    
+    month = payroll_data.get("month", "")  # Format: "YYYY-MM"
+    try:
+        datetime.strptime(month, "%Y-%m")
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid month format. Use YYYY-MM")
+    
+    job = await create_job(
+        "payroll_generation",
         current_user.company_id,
         current_user.id,
-        current_user.name,
-        "GENERATE_PAYROLL",
-        f"Generated payroll for {month} - {len(payroll_records)} employee(s)"
+        {"month": month, "generated_by": current_user.name}
     )
+    start_job(job, run_payroll_generation)
     
+    # employee_count is kept for callers written against the synchronous version of this endpoint
+    employee_count = await db.users.count_documents({
+        "company_id": current_user.company_id,
+        "role": {"$in": ["employee", "staff_member", "manager"]}
+    })
     return {
-        "message": f"Payroll generated for {len(payroll_records)} employee(s)",
+        "message": f"Payroll generation started for {month}",
         "month": month,
-        "employee_count": len(payroll_records)
+        "employee_count": employee_count,
+        "job_id": job["id"],
+        "status": job["status"]
     }
 
 @api_router.get("/payroll")
-async def get_payroll(month: Optional[str] = None, employee_id: Optional[str] = None, current_user: User = Depends(get_current_user)):
+async def get_payroll(
+    response: Response,
+    month: Optional[str] = None,
+    employee_id: Optional[str] = None,
+    cursor: Optional[str] = None,
+    limit: Optional[int] = None,
+    include_total: bool = False,
+    current_user: User = Depends(get_current_user)
+):
     """Get payroll records"""
     query = {"company_id": current_user.company_id}
     
@@ -3985,9 +5364,10 @@ async def get_payroll(month: Optional[str] = None, employee_id: Optional[str] =
     if employee_id:
         query["employee_id"] = employee_id
     
-    payroll = await db.payroll.find(query, {"_id": 0}).sort("generated_at", -1).to_list(length=None)
+    page = await fetch_page(db.payroll, query, "generated_at", -1, cursor, limit, include_total)
+    set_page_headers(response, page)
     
-    return payroll
+    return page["items"]
 
 @api_router.get("/payroll/months")
 async def get_payroll_months(current_user: User = Depends(get_current_user)):
@@ -3996,33 +5376,39 @@ async def get_payroll_months(current_user: User = Depends(get_current_user)):
     employees = await db.users.find({
         "company_id": current_user.company_id,
         "role": {"$in": ["employee", "staff_member", "manager"]}
-    }).to_list(length=None)
+    }, {"_id": 0, "id": 1}).to_list(length=None)
     
     if not employees:
         return []
     
-    # Get distinct months from attendance records
-    pipeline = [
-        {"$match": {"company_id": current_user.company_id}},
-        {"$group": {"_id": {"$substr": ["$date", 0, 7]}}},
-        {"$sort": {"_id": -1}}
-    ]
-    
-    months_data = await db.attendance.aggregate(pipeline).to_list(length=None)
+    # Months with attendance, from payroll_aggregates (far smaller than scanning attendance)
+    months_data = await db.payroll_aggregates.distinct(
+        "month",
+        {"company_id": current_user.company_id, "records": {"$gt": 0}}
+    )
     
     # Also check current month even if no attendance yet
-    from datetime import datetime
     current_month = datetime.now(timezone.utc).strftime("%Y-%m")
-    month_set = set([m["_id"] for m in months_data])
+    month_set = set(months_data)
     month_set.add(current_month)
     
+    # Closed months use their persisted totals; only the current month is computed live
+    stored_totals = await db.payroll_month_totals.find(
+        {"company_id": current_user.company_id, "month": {"$in": list(month_set)}},
+        {"_id": 0, "month": 1, "total_net": 1}
+    ).to_list(length=None)
+    totals_by_month = {t["month"]: t["total_net"] for t in stored_totals}
+    
     result = []
     for month_str in sorted(month_set, reverse=True):
-        # Get detailed payroll for this month to calculate totals
-        detailed_response = await get_detailed_payroll(month_str, current_user)
-        
-        # Calculate totals from detailed records
-        total_net = sum([emp.get("net_salary", 0) for emp in detailed_response.get("employees", [])])
+        if month_str >= current_month:
+            detailed_response = await build_detailed_payroll(current_user.company_id, month_str)
+            total_net = sum([emp.get("net_salary", 0) for emp in detailed_response.get("employees", [])])
+        elif month_str in totals_by_month:
+            total_net = totals_by_month[month_str]
+        else:
+            # First look at a month since it closed (or since its data changed) - snapshot it
+            total_net = (await snapshot_month_totals(current_user.company_id, month_str))["total_net"]
         
         result.append({
             "month": month_str,
@@ -4032,12 +5418,10 @@ async def get_payroll_months(current_user: User = Depends(get_current_user)):
     
     return result
 
-@api_router.get("/payroll/detailed/{month}")
-async def get_detailed_payroll(month: str, current_user: User = Depends(get_current_user)):
-    """Get detailed salary breakdown for all employees in a month"""
-    # Get company and settings
-    company = await db.companies.find_one({"id": current_user.company_id}, {"_id": 0})
-    db_settings = await db.settings.find_one({"company_id": current_user.company_id})
+async def build_detailed_payroll(company_id: str, month: str) -> dict:
+    """Detailed salary breakdown for all employees of a company in a month"""
+    # Get settings
+    db_settings = await db.settings.find_one({"company_id": company_id})
     working_hours_per_day = 8
     start_time = "09:00"
     finish_time = "17:00"
@@ -4057,223 +5441,31 @@ async def get_detailed_payroll(month: str, current_user: User = Depends(get_curr
     year_int = int(year)
     month_int = int(month_num)
     
-    # Get holidays and Saturday settings
-    holidays = db_settings.get("holidays", []) if db_settings else []
-    saturday_enabled = db_settings.get("saturday_enabled", True) if db_settings else True
-    saturday_type = db_settings.get("saturday_type", "full") if db_settings else "full"
-    
     # Calculate working days for this month
-    working_days_result = calculate_working_days(year_int, month_int, holidays, saturday_enabled, saturday_type)
+    working_days_result = company_working_days(company_id, year_int, month_int, db_settings)
     working_days = working_days_result["working_days"]
     
-    print(f"DEBUG DETAILED PAYROLL: Month={month}, Calculated Working Days={working_days}")
-    
     # Get all employees (include admin to match live payroll endpoint)
     employees = await db.users.find({
-        "company_id": current_user.company_id,
+        "company_id": company_id,
         "role": {"$in": ["admin", "employee", "staff_member", "manager", "accountant"]}
     }).to_list(length=None)
     
-    print(f"DEBUG DETAILED PAYROLL: Found {len(employees)} employees for company {current_user.company_id}")
-    
-    detailed_records = []
+    # Check if this is the current month
+    current_month = datetime.now(timezone.utc).strftime("%Y-%m")
     
-    for employee in employees:
-        # Get effective salary (considers increments)
-        basic_salary = await get_effective_salary(employee["id"], current_user.company_id, month)
-        
-        # Get attendance for this month
-        attendance_records = await db.attendance.find({
-            "employee_id": employee["id"],
-            "company_id": current_user.company_id,
-            "date": {"$regex": f"^{month}"}
-        }).to_list(length=None)
-        
-        # Calculate attendance metrics
-        present_days = len([a for a in attendance_records if a.get("status") == "present"])
-        leave_days = len([a for a in attendance_records if a.get("status") == "leave"])
-        half_days = len([a for a in attendance_records if a.get("status") == "half_day"])
-        allowed_leaves = len([a for a in attendance_records if a.get("status") == "allowed_leave"])
-        allowed_half_days = len([a for a in attendance_records if a.get("status") == "allowed_half_day"])
-        
-        # Calculate total attendance minutes
-        total_attendance_minutes = 0
-        now = datetime.now()
-        today_str = now.strftime("%Y-%m-%d")
-        
-        # For present days with check-in/out
-        for record in attendance_records:
-            record_date = record.get("date", "")
-            
-            # For completed days (check-in and check-out both present)
-            if record.get("check_in") and record.get("check_out"):
-                try:
-                    checkin_dt = datetime.fromisoformat(record["check_in"])
-                    checkout_dt = datetime.fromisoformat(record["check_out"])
-                    # Work with naive datetimes - all in local time
-                    duration = checkout_dt - checkin_dt
-                    total_attendance_minutes += int(duration.total_seconds() / 60)
-                except:
-                    pass
-            # For today's ongoing attendance (checked in but not out yet) - only if viewing current month
-            elif record_date == today_str and record.get("check_in") and not record.get("check_out") and month == now.strftime("%Y-%m"):
-                try:
-                    checkin_dt = datetime.fromisoformat(record["check_in"])
-                    # Use naive datetime - compare local to local
-                    duration = now - checkin_dt
-                    total_attendance_minutes += int(duration.total_seconds() / 60)
-                except:
-                    pass
-        
-        # For allowed leaves, add full day minutes (counts as worked)
-        minutes_per_day = working_hours_per_day * 60
-        total_attendance_minutes += (allowed_leaves * minutes_per_day)
-        total_attendance_minutes += (allowed_half_days * minutes_per_day * 0.5)
-        
-        # Calculate late minutes and deduction
-        late_minutes = 0
-        late_deduction = 0
-        
-        if not employee.get("fixed_salary", False):  # Only if NOT fixed salary
-            # Calculate expected check-in time
-            expected_checkin = datetime.strptime(start_time, "%H:%M").time()
-            
-            for record in attendance_records:
-                if record.get("check_in") and record.get("status") == "present":
-                    try:
-                        checkin_dt = datetime.fromisoformat(record["check_in"])
-                        checkin_time = checkin_dt.time()
-                        
-                        # Compare times
-                        expected_minutes = expected_checkin.hour * 60 + expected_checkin.minute
-                        actual_minutes = checkin_time.hour * 60 + checkin_time.minute
-                        
-                        if actual_minutes > expected_minutes:
-                            late_minutes += (actual_minutes - expected_minutes)
-                    except:
-                        pass
-            
-            # Calculate late deduction
-            if late_minutes > 0 and working_days > 0:
-                salary_per_day = basic_salary / working_days
-                salary_per_hour = salary_per_day / working_hours_per_day
-                salary_per_minute = salary_per_hour / 60
-                late_deduction = late_minutes * salary_per_minute
-        
-        # Get advances for this month
-        advances = await db.advances.find({
-            "employee_id": employee["id"],
-            "company_id": current_user.company_id,
-            "status": "approved",
-            "request_date": {"$regex": f"^{month}"}
-        }).to_list(length=None)
-        
-        total_advances = sum([adv.get("amount", 0) for adv in advances])
-        
-        # Get other deductions
-        other_deductions = employee.get("deductions", 0)
-        
-        # Get allowances
-        allowances = employee.get("allowances", 0)
-        
-        # Get extra payments for this month
-        extra_payments = await db.extra_payments.find({
-            "employee_id": employee["id"],
-            "company_id": current_user.company_id,
-            "month": month
-        }).to_list(length=None)
-        
-        total_extra_payment = sum([ep.get("amount", 0) for ep in extra_payments])
-        
-        # Get active loans for this employee
-        active_loans = await db.loans.find({
-            "employee_id": employee["id"],
-            "company_id": current_user.company_id,
-            "status": "active"
-        }).to_list(length=None)
-        
-        # Calculate loan deduction for this month
-        loan_deduction = 0
-        for loan in active_loans:
-            # Calculate how many months have passed since loan start
-            loan_start_month = loan.get("start_month", month)
-            if loan_start_month <= month:
-                loan_deduction += loan.get("monthly_deduction", 0)
-        
-        # Calculate earnings and gross based on salary type
-        salary_per_minute = (basic_salary / working_days / working_hours_per_day / 60) if working_days > 0 else 0
-        
-        # Check if this is the current month
-        current_month = datetime.now(timezone.utc).strftime("%Y-%m")
-        is_current_month = (month == current_month)
-        
-        if employee.get("fixed_salary", False):
-            if is_current_month:
-                # For current month: pro-rate based on time passed
-                import calendar
-                now = datetime.now()
-                days_in_month = calendar.monthrange(int(year), int(month_num))[1]
-                current_day = now.day
-                hours_in_month = days_in_month * 24
-                hours_passed = (current_day - 1) * 24 + now.hour + now.minute / 60 + now.second / 3600
-                
-                # Pro-rata calculation based on time passed
-                earnings_basic = (basic_salary / hours_in_month) * hours_passed
-                earnings_allowances_prorated = (allowances / hours_in_month) * hours_passed
-                earnings = earnings_basic
-                # Gross = Basic earnings + Extra payments (WITHOUT allowances)
-                gross_salary = earnings + total_extra_payment
-                allowances_to_add = earnings_allowances_prorated
-            else:
-                # For past completed months: full salary regardless of attendance
-                earnings = basic_salary
-                # Gross = Basic + Extra payments (WITHOUT allowances)
-                gross_salary = earnings + total_extra_payment
-                allowances_to_add = allowances
-        else:
-            # Non-fixed salary: based on actual attendance minutes
-            earnings = total_attendance_minutes * salary_per_minute
-            # Gross = Earnings + Extra payments (WITHOUT allowances)
-            gross_salary = earnings + total_extra_payment
-            allowances_to_add = allowances
-        
-        # Calculate net salary
-        # Net = Gross + Allowances - Deductions (WITH allowances)
-        total_deductions = late_deduction + total_advances + other_deductions + loan_deduction
-        net_salary = gross_salary + allowances_to_add - total_deductions
-        
-        print(f"DEBUG DETAILED PAYROLL EMPLOYEE: {employee['name']} - gross={gross_salary:.2f}, earnings={earnings:.2f}, minutes={total_attendance_minutes}")
-        
-        detailed_records.append({
-            "employee_id": employee["id"],
-            "employee_name": employee["name"],
-            "position": employee.get("position", "Staff"),
-            "profile_picture": employee.get("profile_pic"),
-            "basic_salary": round(basic_salary, 2),
-            "allowances": round(allowances_to_add, 2),
-            "earnings": round(earnings, 2),
-            "working_days": working_days,
-            "present_days": present_days,
-            "leave_days": leave_days,
-            "half_days": half_days,
-            "allowed_leaves": allowed_leaves,
-            "allowed_half_days": allowed_half_days,
-            "total_attendance_minutes": total_attendance_minutes,
-            "late_minutes": late_minutes,
-            "late_deduction": round(late_deduction, 2),
-            "advances": round(total_advances, 2),
-            "other_deductions": round(other_deductions, 2),
-            "loan_deduction": round(loan_deduction, 2),
-            "extra_payment": round(total_extra_payment, 2),
-            "gross_salary": round(gross_salary, 2),
-            "total_deductions": round(total_deductions, 2),
-            "net_salary": round(net_salary, 2),
-            "fixed_salary": employee.get("fixed_salary", False),
-            "salary_per_minute": round(salary_per_minute, 2)
-        })
+    detailed_records, _ = await compute_company_payroll(
+        company_id,
+        month,
+        employees,
+        datetime.now(),
+        working_days,
+        working_hours_per_day,
+        start_time,
+        is_current_month=(month == current_month)
+    )
     
     total_gross_calc = sum([r["gross_salary"] for r in detailed_records])
-    print(f"DEBUG DETAILED PAYROLL: Calculated total_gross={total_gross_calc} from {len(detailed_records)} records")
     
     return {
         "month": month,
@@ -4285,15 +5477,30 @@ async def get_detailed_payroll(month: str, current_user: User = Depends(get_curr
         "total_allowances": sum([r["allowances"] for r in detailed_records])
     }
 
+@api_router.get("/payroll/detailed/{month}")
+async def get_detailed_payroll(month: str, current_user: User = Depends(get_current_user)):
+    """Get detailed salary breakdown for all employees in a month"""
+    return await build_detailed_payroll(current_user.company_id, month)
+
 
-@api_router.get("/payroll/live-current-month")
-async def get_live_current_month_payroll(current_user: User = Depends(get_current_user)):
-    """Get real-time payroll calculation for current month up to this second"""
-    now = datetime.now()
+async def load_live_payroll_employees(company_id: str, employee_id: Optional[str] = None) -> List[dict]:
+    """Employees shown in live payroll - one employee's own record, or the whole company"""
+    if employee_id:
+        return await db.users.find({
+            "id": employee_id,
+            "company_id": company_id
+        }).to_list(length=None)
+    return await db.users.find({
+        "company_id": company_id,
+        "role": {"$in": ["admin", "employee", "staff_member", "manager", "accountant"]}
+    }).to_list(length=None)
+
+async def build_live_payroll(company_id: str, employees: List[dict], now: datetime) -> dict:
+    """Current month payroll for the given employees up to `now`"""
     current_month = now.strftime("%Y-%m")
     
     # Get company settings
-    settings = await db.settings.find_one({"company_id": current_user.company_id})
+    settings = await db.settings.find_one({"company_id": company_id})
     working_hours_per_day = 8
     start_time = "09:00"
     finish_time = "17:00"
@@ -4313,244 +5520,205 @@ async def get_live_current_month_payroll(current_user: User = Depends(get_curren
     year_int = int(year)
     month_int = int(month_num)
     
-    # Get holidays and Saturday settings
-    holidays = settings.get("holidays", []) if settings else []
-    saturday_enabled = settings.get("saturday_enabled", True) if settings else True
-    saturday_type = settings.get("saturday_type", "full") if settings else "full"
-    
     # Calculate working days for this month
-    working_days_result = calculate_working_days(year_int, month_int, holidays, saturday_enabled, saturday_type)
+    working_days_result = company_working_days(company_id, year_int, month_int, settings)
     working_days = working_days_result["working_days"]
     
-    print(f"DEBUG WORKING DAYS: Month={current_month}, Calculated Working Days={working_days}")
+    detailed_records, today_total_earnings = await compute_company_payroll(
+        company_id,
+        current_month,
+        employees,
+        now,
+        working_days,
+        working_hours_per_day,
+        start_time,
+        is_current_month=True
+    )
     
+    return {
+        "month": current_month,
+        "timestamp": now.isoformat(),
+        "employees": detailed_records,
+        **summarize_live_payroll(detailed_records),
+        "today_total_earnings": round(today_total_earnings, 2)
+    }
+
+def summarize_live_payroll(records: List[dict]) -> dict:
+    return {
+        "total_gross": round(sum([r["gross_salary"] for r in records]), 2),
+        "total_net": round(sum([r["net_salary"] for r in records]), 2),
+        "total_deductions": round(sum([r["total_deductions"] for r in records]), 2),
+        "total_allowances": round(sum([r["allowances"] for r in records]), 2)
+    }
+
+@api_router.get("/payroll/live-current-month")
+async def get_live_current_month_payroll(current_user: User = Depends(get_current_user)):
+    """Get real-time payroll calculation for current month up to this second"""
     # Get all employees (only if employee role, show own data; if admin/manager, show all)
-    if current_user.role == "employee":
-        employees = await db.users.find({
-            "id": current_user.id,
-            "company_id": current_user.company_id
-        }).to_list(length=None)
-    else:
-        employees = await db.users.find({
-            "company_id": current_user.company_id,
-            "role": {"$in": ["admin", "employee", "staff_member", "manager", "accountant"]}
-        }).to_list(length=None)
-    
-    print(f"DEBUG LIVE PAYROLL: Found {len(employees)} employees for company {current_user.company_id}")
+    employees = await load_live_payroll_employees(
+        current_user.company_id,
+        current_user.id if current_user.role == "employee" else None
+    )
     
-    detailed_records = []
-    today_total_earnings = 0  # Track today's earnings across all employees
+    return await build_live_payroll(current_user.company_id, employees, datetime.now())
+
+
+# ============= LIVE PAYROLL STREAM =============
+# One channel per (company, scope) computes payroll once and pushes it to every subscriber, so
+# Mongo load does not grow with the number of open payroll/dashboard screens. Between pushes
+# clients advance the figures themselves using earnings_per_second / allowances_per_second.
+# A channel recomputes when attendance changes (notify_live_payroll) and every resync interval.
+LIVE_PAYROLL_RESYNC_SECONDS = 60
+LIVE_PAYROLL_DEBOUNCE_SECONDS = 1
+LIVE_PAYROLL_HEARTBEAT_SECONDS = 15
+LIVE_PAYROLL_TICKET_SECONDS = 30  # how long a stream ticket can wait before the EventSource opens
+LIVE_PAYROLL_QUEUE_SIZE = 10
+
+live_payroll_channels = {}
+
+def notify_live_payroll(company_id: str):
+    """Attendance changed for a company - recompute its live payroll channels"""
+    for channel in list(live_payroll_channels.values()):
+        if channel["company_id"] == company_id:
+            channel["dirty"].set()
+
+def live_payroll_message(message_type: str, payload: dict) -> dict:
+    # sent_at lets the client work out how old the snapshot is without trusting its own clock
+    return {"type": message_type, **payload, "sent_at": datetime.now().isoformat()}
+
+def push_live_payroll(channel: dict, queue: asyncio.Queue, message: dict):
+    try:
+        queue.put_nowait(message)
+    except asyncio.QueueFull:
+        # Slow client - throw away the backlog and resend the full snapshot
+        while not queue.empty():
+            queue.get_nowait()
+        queue.put_nowait(live_payroll_message("snapshot", channel["snapshot"]))
+
+def publish_live_payroll(channel: dict, snapshot: dict):
+    """Store a new snapshot and push the difference to subscribers"""
+    previous = channel["snapshot"]
+    channel["snapshot"] = snapshot
+    
+    if previous is None or previous["month"] != snapshot["month"]:
+        message = live_payroll_message("snapshot", snapshot)
+    else:
+        previous_records = {r["employee_id"]: r for r in previous["employees"]}
+        current_ids = {r["employee_id"] for r in snapshot["employees"]}
+        message = live_payroll_message("delta", {
+            **{k: v for k, v in snapshot.items() if k != "employees"},
+            "employees": [r for r in snapshot["employees"] if previous_records.get(r["employee_id"]) != r],
+            "removed": [emp_id for emp_id in previous_records if emp_id not in current_ids]
+        })
     
-    for employee in employees:
-        # Get effective salary
-        basic_salary = await get_effective_salary(employee["id"], current_user.company_id, current_month)
-        
-        # Get attendance for current month
-        attendance_records = await db.attendance.find({
-            "employee_id": employee["id"],
-            "company_id": current_user.company_id,
-            "date": {"$regex": f"^{current_month}"}
-        }).to_list(length=None)
-        
-        # Calculate attendance metrics
-        present_days = len([a for a in attendance_records if a.get("status") == "present"])
-        leave_days = len([a for a in attendance_records if a.get("status") == "leave"])
-        half_days = len([a for a in attendance_records if a.get("status") == "half_day"])
-        allowed_leaves = len([a for a in attendance_records if a.get("status") == "allowed_leave"])
-        allowed_half_days = len([a for a in attendance_records if a.get("status") == "allowed_half_day"])
-        
-        # Calculate total attendance minutes UP TO NOW
-        total_attendance_minutes = 0
-        today_minutes = 0  # Track today's minutes for this employee
-        today_str = now.strftime("%Y-%m-%d")
-        
-        for record in attendance_records:
-            record_date = record.get("date", "")
-            
-            # For completed days (check-in and check-out both present)
-            if record.get("check_in") and record.get("check_out"):
-                try:
-                    checkin_dt = datetime.fromisoformat(record["check_in"])
-                    checkout_dt = datetime.fromisoformat(record["check_out"])
-                    # Work with naive datetimes - all in local time
-                    duration = checkout_dt - checkin_dt
-                    minutes_worked = int(duration.total_seconds() / 60)
-                    total_attendance_minutes += minutes_worked
-                    # If this is today's completed record, track it
-                    if record_date == today_str:
-                        today_minutes += minutes_worked
-                except Exception as e:
-                    pass
-            # For today's ongoing attendance (checked in but not out yet)
-            elif record_date == today_str and record.get("check_in") and not record.get("check_out"):
-                try:
-                    from datetime import timedelta
-                    checkin_dt = datetime.fromisoformat(record["check_in"])
-                    
-                    # For total_attendance_minutes: Use NO timezone adjustment (match detailed payroll)
-                    duration_no_tz = now - checkin_dt
-                    minutes_no_tz = int(duration_no_tz.total_seconds() / 60)
-                    total_attendance_minutes += minutes_no_tz
-                    
-                    # For today_minutes (used in Today Salary): Use timezone adjustment
-                    # Server is in UTC, check-ins are in Sri Lanka time (UTC+5:30)
-                    now_srilanka = now + timedelta(hours=5, minutes=30)
-                    duration_with_tz = now_srilanka - checkin_dt
-                    minutes_with_tz = int(duration_with_tz.total_seconds() / 60)
-                    today_minutes += minutes_with_tz  # Use adjusted time for today's earnings
-                except Exception as e:
-                    pass
-        
-        # Add allowed leaves (count as worked time)
-        minutes_per_day = working_hours_per_day * 60
-        total_attendance_minutes += (allowed_leaves * minutes_per_day)
-        total_attendance_minutes += (allowed_half_days * minutes_per_day * 0.5)
-        
-        # Calculate late minutes and deduction
-        late_minutes = 0
-        late_deduction = 0
-        
-        if not employee.get("fixed_salary", False):
-            expected_checkin = datetime.strptime(start_time, "%H:%M").time()
-            
-            for record in attendance_records:
-                if record.get("check_in") and record.get("status") == "present":
-                    try:
-                        checkin_dt = datetime.fromisoformat(record["check_in"])
-                        checkin_time = checkin_dt.time()
-                        
-                        expected_minutes = expected_checkin.hour * 60 + expected_checkin.minute
-                        actual_minutes = checkin_time.hour * 60 + checkin_time.minute
-                        
-                        if actual_minutes > expected_minutes:
-                            late_minutes += (actual_minutes - expected_minutes)
-                    except:
-                        pass
-            
-            if late_minutes > 0 and working_days > 0:
-                salary_per_day = basic_salary / working_days
-                salary_per_hour = salary_per_day / working_hours_per_day
-                salary_per_minute = salary_per_hour / 60
-                late_deduction = late_minutes * salary_per_minute
-        
-        # Get advances for current month
-        advances = await db.advances.find({
-            "employee_id": employee["id"],
-            "company_id": current_user.company_id,
-            "status": "approved",
-            "request_date": {"$regex": f"^{current_month}"}
-        }).to_list(length=None)
-        
-        total_advances = sum([adv.get("amount", 0) for adv in advances])
-        
-        # Get other deductions
-        other_deductions = employee.get("deductions", 0)
-        
-        # Get allowances
-        allowances = employee.get("allowances", 0)
-        
-        # Get extra payments
-        extra_payments = await db.extra_payments.find({
-            "employee_id": employee["id"],
-            "company_id": current_user.company_id,
-            "month": current_month
-        }).to_list(length=None)
-        
-        total_extra_payment = sum([ep.get("amount", 0) for ep in extra_payments])
-        
-        # Get active loans
-        active_loans = await db.loans.find({
-            "employee_id": employee["id"],
-            "company_id": current_user.company_id,
-            "status": "active"
-        }).to_list(length=None)
-        
-        loan_deduction = 0
-        for loan in active_loans:
-            loan_start_month = loan.get("start_month", current_month)
-            if loan_start_month <= current_month:
-                loan_deduction += loan.get("monthly_deduction", 0)
-        
-        # Calculate earnings based on salary type
-        salary_per_minute = (basic_salary / working_days / working_hours_per_day / 60) if working_days > 0 else 0
-        
-        if employee.get("fixed_salary", False):
-            # Fixed salary for CURRENT MONTH: pro-rate based on time passed
-            import calendar
-            days_in_month = calendar.monthrange(int(year), int(month_num))[1]
-            current_day = now.day
-            hours_in_month = days_in_month * 24
-            hours_passed = (current_day - 1) * 24 + now.hour + now.minute / 60 + now.second / 3600
+    for queue in list(channel["subscribers"]):
+        push_live_payroll(channel, queue, message)
+
+async def run_live_payroll_channel(channel: dict):
+    try:
+        while channel["subscribers"]:
+            channel["dirty"].clear()
+            try:
+                employees = await load_live_payroll_employees(channel["company_id"], channel["employee_id"])
+                snapshot = await build_live_payroll(channel["company_id"], employees, datetime.now())
+                publish_live_payroll(channel, snapshot)
+            except Exception as e:
+                logging.error(f"Live payroll refresh failed for {channel['company_id']}: {str(e)}")
             
-            # Pro-rata calculation based on time passed
-            earnings_basic = (basic_salary / hours_in_month) * hours_passed
-            earnings_allowances_prorated = (allowances / hours_in_month) * hours_passed
-            earnings = earnings_basic
-            # Gross = Basic earnings + Extra payments (WITHOUT allowances)
-            gross_salary = earnings + total_extra_payment
-            # For fixed salary, use prorated allowances
-            allowances_to_add = earnings_allowances_prorated
-        else:
-            # Non-fixed: based on actual minutes worked so far
-            earnings = total_attendance_minutes * salary_per_minute
-            # Gross = Earnings + Extra payments (WITHOUT allowances)
-            gross_salary = earnings + total_extra_payment
-            # For non-fixed, use full allowances
-            allowances_to_add = allowances
-        
-        # Calculate net salary
-        # Net = Gross + Allowances - Deductions (WITH allowances)
-        total_deductions = late_deduction + total_advances + other_deductions + loan_deduction
-        net_salary = gross_salary + allowances_to_add - total_deductions
-        
-        print(f"DEBUG LIVE PAYROLL EMPLOYEE: {employee['name']} - gross={gross_salary:.2f}, earnings={earnings:.2f}, minutes={total_attendance_minutes}")
-        
-        # Calculate today's earnings for this employee (only for non-fixed)
-        today_earnings = today_minutes * salary_per_minute if not employee.get("fixed_salary", False) else 0
-        today_total_earnings += today_earnings
-        
-        detailed_records.append({
-            "employee_id": employee["id"],
-            "employee_name": employee["name"],
-            "position": employee.get("position", "Staff"),
-            "profile_picture": employee.get("profile_pic"),
-            "basic_salary": round(basic_salary, 2),
-            "allowances": round(allowances_to_add, 2),
-            "earnings": round(earnings, 2),
-            "working_days": working_days,
-            "present_days": present_days,
-            "leave_days": leave_days,
-            "half_days": half_days,
-            "allowed_leaves": allowed_leaves,
-            "allowed_half_days": allowed_half_days,
-            "total_attendance_minutes": total_attendance_minutes,
-            "late_minutes": late_minutes,
-            "late_deduction": round(late_deduction, 2),
-            "advances": round(total_advances, 2),
-            "other_deductions": round(other_deductions, 2),
-            "loan_deduction": round(loan_deduction, 2),
-            "extra_payment": round(total_extra_payment, 2),
-            "gross_salary": round(gross_salary, 2),
-            "total_deductions": round(total_deductions, 2),
-            "net_salary": round(net_salary, 2),
-            "fixed_salary": employee.get("fixed_salary", False),
-            "salary_per_minute": round(salary_per_minute, 2)
-        })
+            try:
+                await asyncio.wait_for(channel["dirty"].wait(), timeout=LIVE_PAYROLL_RESYNC_SECONDS)
+                # Coalesce a burst of punches into one recompute
+                await asyncio.sleep(LIVE_PAYROLL_DEBOUNCE_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+    finally:
+        live_payroll_channels.pop(channel["key"], None)
+
+def subscribe_live_payroll(company_id: str, employee_id: Optional[str] = None) -> tuple:
+    """Join (or start) a live payroll channel; returns (channel, queue)"""
+    key = (company_id, employee_id)
+    channel = live_payroll_channels.get(key)
+    if channel is None:
+        channel = {
+            "key": key,
+            "company_id": company_id,
+            "employee_id": employee_id,
+            "subscribers": set(),
+            "snapshot": None,
+            "dirty": asyncio.Event()
+        }
+        live_payroll_channels[key] = channel
+    
+    queue = asyncio.Queue(maxsize=LIVE_PAYROLL_QUEUE_SIZE)
+    channel["subscribers"].add(queue)
+    if channel["snapshot"] is not None:
+        queue.put_nowait(live_payroll_message("snapshot", channel["snapshot"]))
+    if "task" not in channel:
+        channel["task"] = asyncio.create_task(run_live_payroll_channel(channel))
+    return channel, queue
+
+def unsubscribe_live_payroll(channel: dict, queue: asyncio.Queue):
+    channel["subscribers"].discard(queue)
+    if not channel["subscribers"]:
+        # Wake the channel loop so it notices nobody is listening and stops
+        channel["dirty"].set()
+
+@api_router.post("/payroll/live/ticket")
+async def create_live_payroll_ticket(current_user: User = Depends(get_current_user)):
+    """
+    Single-use ticket for opening /payroll/live/stream
+    EventSource cannot send headers, and a JWT in the query string would end up in access logs,
+    so the client trades its token for a ticket that expires after LIVE_PAYROLL_TICKET_SECONDS
+    """
+    import secrets
+    ticket = secrets.token_urlsafe(32)
+    await db.stream_tickets.insert_one({
+        "ticket": ticket,
+        "user_id": current_user.id,
+        "company_id": current_user.company_id,
+        "role": current_user.role,
+        "expires_at": datetime.now(timezone.utc) + timedelta(seconds=LIVE_PAYROLL_TICKET_SECONDS)
+    })
+    return {"ticket": ticket, "expires_in": LIVE_PAYROLL_TICKET_SECONDS}
+
+@api_router.get("/payroll/live/stream")
+async def stream_live_payroll(request: Request, ticket: str):
+    """
+    Server-Sent Events stream of current month payroll
+    Opened with a ticket from POST /payroll/live/ticket, passed as ?ticket=
+    Events: "snapshot" (full payload, same shape as /payroll/live-current-month) and
+    "delta" (totals plus only the changed employee records and removed employee ids)
+    """
+    import json
+    # Deleting the ticket on use makes it single-use; the TTL index drops unused ones
+    grant = await db.stream_tickets.find_one_and_delete({
+        "ticket": ticket,
+        "expires_at": {"$gt": datetime.now(timezone.utc)}
+    })
+    if not grant:
+        raise HTTPException(status_code=401, detail="Invalid or expired stream ticket")
     
-    total_gross_calc = round(sum([r["gross_salary"] for r in detailed_records]), 2)
-    today_total_earnings_rounded = round(today_total_earnings, 2)
-    print(f"DEBUG LIVE PAYROLL: Calculated total_gross={total_gross_calc}, today_total_earnings={today_total_earnings_rounded} from {len(detailed_records)} records")
+    channel, queue = subscribe_live_payroll(
+        grant["company_id"],
+        grant["user_id"] if grant["role"] == "employee" else None
+    )
     
-    return {
-        "month": current_month,
-        "timestamp": now.isoformat(),
-        "employees": detailed_records,
-        "total_gross": total_gross_calc,
-        "total_net": round(sum([r["net_salary"] for r in detailed_records]), 2),
-        "total_deductions": round(sum([r["total_deductions"] for r in detailed_records]), 2),
-        "total_allowances": round(sum([r["allowances"] for r in detailed_records]), 2),
-        "today_total_earnings": today_total_earnings_rounded
-    }
+    async def event_stream():
+        try:
+            while not await request.is_disconnected():
+                try:
+                    message = await asyncio.wait_for(queue.get(), timeout=LIVE_PAYROLL_HEARTBEAT_SECONDS)
+                    yield f"event: {message['type']}\ndata: {json.dumps(message, default=str)}\n\n"
+                except asyncio.TimeoutError:
+                    yield ": ping\n\n"
+        finally:
+            unsubscribe_live_payroll(channel, queue)
+    
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
 
 
 # ============= UTILITY FUNCTIONS =============
@@ -4565,61 +5733,116 @@ def calculate_working_days(year: int, month: int, holidays: List[dict], saturday
     - Public holidays from holiday calendar
     - Saturday settings (full day, half day, or off)
     """
-    import calendar
-    from datetime import date
+    result = calculate_working_days_range(year, month, year, month, holidays, saturday_enabled, saturday_type)[0]
+    result.pop("month")
+    return result
+
+def calculate_working_days_range(start_year: int, start_month: int, end_year: int, end_month: int, holidays: List[dict],
+                                 saturday_enabled: bool = True, saturday_type: str = "full") -> List[dict]:
+    """
+    Working days for every month from start to end (inclusive), computed for all days at once
+    with numpy instead of looping day by day
+
+    Returns:
+        One calculate_working_days() dict per month, plus "month" (YYYY-MM)
+    """
+    import numpy as np
     
-    # Get total days in month
-    total_days = calendar.monthrange(year, month)[1]
+    first_month = np.datetime64(f"{start_year:04d}-{start_month:02d}", "M")
+    last_month = np.datetime64(f"{end_year:04d}-{end_month:02d}", "M")
+    if last_month < first_month:
+        return []
     
-    # Count working days
-    working_days = 0
-    half_days = 0
+    days = np.arange(first_month.astype("datetime64[D]"), (last_month + 1).astype("datetime64[D]"))
+    month_index = (days.astype("datetime64[M]") - first_month).astype(np.int64)
+    month_count = int(month_index[-1]) + 1
+    weekday = (days.astype(np.int64) + 3) % 7  # 1970-01-01 was a Thursday; 0=Monday, 6=Sunday
     
-    # Convert holidays to date strings for comparison
-    holiday_dates = set()
+    # Parse holidays once for the whole range
+    holiday_days = []
     for holiday in holidays:
         try:
-            holiday_date = datetime.fromisoformat(holiday['date']).date()
-            if holiday_date.year == year and holiday_date.month == month:
-                holiday_dates.add(holiday['date'])
-        except:
-            continue
-    
-    for day in range(1, total_days + 1):
-        current_date = date(year, month, day)
-        date_str = current_date.isoformat()
-        weekday = current_date.weekday()  # 0=Monday, 6=Sunday
-        
-        # Skip Sundays
-        if weekday == 6:
-            continue
-        
-        # Skip holidays
-        if date_str in holiday_dates:
-            continue
-        
-        # Handle Saturday
-        if weekday == 5:  # Saturday
-            if not saturday_enabled:
-                continue
-            elif saturday_type == "half":
-                half_days += 1
-            else:  # full day
-                working_days += 1
-        else:
-            working_days += 1
+            holiday_days.append(np.datetime64(datetime.fromisoformat(holiday['date']).date(), "D"))
+        except:
+            continue
+    is_holiday = np.isin(days, np.array(holiday_days, dtype="datetime64[D]"))
     
-    # Convert half days to working days (2 half days = 1 full day)
-    total_working_days = working_days + (half_days * 0.5)
+    is_sunday = weekday == 6
+    is_saturday = weekday == 5
+    open_day = ~is_sunday & ~is_holiday
     
-    return {
-        "total_days": total_days,
-        "working_days": round(total_working_days, 1),
-        "full_days": working_days,
-        "half_days": half_days,
-        "holidays": len(holiday_dates),
-        "sundays": sum(1 for day in range(1, total_days + 1) if date(year, month, day).weekday() == 6)
-    }
+    full_day = open_day & ~is_saturday
+    half_day = np.zeros(len(days), dtype=bool)
+    if saturday_enabled:
+        if saturday_type == "half":
+            half_day = open_day & is_saturday
+        else:
+            full_day = full_day | (open_day & is_saturday)
+    
+    def per_month(mask):
+        return np.bincount(month_index, weights=mask.astype(np.int64), minlength=month_count).astype(np.int64)
+    
+    total_days = np.bincount(month_index, minlength=month_count)
+    full_days = per_month(full_day)
+    half_days = per_month(half_day)
+    holiday_counts = per_month(is_holiday)
+    sundays = per_month(is_sunday)
+    
+    results = []
+    for i in range(month_count):
+        # Convert half days to working days (2 half days = 1 full day)
+        results.append({
+            "month": str(first_month + i),
+            "total_days": int(total_days[i]),
+            "working_days": round(int(full_days[i]) + int(half_days[i]) * 0.5, 1),
+            "full_days": int(full_days[i]),
+            "half_days": int(half_days[i]),
+            "holidays": int(holiday_counts[i]),
+            "sundays": int(sundays[i])
+        })
+    return results
+
+# ============= WORKING DAY CALENDAR =============
+# Working days only change when a company's Saturday rules or holidays change, so results are
+# memoized per (company, year, month, settings_version). update_settings, add_holiday and
+# delete_holiday bump settings_version, which makes older entries unreachable on every worker.
+working_days_cache = LRUCache(maxsize=10000)
+
+def settings_calendar(settings: Optional[dict]) -> tuple:
+    """(holidays, saturday_enabled, saturday_type, settings_version) from a settings document"""
+    if not settings:
+        return [], True, "full", 0
+    return (
+        settings.get("holidays", []),
+        settings.get("saturday_enabled", True),
+        settings.get("saturday_type", "full"),
+        settings.get("settings_version", 0)
+    )
+
+def company_working_days(company_id: str, year: int, month: int, settings: Optional[dict]) -> dict:
+    """Memoized calculate_working_days for a company, using its already-loaded settings document"""
+    holidays, saturday_enabled, saturday_type, version = settings_calendar(settings)
+    key = (company_id, year, month, version)
+    if key not in working_days_cache:
+        working_days_cache[key] = calculate_working_days(year, month, holidays, saturday_enabled, saturday_type)
+    return dict(working_days_cache[key])
+
+def company_working_days_range(company_id: str, start: str, end: str, settings: Optional[dict]) -> List[dict]:
+    """Working days for each month from start to end (YYYY-MM, inclusive); fills the memo for every month"""
+    holidays, saturday_enabled, saturday_type, version = settings_calendar(settings)
+    start_year, start_month = [int(part) for part in start.split("-")]
+    end_year, end_month = [int(part) for part in end.split("-")]
+    
+    results = calculate_working_days_range(start_year, start_month, end_year, end_month, holidays, saturday_enabled, saturday_type)
+    for result in results:
+        year, month = [int(part) for part in result["month"].split("-")]
+        working_days_cache[(company_id, year, month, version)] = {k: v for k, v in result.items() if k != "month"}
+    return results
+
+def invalidate_working_days(company_id: str):
+    """Free this company's memoized months (settings_version already makes them unreachable)"""
+    for key in [key for key in list(working_days_cache.keys()) if key[0] == company_id]:
+        working_days_cache.pop(key, None)
 
 # ============= SETTINGS ENDPOINTS =============
 @api_router.get("/settings")
@@ -4650,9 +5873,11 @@ async def update_settings(updates: SettingsUpdate, current_user: User = Depends(
     
     result = await db.settings.update_one(
         {"company_id": current_user.company_id},
-        {"$set": update_data},
+        {"$set": update_data, "$inc": {"settings_version": 1}},
         upsert=True
     )
+    invalidate_working_days(current_user.company_id)
+    await invalidate_company_month_totals(current_user.company_id)
     
     # Log activity regardless of whether it was an insert or update
     await log_activity(current_user.company_id, current_user.id, current_user.name, "UPDATE_SETTINGS", f"Updated settings: {settings_changes}")
@@ -4666,12 +5891,14 @@ async def add_holiday(holiday: Holiday, current_user: User = Depends(get_current
     
     result = await db.settings.update_one(
         {"company_id": current_user.company_id},
-        {"$push": {"holidays": holiday.model_dump()}}
+        {"$push": {"holidays": holiday.model_dump()}, "$inc": {"settings_version": 1}}
     )
     
     if result.modified_count == 0:
         raise HTTPException(status_code=404, detail="Settings not found")
+    invalidate_working_days(current_user.company_id)
     
+    await invalidate_company_month_totals(current_user.company_id)
     await log_activity(current_user.company_id, current_user.id, current_user.name, "ADD_HOLIDAY", f"Added holiday: {holiday.name} on {holiday.date}, Type: {holiday.type}")
     
     return {"message": "Holiday added successfully"}
@@ -4681,41 +5908,314 @@ async def delete_holiday(date: str, current_user: User = Depends(get_current_use
     if current_user.role not in ["admin", "manager", "accountant"]:
         raise HTTPException(status_code=403, detail="Admin, manager or accountant access required")
     
+    settings = await db.settings.find_one({"company_id": current_user.company_id}, {"_id": 0, "holidays": 1})
+    holidays = settings.get("holidays", []) if settings else []
+    
     result = await db.settings.update_one(
-        {"company_id": current_user.company_id},
-        {"$pull": {"holidays": {"date": date}}}
+        {"company_id": current_user.company_id, "holidays.date": date},
+        {"$pull": {"holidays": {"date": date}}, "$inc": {"settings_version": 1}}
     )
     
     if result.modified_count == 0:
         raise HTTPException(status_code=404, detail="Holiday not found")
+    invalidate_working_days(current_user.company_id)
+    await invalidate_company_month_totals(current_user.company_id)
     
     holiday_name = next((h['name'] for h in holidays if h['date'] == date), 'Unknown')
     await log_activity(current_user.company_id, current_user.id, current_user.name, "DELETE_HOLIDAY", f"Removed holiday: {holiday_name} on {date}")
     
     return {"message": "Holiday removed successfully"}
 
+@api_router.post("/settings/geofences")
+async def add_geofence(geofence: Geofence, current_user: User = Depends(get_current_user)):
+    """Add a circle or polygon geofence; stored tracking points and check-ins are re-classified in the background"""
+    if current_user.role not in ["admin", "manager"]:
+        raise HTTPException(status_code=403, detail="Admin or manager access required")
+    validate_geofence(geofence)
+    
+    result = await db.settings.update_one(
+        {"company_id": current_user.company_id},
+        {"$push": {"geofences": geofence.model_dump()}}
+    )
+    
+    if result.modified_count == 0:
+        raise HTTPException(status_code=404, detail="Settings not found")
+    invalidate_geofence_index(current_user.company_id)
+    
+    await log_activity(current_user.company_id, current_user.id, current_user.name, "ADD_GEOFENCE", f"Added {geofence.type} geofence: {geofence.name}")
+    
+    return {"message": "Geofence added successfully", "geofence": geofence, "job_id": await start_geofence_evaluation(current_user)}
+
+@api_router.delete("/settings/geofences/{geofence_id}")
+async def delete_geofence(geofence_id: str, current_user: User = Depends(get_current_user)):
+    if current_user.role not in ["admin", "manager"]:
+        raise HTTPException(status_code=403, detail="Admin or manager access required")
+    
+    settings = await db.settings.find_one({"company_id": current_user.company_id}, {"_id": 0, "geofences": 1})
+    geofences = settings.get("geofences", []) if settings else []
+    
+    result = await db.settings.update_one(
+        {"company_id": current_user.company_id, "geofences.id": geofence_id},
+        {"$pull": {"geofences": {"id": geofence_id}}}
+    )
+    
+    if result.modified_count == 0:
+        raise HTTPException(status_code=404, detail="Geofence not found")
+    invalidate_geofence_index(current_user.company_id)
+    
+    geofence_name = next((g.get('name') for g in geofences if g.get('id') == geofence_id), 'Unknown')
+    await log_activity(current_user.company_id, current_user.id, current_user.name, "DELETE_GEOFENCE", f"Removed geofence: {geofence_name}")
+    
+    return {"message": "Geofence removed successfully", "job_id": await start_geofence_evaluation(current_user)}
+
+@api_router.post("/settings/geofences/evaluate")
+async def evaluate_geofences(current_user: User = Depends(get_current_user)):
+    """Re-classify all stored tracking points and check-ins against the current geofences (background job)"""
+    if current_user.role not in ["admin", "manager"]:
+        raise HTTPException(status_code=403, detail="Admin or manager access required")
+    return {"message": "Geofence evaluation started", "job_id": await start_geofence_evaluation(current_user)}
+
 @api_router.get("/settings/working-days/{year}/{month}")
 async def get_working_days(year: int, month: int, current_user: User = Depends(get_current_user)):
     if current_user.role == "super_admin":
         raise HTTPException(status_code=400, detail="Not applicable for super admin")
     
     # Get company settings
-    settings = await db.settings.find_one({"company_id": current_user.company_id}, {"_id": 0})
-    
-    if not settings:
-        # Use default settings
-        holidays = []
-        saturday_enabled = True
-        saturday_type = "full"
-    else:
-        holidays = settings.get("holidays", [])
-        saturday_enabled = settings.get("saturday_enabled", True)
-        saturday_type = settings.get("saturday_type", "full")
+    settings = await db.settings.find_one(
+        {"company_id": current_user.company_id},
+        {"_id": 0, "holidays": 1, "saturday_enabled": 1, "saturday_type": 1, "settings_version": 1}
+    )
     
     # Calculate working days
-    result = calculate_working_days(year, month, holidays, saturday_enabled, saturday_type)
+    return company_working_days(current_user.company_id, year, month, settings)
+
+@api_router.get("/settings/working-days")
+async def get_working_days_range(start: str, end: str, current_user: User = Depends(get_current_user)):
+    """Working days for every month from start to end (YYYY-MM, inclusive) - for yearly reports"""
+    if current_user.role == "super_admin":
+        raise HTTPException(status_code=400, detail="Not applicable for super admin")
     
-    return result
+    try:
+        start_year, start_month = [int(part) for part in start.split("-")]
+        end_year, end_month = [int(part) for part in end.split("-")]
+        if not (1 <= start_month <= 12 and 1 <= end_month <= 12):
+            raise ValueError
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid month format. Use YYYY-MM")
+    
+    if (end_year - start_year) * 12 + (end_month - start_month) > 120:
+        raise HTTPException(status_code=400, detail="Range too large (maximum 10 years)")
+    
+    settings = await db.settings.find_one(
+        {"company_id": current_user.company_id},
+        {"_id": 0, "holidays": 1, "saturday_enabled": 1, "saturday_type": 1, "settings_version": 1}
+    )
+    
+    return company_working_days_range(current_user.company_id, start, end, settings)
+
+# ============= BLOB STORE =============
+# Uploaded images are stored on disk once per SHA-256 (BLOB_STORAGE_DIR/ab/cd/<hash>) with a
+# db.blobs document for type and size. Documents keep only the /api/blobs/<hash> URL.
+BLOB_STORAGE_DIR = Path(os.environ.get('BLOB_STORAGE_DIR', ROOT_DIR / 'uploads' / 'blobs'))
+BLOB_URL_PREFIX = "/api/blobs/"
+BLOB_MAX_BYTES = 10 * 1024 * 1024
+
+def blob_path(blob_hash: str) -> Path:
+    return BLOB_STORAGE_DIR / blob_hash[:2] / blob_hash[2:4] / blob_hash
+
+def write_blob_file(path: Path, data: bytes):
+    if path.exists():
+        return
+    path.parent.mkdir(parents=True, exist_ok=True)
+    # Write then rename so a reader never sees a half written blob
+    temp_path = path.with_name(f"{path.name}.{uuid.uuid4().hex}.tmp")
+    temp_path.write_bytes(data)
+    os.replace(temp_path, path)
+
+def read_blob_range(path: Path, start: int, length: int) -> bytes:
+    with open(path, "rb") as f:
+        f.seek(start)
+        return f.read(length)
+
+async def store_blob(data: bytes, content_type: Optional[str]) -> str:
+    """Store bytes in the blob store (deduplicated by content) and return their URL"""
+    import hashlib
+    if len(data) > BLOB_MAX_BYTES:
+        raise HTTPException(status_code=413, detail=f"File too large. Maximum size is {BLOB_MAX_BYTES // (1024 * 1024)}MB")
+    
+    blob_hash = hashlib.sha256(data).hexdigest()
+    await asyncio.to_thread(write_blob_file, blob_path(blob_hash), data)
+    await db.blobs.update_one(
+        {"hash": blob_hash},
+        {"$setOnInsert": {
+            "hash": blob_hash,
+            "content_type": content_type or "application/octet-stream",
+            "size": len(data),
+            "created_at": datetime.now(timezone.utc).isoformat()
+        }},
+        upsert=True
+    )
+    return BLOB_URL_PREFIX + blob_hash
+
+async def store_data_url(value):
+    """Move an inline base64 data: URL into the blob store; any other value is returned unchanged"""
+    if not isinstance(value, str) or not value.startswith("data:") or "," not in value:
+        return value
+    header, payload = value[5:].split(",", 1)
+    if ";base64" not in header:
+        return value
+    try:
+        data = base64.b64decode(payload)
+    except Exception:
+        return value
+    return await store_blob(data, header.split(";")[0])
+
+@api_router.get("/blobs/{blob_hash}")
+async def get_blob(blob_hash: str, request: Request):
+    """Serve a stored blob - public (img tags can't send a token) but only reachable by content hash"""
+    import re
+    if not re.fullmatch(r"[0-9a-f]{64}", blob_hash):
+        raise HTTPException(status_code=404, detail="Not found")
+    
+    blob = await db.blobs.find_one({"hash": blob_hash}, {"_id": 0})
+    path = blob_path(blob_hash)
+    if not blob or not path.exists():
+        raise HTTPException(status_code=404, detail="Not found")
+    
+    # Only images are served with their own type so an upload can't become a page on our origin
+    content_type = blob["content_type"] if blob["content_type"].startswith("image/") else "application/octet-stream"
+    etag = f'"{blob_hash}"'
+    headers = {
+        "ETag": etag,
+        "Cache-Control": "public, max-age=31536000, immutable",
+        "Accept-Ranges": "bytes",
+        "X-Content-Type-Options": "nosniff"
+    }
+    if content_type == "image/svg+xml":
+        # An SVG opened directly is a document - no scripts, no loads, no same-origin access
+        headers["Content-Security-Policy"] = "default-src 'none'; style-src 'unsafe-inline'; sandbox"
+    
+    if_none_match = request.headers.get("if-none-match", "")
+    if if_none_match.strip() == "*" or etag in [tag.strip() for tag in if_none_match.split(",")]:
+        return Response(status_code=304, headers=headers)
+    
+    size = blob["size"]
+    range_header = request.headers.get("range")
+    if_range = request.headers.get("if-range")
+    if range_header and (not if_range or if_range.strip() == etag):
+        # Single byte ranges only; anything else gets the whole blob, which RFC 9110 allows
+        match = re.fullmatch(r"bytes=(\d*)-(\d*)", range_header.strip())
+        if match and (match.group(1) or match.group(2)):
+            if match.group(1):
+                start = int(match.group(1))
+                end = min(int(match.group(2)), size - 1) if match.group(2) else size - 1
+            else:
+                start = max(size - int(match.group(2)), 0)
+                end = size - 1
+            
+            if start >= size or start > end:
+                return Response(status_code=416, headers={**headers, "Content-Range": f"bytes */{size}"})
+            
+            data = await asyncio.to_thread(read_blob_range, path, start, end - start + 1)
+            return Response(
+                content=data,
+                status_code=206,
+                media_type=content_type,
+                headers={**headers, "Content-Range": f"bytes {start}-{end}/{size}"}
+            )
+    
+    data = await asyncio.to_thread(path.read_bytes)
+    return Response(content=data, media_type=content_type, headers=headers)
+
+# ============= IMAGE PROCESSING =============
+# Uploaded pictures are decoded once and re-encoded as square-bounded WebP variants with all
+# metadata dropped. Decoding runs on image_executor so a large photo never stalls the event loop.
+# The uploaded file itself is kept as the "original" variant. SVG (where allowed) can't be
+# thumbnailed and is stored as the original only.
+IMAGE_VARIANT_SIZES = (64, 128, 512)
+LIST_THUMBNAIL_SIZE = "128"
+IMAGE_MAX_PIXELS = 40_000_000
+image_executor = ThreadPoolExecutor(max_workers=min(4, os.cpu_count() or 1), thread_name_prefix="image")
+
+def render_image_variants(data: bytes) -> tuple:
+    """
+    Decode an uploaded image
+    Returns ({size: webp bytes} for every IMAGE_VARIANT_SIZES entry, MIME type of the upload)
+    """
+    import io
+    from PIL import Image, ImageOps, UnidentifiedImageError
+    
+    try:
+        with Image.open(io.BytesIO(data)) as source:
+            if source.width * source.height > IMAGE_MAX_PIXELS:
+                raise ValueError("Image dimensions are too large")
+            mime_type = Image.MIME.get(source.format, "application/octet-stream")
+            # Apply the EXIF orientation before the EXIF block is thrown away
+            image = ImageOps.exif_transpose(source)
+            has_alpha = image.mode in ("RGBA", "LA", "PA") or (image.mode == "P" and "transparency" in image.info)
+            image = image.convert("RGBA" if has_alpha else "RGB")
+    except (UnidentifiedImageError, Image.DecompressionBombError, OSError) as e:
+        raise ValueError(f"Unsupported or corrupt image: {e}")
+    
+    variants = {}
+    for size in IMAGE_VARIANT_SIZES:
+        variant = image.copy()
+        variant.thumbnail((size, size), Image.Resampling.LANCZOS)
+        output = io.BytesIO()
+        variant.save(output, "WEBP", quality=80, method=4, exif=b"", icc_profile="")
+        variants[size] = output.getvalue()
+    return variants, mime_type
+
+def is_svg(data: bytes) -> bool:
+    head = data[:1024].lstrip().lower()
+    return (head.startswith(b"<?xml") or head.startswith(b"<svg") or head.startswith(b"<!--")) and b"<svg" in head
+
+async def store_image(data: bytes, allow_svg: bool = False) -> dict:
+    """
+    Thumbnail an uploaded image and store every variant
+    Returns {"original": url, "64": url, "128": url, "512": url}, or just {"original": url}
+    for an SVG when allow_svg is set
+    """
+    if len(data) > BLOB_MAX_BYTES:
+        raise HTTPException(status_code=413, detail=f"File too large. Maximum size is {BLOB_MAX_BYTES // (1024 * 1024)}MB")
+    
+    if allow_svg and is_svg(data):
+        return {"original": await store_blob(data, "image/svg+xml")}
+    
+    loop = asyncio.get_running_loop()
+    try:
+        variants, mime_type = await loop.run_in_executor(image_executor, render_image_variants, data)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    urls = await asyncio.gather(
+        store_blob(data, mime_type),
+        *(store_blob(variant, "image/webp") for variant in variants.values())
+    )
+    return {"original": urls[0], **{str(size): url for size, url in zip(variants, urls[1:])}}
+
+def image_variant(variants: dict, size: str) -> str:
+    """URL of one thumbnail size, or the original when there are no thumbnails (SVG)"""
+    return variants.get(size) or variants["original"]
+
+def profile_thumbnail(user: dict) -> Optional[str]:
+    """The list-sized profile picture, falling back to the original for users not yet thumbnailed"""
+    return (user.get("profile_pic_variants") or {}).get(LIST_THUMBNAIL_SIZE) or user.get("profile_pic")
+
+async def load_image_source(value: Optional[str]) -> Optional[bytes]:
+    """Bytes behind an inline data: URL or one of our blob URLs"""
+    if not value:
+        return None
+    if value.startswith("data:") and ";base64," in value:
+        try:
+            return base64.b64decode(value.split(",", 1)[1])
+        except Exception:
+            return None
+    if value.startswith(BLOB_URL_PREFIX):
+        path = blob_path(value[len(BLOB_URL_PREFIX):])
+        if path.exists():
+            return await asyncio.to_thread(path.read_bytes)
+    return None
 
 # ============= BRANDING ENDPOINTS =============
 @api_router.post("/company/branding")
@@ -4727,22 +6227,24 @@ async def upload_branding(file: UploadFile = File(...), type: str = Form(...), c
         raise HTTPException(status_code=400, detail="Invalid type. Must be 'logo' or 'favicon'")
     
     try:
-        # Read file and convert to base64
+        # Thumbnail the file into the blob store and keep only the URLs in settings
         contents = await file.read()
-        base64_image = base64.b64encode(contents).decode('utf-8')
-        data_url = f"data:{file.content_type};base64,{base64_image}"
+        variants = await store_image(contents, allow_svg=True)
+        image_url = image_variant(variants, "512" if type == "logo" else "128")
         
         # Update settings with the uploaded image
         field_name = "company_logo" if type == "logo" else "favicon"
         await db.settings.update_one(
             {"company_id": current_user.company_id},
-            {"$set": {field_name: data_url}},
+            {"$set": {field_name: image_url, f"{field_name}_variants": variants}},
             upsert=True
         )
         
         await log_activity(current_user.company_id, current_user.id, current_user.name, f"UPLOAD_{type.upper()}", f"Uploaded company {type}, File: {file.filename}, Size: {len(contents)} bytes, Type: {file.content_type}")
         
-        return {"message": f"{type.capitalize()} uploaded successfully", field_name: data_url}
+        return {"message": f"{type.capitalize()} uploaded successfully", field_name: image_url}
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -4765,22 +6267,24 @@ async def upload_superadmin_branding(
         if not company:
             raise HTTPException(status_code=404, detail="Company not found")
         
-        # Read file and convert to base64
+        # Thumbnail the file into the blob store and keep only the URLs in settings
         contents = await file.read()
-        base64_image = base64.b64encode(contents).decode('utf-8')
-        data_url = f"data:{file.content_type};base64,{base64_image}"
+        variants = await store_image(contents, allow_svg=True)
+        image_url = image_variant(variants, "512" if type == "logo" else "128")
         
         # Update settings with the uploaded image
         field_name = "company_logo" if type == "logo" else "favicon"
         await db.settings.update_one(
             {"company_id": company_id},
-            {"$set": {field_name: data_url}},
+            {"$set": {field_name: image_url, f"{field_name}_variants": variants}},
             upsert=True
         )
         
         await log_activity("SUPER_ADMIN", current_user.id, current_user.name, f"UPLOAD_{type.upper()}", f"Uploaded {type} for company {company['name']}")
         
-        return {"message": f"{type.capitalize()} uploaded successfully for {company['name']}", field_name: data_url}
+        return {"message": f"{type.capitalize()} uploaded successfully for {company['name']}", field_name: image_url}
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -4795,18 +6299,21 @@ async def upload_employee_profile_pic(
         raise HTTPException(status_code=403, detail="Admin, manager or accountant access required")
     
     try:
-        # Read file and convert to base64
+        # Thumbnail the file into the blob store and keep only the URLs on the user
         contents = await file.read()
-        base64_image = base64.b64encode(contents).decode('utf-8')
-        data_url = f"data:{file.content_type};base64,{base64_image}"
+        variants = await store_image(contents)
+        image_url = variants["512"]
         
         # Update employee profile picture
         await db.users.update_one(
             {"id": employee_id, "company_id": current_user.company_id},
-            {"$set": {"profile_pic": data_url}}
+            {"$set": {"profile_pic": image_url, "profile_pic_variants": variants}}
         )
+        invalidate_user_cache(employee_id)
         
-        return {"message": "Profile picture updated successfully"}
+        return {"message": "Profile picture updated successfully", "profile_pic": image_url}
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to upload profile picture: {str(e)}")
 
@@ -5086,95 +6593,235 @@ Return ONLY the JSON response, no additional text.""",
         raise HTTPException(status_code=500, detail=f"Failed to parse file: {str(e)}")
 
 
-@api_router.post("/attendance/import-device-data")
-async def import_device_data(request: DeviceImportRequest, current_user: User = Depends(get_current_user)):
-    """Import device attendance data with ID mapping"""
-    
+# Text device logs are uploaded as a file and parsed while streaming; the records are staged in
+# db.device_import_records under an import_id and only a summary goes back to the browser.
+# Staged imports expire after DEVICE_IMPORT_TTL_HOURS (TTL index on expires_at).
+DEVICE_LOG_SEPARATOR = re.compile(r"\t+|\s{2,}")
+DEVICE_IMPORT_CHUNK_BYTES = 1024 * 1024
+DEVICE_IMPORT_STAGE_BATCH = 5000
+DEVICE_IMPORT_TTL_HOURS = 24
+
+async def iter_upload_lines(file: UploadFile, chunk_size: int = DEVICE_IMPORT_CHUNK_BYTES):
+    """Yield the lines of an uploaded text file without reading it into memory"""
+    import codecs
+    decoder = codecs.getincrementaldecoder("utf-8-sig")(errors="replace")
+    pending = ""
+    while True:
+        chunk = await file.read(chunk_size)
+        lines = (pending + decoder.decode(chunk, final=not chunk)).split("\n")
+        pending = lines.pop()
+        for line in lines:
+            yield line
+        if not chunk:
+            break
+    if pending:
+        yield pending
+
+@api_router.post("/attendance/device-import/upload")
+async def upload_device_import(file: UploadFile = File(...), current_user: User = Depends(get_current_user)):
+    """Stream-parse a text device log (vendor_id <tab> YYYY-MM-DD HH:MM[:SS]) and stage its records"""
     if current_user.role not in ["admin", "manager", "accountant"]:
         raise HTTPException(status_code=403, detail="Admin, manager or accountant access required")
     
-    # Create mapping dictionary
-    id_mapping = {mapping.vendor_id: mapping.employee_id for mapping in request.mappings}
-    
-    imported_count = 0
-    skipped_count = 0
-    overwritten_count = 0
-    errors = []
-    
-    # Group records by vendor_id and date
-    from collections import defaultdict
-    grouped_records = defaultdict(list)
-    
-    for record in request.parsed_records:
-        vendor_id = record.vendor_id
-        if vendor_id in id_mapping:
-            employee_id = id_mapping[vendor_id]
-            grouped_records[(employee_id, record.date)].append(record)
+    import_id = str(uuid.uuid4())
+    expires_at = datetime.now(timezone.utc) + timedelta(hours=DEVICE_IMPORT_TTL_HOURS)
+    vendor_counts = defaultdict(int)
+    first_date = None
+    last_date = None
+    total_records = 0
+    skipped_lines = 0
+    batch = []
     
-    # Process each employee-date group
-    for (employee_id, date), records in grouped_records.items():
-        try:
-            # Get employee
-            employee = await db.users.find_one({"id": employee_id, "company_id": request.company_id})
-            if not employee:
-                errors.append(f"Employee {employee_id} not found for date {date}")
+    try:
+        async for line in iter_upload_lines(file):
+            line = line.strip()
+            if not line:
+                continue
+            # Fields are separated by tabs or runs of spaces: vendor_id, "date time", anything else
+            parts = DEVICE_LOG_SEPARATOR.split(line, maxsplit=2)
+            datetime_str = parts[1].strip() if len(parts) >= 2 else ""
+            if " " not in datetime_str:
+                skipped_lines += 1
                 continue
             
-            # Sort records by time to get check-in and check-out
-            sorted_records = sorted(records, key=lambda r: r.time)
-            check_in_time = sorted_records[0].time
-            check_out_time = sorted_records[-1].time if len(sorted_records) > 1 else None
-            
-            # Check if attendance already exists
-            existing = await db.attendance.find_one({
-                "company_id": request.company_id,
-                "employee_id": employee_id,
-                "date": date
+            vendor_id = parts[0].strip()
+            date_part, time_part = datetime_str.split(" ", 1)
+            batch.append({
+                "import_id": import_id,
+                "vendor_id": vendor_id,
+                "date": date_part,
+                "time": time_part,
+                "expires_at": expires_at
             })
+            vendor_counts[vendor_id] += 1
+            first_date = date_part if first_date is None or date_part < first_date else first_date
+            last_date = date_part if last_date is None or date_part > last_date else last_date
+            total_records += 1
             
-            if existing:
-                if request.duplicate_action == "skip":
-                    skipped_count += 1
-                    continue
-                elif request.duplicate_action == "overwrite":
-                    # Update existing record
-                    await db.attendance.update_one(
-                        {"id": existing["id"]},
-                        {"$set": {
-                            "check_in": f"{date}T{check_in_time}",
-                            "check_out": f"{date}T{check_out_time}" if check_out_time else None,
-                            "status": "present",
-                            "updated_at": datetime.now(timezone.utc).isoformat(),
-                            "updated_by": current_user.id
-                        }}
-                    )
-                    overwritten_count += 1
-                    continue
-            
-            # Create new attendance record
-            new_attendance = {
-                "id": str(uuid.uuid4()),
-                "company_id": request.company_id,
-                "employee_id": employee_id,
-                "employee_name": capitalize_name(employee["name"]),
-                "date": date,
-                "check_in": f"{date}T{check_in_time}",
-                "check_out": f"{date}T{check_out_time}" if check_out_time else None,
-                "status": "present",
-                "created_by": current_user.id,
-                "created_at": datetime.now(timezone.utc).isoformat()
-            }
-            
-            await db.attendance.insert_one(new_attendance)
-            imported_count += 1
-            
-        except Exception as e:
-            errors.append(f"Error processing {employee_id} on {date}: {str(e)}")
+            if len(batch) >= DEVICE_IMPORT_STAGE_BATCH:
+                await db.device_import_records.insert_many(batch, ordered=False)
+                batch = []
+        
+        if batch:
+            await db.device_import_records.insert_many(batch, ordered=False)
+    except Exception as e:
+        logging.error(f"Device import upload failed: {str(e)}")
+        await db.device_import_records.delete_many({"import_id": import_id})
+        raise HTTPException(status_code=500, detail=f"Failed to parse file: {str(e)}")
+    
+    summary = {
+        "import_id": import_id,
+        "format_detected": "Tab or space-separated format with vendor_id and datetime",
+        "unique_vendor_ids": sorted(vendor_counts),
+        "vendor_counts": dict(vendor_counts),
+        "date_range": {"start": first_date, "end": last_date},
+        "total_records": total_records,
+        "skipped_lines": skipped_lines
+    }
+    await db.device_imports.insert_one({
+        "id": import_id,
+        "company_id": current_user.company_id,
+        "filename": file.filename,
+        "status": "staged",
+        **{key: value for key, value in summary.items() if key not in ["import_id", "vendor_counts"]},
+        "created_by": current_user.id,
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "expires_at": expires_at
+    })
     
     await log_activity(
-        request.company_id,
+        current_user.company_id,
         current_user.id,
         current_user.name,
+        "PARSE_DEVICE_IMPORT",
+        f"Parsed device import file {file.filename}: {total_records} records found"
+    )
+    
+    return {"success": True, "data": summary}
+
+def merge_day_punches(day_punches: dict, employee_id: str, date: str, first_time: str, last_time: str, count: int):
+    """Fold punches into day_punches[(employee_id, date)] = [first time, last time, punch count]"""
+    current = day_punches.get((employee_id, date))
+    if current is None:
+        day_punches[(employee_id, date)] = [first_time, last_time, count]
+    else:
+        current[0] = min(current[0], first_time)
+        current[1] = max(current[1], last_time)
+        current[2] += count
+
+async def collect_day_punches(import_id: Optional[str], id_mapping: dict, parsed_records: List[ParsedDeviceRecord]) -> dict:
+    """First and last punch per employee and date (several vendor IDs may map to one employee)"""
+    day_punches = {}
+    if import_id:
+        punch_groups = db.device_import_records.aggregate([
+            {"$match": {"import_id": import_id, "vendor_id": {"$in": list(id_mapping)}}},
+            {"$group": {
+                "_id": {"vendor_id": "$vendor_id", "date": "$date"},
+                "first": {"$min": "$time"},
+                "last": {"$max": "$time"},
+                "count": {"$sum": 1}
+            }}
+        ], allowDiskUse=True)
+        async for group in punch_groups:
+            merge_day_punches(day_punches, id_mapping[group["_id"]["vendor_id"]], group["_id"]["date"], group["first"], group["last"], group["count"])
+    else:
+        for record in parsed_records:
+            if record.vendor_id in id_mapping:
+                merge_day_punches(day_punches, id_mapping[record.vendor_id], record.date, record.time, record.time, 1)
+    return day_punches
+
+async def run_device_import(job: dict, id_mapping: dict, parsed_records: List[ParsedDeviceRecord]) -> dict:
+    """Plan a device import in memory from two prefetches, then write it with bulk_write"""
+    company_id = job["company_id"]
+    import_id = job["details"].get("import_id")
+    duplicate_action = job["details"]["duplicate_action"]
+    
+    day_punches = await collect_day_punches(import_id, id_mapping, parsed_records)
+    await update_job(job["id"], total=len(day_punches))
+    
+    skipped_count = 0
+    errors = []
+    
+    employee_ids = list({employee_id for employee_id, _ in day_punches})
+    dates = [date for _, date in day_punches]
+    start_time = await get_company_start_time(company_id)
+    
+    # Prefetch everyone referenced and all their attendance in the import's date range
+    employees = {
+        emp["id"]: emp for emp in await db.users.find(
+            {"id": {"$in": employee_ids}, "company_id": company_id}, {"_id": 0, "id": 1, "name": 1}
+        ).to_list(length=None)
+    }
+    existing_days = {}
+    if dates:
+        # Sorted by slot so the latest record of a day wins, as in open_attendance_day()
+        async for record in db.attendance.find(
+            {"company_id": company_id, "employee_id": {"$in": employee_ids}, "date": {"$gte": min(dates), "$lte": max(dates)}},
+            {"_id": 0}
+        ).sort("seq", 1):
+            existing_days[(record["employee_id"], record["date"])] = record
+    
+    inserts = []
+    updates = []
+    now = datetime.now(timezone.utc).isoformat()
+    for (employee_id, date), (first_time, last_time, punch_count) in sorted(day_punches.items()):
+        employee = employees.get(employee_id)
+        if not employee:
+            errors.append(f"Employee {employee_id} not found for date {date}")
+            continue
+        
+        # Earliest punch is the check-in, latest the check-out
+        check_in = f"{date}T{first_time}"
+        check_out = f"{date}T{last_time}" if punch_count > 1 else None
+        
+        existing = existing_days.get((employee_id, date))
+        if existing:
+            if duplicate_action == "overwrite":
+                updates.append((existing, {
+                    "check_in": check_in,
+                    "check_out": check_out,
+                    "status": "present",
+                    "updated_at": now,
+                    "updated_by": job["created_by"]
+                }))
+            else:
+                skipped_count += 1
+            continue
+        
+        inserts.append({
+            "id": str(uuid.uuid4()),
+            "company_id": company_id,
+            "employee_id": employee_id,
+            "employee_name": capitalize_name(employee["name"]),
+            "date": date,
+            "check_in": check_in,
+            "check_out": check_out,
+            "status": "present",
+            "created_by": job["created_by"],
+            "created_at": now
+        })
+    
+    planned = skipped_count + len(errors)
+    await update_job(job["id"], processed=planned)
+    
+    async def report_progress(written: int):
+        await update_job(job["id"], processed=planned + written)
+    
+    applied = await bulk_apply_attendance(company_id, inserts, updates, start_time, report_progress)
+    imported_count = applied["inserted"]
+    overwritten_count = applied["updated"]
+    # A punch or manual entry created the day while we were importing - treat it as existing
+    skipped_count += len(applied["conflicts"])
+    errors.extend(applied["errors"])
+    
+    if import_id:
+        await db.device_import_records.delete_many({"import_id": import_id})
+        await db.device_imports.update_one({"id": import_id}, {"$set": {"status": "imported"}})
+    
+    await log_activity(
+        company_id,
+        job["created_by"],
+        job["details"].get("created_by_name", ""),
         "IMPORT_DEVICE_ATTENDANCE",
         f"Imported {imported_count} records, skipped {skipped_count}, overwritten {overwritten_count}"
     )
@@ -5187,27 +6834,707 @@ async def import_device_data(request: DeviceImportRequest, current_user: User =
         "errors": errors
     }
 
+@api_router.post("/attendance/import-device-data")
+async def import_device_data(request: DeviceImportRequest, current_user: User = Depends(get_current_user)):
+    """Import device attendance data with ID mapping - runs as a background job, poll GET /jobs/{job_id}"""
+    
+    if current_user.role not in ["admin", "manager", "accountant"]:
+        raise HTTPException(status_code=403, detail="Admin, manager or accountant access required")
+    
+    if request.duplicate_action not in ["skip", "overwrite"]:
+        raise HTTPException(status_code=400, detail="duplicate_action must be 'skip' or 'overwrite'")
+    
+    if request.import_id:
+        # Claim the staged import so a double-clicked import can't run twice
+        staged_import = await db.device_imports.find_one_and_update(
+            {"id": request.import_id, "company_id": current_user.company_id, "status": "staged"},
+            {"$set": {"status": "importing"}}
+        )
+        if not staged_import:
+            raise HTTPException(status_code=404, detail="Import not found or expired - please upload the file again")
+    
+    # Create mapping dictionary
+    id_mapping = {mapping.vendor_id: mapping.employee_id for mapping in request.mappings}
+    
+    job = await create_job("device_import", current_user.company_id, current_user.id, {
+        "import_id": request.import_id,
+        "duplicate_action": request.duplicate_action,
+        "created_by_name": current_user.name
+    })
+    parsed_records = request.parsed_records
+    
+    async def worker(job):
+        try:
+            return await run_device_import(job, id_mapping, parsed_records)
+        except BaseException:
+            # Let the user retry a staged import that did not finish
+            if request.import_id:
+                await db.device_imports.update_one({"id": request.import_id, "status": "importing"}, {"$set": {"status": "staged"}})
+            raise
+    
+    start_job(job, worker)
+    
+    return {"success": True, "job_id": job["id"], "status": job["status"]}
+
 @api_router.post("/upload/profile-pic")
 async def upload_profile_pic(file: UploadFile = File(...), current_user: User = Depends(get_current_user)):
     try:
-        # Read file and convert to base64
+        # Thumbnail the file into the blob store and keep only the URLs on the user
         contents = await file.read()
-        base64_image = base64.b64encode(contents).decode('utf-8')
-        data_url = f"data:{file.content_type};base64,{base64_image}"
+        variants = await store_image(contents)
+        image_url = variants["512"]
         
         # Update user profile picture
         await db.users.update_one(
             {"id": current_user.id},
-            {"$set": {"profile_pic": data_url}}
+            {"$set": {"profile_pic": image_url, "profile_pic_variants": variants}}
         )
+        invalidate_user_cache(current_user.id)
         
         await log_activity(current_user.company_id or "SUPER_ADMIN", current_user.id, current_user.name, "UPDATE_PROFILE_PIC", "Updated profile picture")
         
-        return {"message": "Profile picture uploaded successfully", "profile_pic": data_url}
+        return {"message": "Profile picture uploaded successfully", "profile_pic": image_url}
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
+# ============= LOCATION POINT BUCKETS =============
+# GPS fixes are stored per session per UTC hour in db.location_points instead of growing
+# tracking_sessions.locations forever. A bucket is closed once it holds LOCATION_BUCKET_MAX
+# points and the next fix for that hour opens a new one.
+
+LOCATION_BUCKET_MAX = 720  # one fix every 5 seconds for an hour
+
+def location_bucket_hour(timestamp: str) -> str:
+    """Bucket key for an ISO timestamp, e.g. 2026-01-05T08"""
+    return timestamp[:13]
+
+async def append_location_points(session: dict, points: List[dict]) -> int:
+    """Append GPS fixes to the session's hourly buckets and roll them into the session summary"""
+    if not points:
+        return 0
+    
+    index = await company_geofence_index(session["company_id"])
+    if index["fences"]:
+        matches = classify_points(index, [p["latitude"] for p in points], [p["longitude"] for p in points])
+        for point, ids in zip(points, matches):
+            point["geofence_ids"] = ids
+    
+    by_hour = defaultdict(list)
+    for point in sorted(points, key=lambda p: p["timestamp"]):
+        by_hour[location_bucket_hour(point["timestamp"])].append(point)
+    
+    for hour, hour_points in by_hour.items():
+        # Top up the open bucket first, then start new ones. A push only matches a bucket that
+        # still has room for the whole slice, so a concurrent writer can't push it past the cap -
+        # the slice lands in a fresh bucket instead.
+        open_bucket = await db.location_points.find_one(
+            {"session_id": session["id"], "hour": hour, "count": {"$lt": LOCATION_BUCKET_MAX}},
+            {"_id": 0, "count": 1}
+        )
+        room = LOCATION_BUCKET_MAX - open_bucket["count"] if open_bucket else LOCATION_BUCKET_MAX
+        slices = [hour_points[:room]] + [
+            hour_points[i:i + LOCATION_BUCKET_MAX] for i in range(room, len(hour_points), LOCATION_BUCKET_MAX)
+        ]
+        for chunk in slices:
+            if not chunk:
+                continue
+            await db.location_points.update_one(
+                {
+                    "session_id": session["id"],
+                    "hour": hour,
+                    "count": {"$lte": LOCATION_BUCKET_MAX - len(chunk)}
+                },
+                {
+                    "$push": {"points": {"$each": chunk}},
+                    "$inc": {
+                        "count": len(chunk),
+                        "inside_count": sum(1 for p in chunk if p.get("geofence_ids"))
+                    },
+                    "$min": {"first_timestamp": chunk[0]["timestamp"]},
+                    "$max": {"last_timestamp": chunk[-1]["timestamp"]},
+                    "$setOnInsert": {
+                        "company_id": session["company_id"],
+                        "employee_id": session["employee_id"]
+                    }
+                },
+                upsert=True
+            )
+    
+    first_point = min(points, key=lambda p: p["timestamp"])
+    latest_point = max(points, key=lambda p: p["timestamp"])
+    await db.tracking_sessions.update_one(
+        {"id": session["id"]},
+        {
+            "$inc": {
+                "point_count": len(points),
+                "points_inside": sum(1 for p in points if p.get("geofence_ids"))
+            },
+            "$min": {"first_point_at": first_point["timestamp"]}
+        }
+    )
+    # Only move last_location forward - fixes can arrive out of order
+    await db.tracking_sessions.update_one(
+        {
+            "id": session["id"],
+            "$or": [{"last_point_at": None}, {"last_point_at": {"$lte": latest_point["timestamp"]}}]
+        },
+        {"$set": {"last_point_at": latest_point["timestamp"], "last_location": latest_point}}
+    )
+    return len(points)
+
+async def load_location_points(session_ids: List[str], from_time: Optional[str] = None, to_time: Optional[str] = None) -> dict:
+    """Points for the given sessions in time order, keyed by session id. Only buckets overlapping the range are read."""
+    query = {"session_id": {"$in": session_ids}}
+    if from_time:
+        query["last_timestamp"] = {"$gte": from_time}
+    if to_time:
+        query["first_timestamp"] = {"$lte": to_time}
+    
+    points_by_session = {session_id: [] for session_id in session_ids}
+    buckets = db.location_points.find(
+        query,
+        {"_id": 0, "session_id": 1, "points": 1}
+    ).sort([("session_id", 1), ("hour", 1), ("first_timestamp", 1)])
+    async for bucket in buckets:
+        points_by_session[bucket["session_id"]].extend(
+            p for p in bucket["points"]
+            if (not from_time or p["timestamp"] >= from_time) and (not to_time or p["timestamp"] <= to_time)
+        )
+    for points in points_by_session.values():
+        points.sort(key=lambda p: p["timestamp"])
+    return points_by_session
+
+
+# ============= ROUTE GEOMETRY =============
+# Reports ship a Douglas-Peucker simplified, Google encoded polyline and a summary
+# (distance, dwell time, bounding box) instead of raw points.
+
+EARTH_RADIUS_M = 6371008.8
+ROUTE_TOLERANCE_M = 10.0  # default simplification tolerance
+DWELL_RADIUS_M = 50.0  # staying within this distance ...
+DWELL_MIN_SECONDS = 300  # ... for at least this long counts as dwelling
+
+def haversine_m(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    """Great-circle distance in metres"""
+    import math
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    dphi = phi2 - phi1
+    dlambda = math.radians(lon2 - lon1)
+    a = math.sin(dphi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(dlambda / 2) ** 2
+    return 2 * EARTH_RADIUS_M * math.asin(min(1.0, math.sqrt(a)))
+
+def simplify_route(points: List[dict], tolerance_m: float = ROUTE_TOLERANCE_M) -> List[dict]:
+    """Douglas-Peucker simplification, keeping the original point dicts (with their timestamps)"""
+    import math
+    if tolerance_m <= 0 or len(points) < 3:
+        return list(points)
+    
+    # Local equirectangular projection to metres - accurate enough at trail scale
+    lat0 = math.radians(sum(p["latitude"] for p in points) / len(points))
+    kx = math.radians(1) * EARTH_RADIUS_M * math.cos(lat0)
+    ky = math.radians(1) * EARTH_RADIUS_M
+    xs = [p["longitude"] * kx for p in points]
+    ys = [p["latitude"] * ky for p in points]
+    
+    keep = [False] * len(points)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(points) - 1)]
+    tolerance_sq = tolerance_m * tolerance_m
+    while stack:
+        first, last = stack.pop()
+        ax, ay = xs[first], ys[first]
+        dx, dy = xs[last] - ax, ys[last] - ay
+        length_sq = dx * dx + dy * dy
+        
+        farthest, farthest_sq = 0, -1.0
+        for i in range(first + 1, last):
+            px, py = xs[i] - ax, ys[i] - ay
+            t = 0.0 if length_sq == 0 else max(0.0, min(1.0, (px * dx + py * dy) / length_sq))
+            ex, ey = px - t * dx, py - t * dy
+            dist_sq = ex * ex + ey * ey
+            if dist_sq > farthest_sq:
+                farthest, farthest_sq = i, dist_sq
+        
+        if farthest_sq > tolerance_sq:
+            keep[farthest] = True
+            if farthest - first > 1:
+                stack.append((first, farthest))
+            if last - farthest > 1:
+                stack.append((farthest, last))
+    
+    return [p for p, kept in zip(points, keep) if kept]
+
+def encode_polyline(points: List[dict], precision: int = 5) -> str:
+    """Google encoded polyline of the points' coordinates"""
+    factor = 10 ** precision
+    encoded = []
+    prev_lat = prev_lng = 0
+    for p in points:
+        lat = int(round(p["latitude"] * factor))
+        lng = int(round(p["longitude"] * factor))
+        for delta in (lat - prev_lat, lng - prev_lng):
+            value = ~(delta << 1) if delta < 0 else delta << 1
+            while value >= 0x20:
+                encoded.append(chr((0x20 | (value & 0x1f)) + 63))
+                value >>= 5
+            encoded.append(chr(value + 63))
+        prev_lat, prev_lng = lat, lng
+    return "".join(encoded)
+
+def summarize_route(points: List[dict], tolerance_m: float = ROUTE_TOLERANCE_M) -> Optional[dict]:
+    """Distance, duration, dwell time, bounding box and simplified polyline of time-ordered points"""
+    if not points:
+        return None
+    
+    times = [datetime.fromisoformat(p["timestamp"]).timestamp() for p in points]
+    distance = 0.0
+    dwell_seconds = 0.0
+    anchor = 0  # first point of the current stay
+    for i in range(1, len(points)):
+        prev, point = points[i - 1], points[i]
+        distance += haversine_m(prev["latitude"], prev["longitude"], point["latitude"], point["longitude"])
+        if haversine_m(points[anchor]["latitude"], points[anchor]["longitude"], point["latitude"], point["longitude"]) > DWELL_RADIUS_M:
+            stay = times[i - 1] - times[anchor]
+            if stay >= DWELL_MIN_SECONDS:
+                dwell_seconds += stay
+            anchor = i
+    stay = times[-1] - times[anchor]
+    if stay >= DWELL_MIN_SECONDS:
+        dwell_seconds += stay
+    
+    simplified = simplify_route(points, tolerance_m)
+    duration = times[-1] - times[0]
+    return {
+        "point_count": len(points),
+        "distance_m": round(distance, 1),
+        "duration_seconds": round(duration),
+        "dwell_seconds": round(dwell_seconds),
+        "moving_seconds": round(duration - dwell_seconds),
+        "bbox": {
+            "min_lat": min(p["latitude"] for p in points),
+            "min_lng": min(p["longitude"] for p in points),
+            "max_lat": max(p["latitude"] for p in points),
+            "max_lng": max(p["longitude"] for p in points)
+        },
+        "tolerance_m": tolerance_m,
+        "simplified_count": len(simplified),
+        "polyline": encode_polyline(simplified)
+    }
+
+async def attach_session_routes(sessions: List[dict]):
+    """Fill in session["route"] where missing - stored for stopped sessions, computed per request for active ones"""
+    missing = [session for session in sessions if session.get("point_count") and not session.get("route")]
+    if not missing:
+        return
+    
+    points = await load_location_points([session["id"] for session in missing])
+    for session in missing:
+        session["route"] = summarize_route(points[session["id"]])
+        if session.get("status") != "active":
+            await db.tracking_sessions.update_one({"id": session["id"]}, {"$set": {"route": session["route"]}})
+
+
+# ============= GEOFENCES =============
+# Company geofences (circles and polygons in settings.geofences) are compiled into a grid index:
+# each GEOFENCE_CELL_DEG cell lists the fences whose bounding box touches it, so a point is only
+# tested against nearby fences. Points are classified in numpy batches. Compiled indexes are
+# cached per company for GEOFENCE_CACHE_TTL_SECONDS and dropped when this worker changes them.
+GEOFENCE_CELL_DEG = 0.01  # about 1.1 km
+GEOFENCE_MAX_CELLS = 10000  # fences covering more cells are tested against every point
+GEOFENCE_CACHE_TTL_SECONDS = 60
+geofence_indexes = TTLCache(maxsize=10000, ttl=GEOFENCE_CACHE_TTL_SECONDS)
+
+def geofence_bbox(fence: dict) -> tuple:
+    """(min_lat, min_lng, max_lat, max_lng) of a geofence"""
+    import math
+    if fence["type"] == "circle":
+        dlat = math.degrees(fence["radius_m"] / EARTH_RADIUS_M)
+        dlng = dlat / max(math.cos(math.radians(fence["latitude"])), 0.01)
+        return (fence["latitude"] - dlat, fence["longitude"] - dlng, fence["latitude"] + dlat, fence["longitude"] + dlng)
+    lats = [vertex[0] for vertex in fence["points"]]
+    lngs = [vertex[1] for vertex in fence["points"]]
+    return (min(lats), min(lngs), max(lats), max(lngs))
+
+def build_geofence_index(geofences: List[dict]) -> dict:
+    """Compile geofences into {"fences": [...], "cells": {(row, col): [fence numbers]}, "everywhere": [...]}"""
+    import math
+    import numpy as np
+    index = {"fences": [], "cells": defaultdict(list), "everywhere": []}
+    for fence in geofences:
+        compiled = {"id": fence["id"], "name": fence.get("name"), "type": fence["type"]}
+        if fence["type"] == "circle":
+            compiled.update({"latitude": fence["latitude"], "longitude": fence["longitude"], "radius_m": fence["radius_m"]})
+        else:
+            compiled.update({
+                "lats": np.array([vertex[0] for vertex in fence["points"]], dtype=np.float64),
+                "lngs": np.array([vertex[1] for vertex in fence["points"]], dtype=np.float64)
+            })
+        number = len(index["fences"])
+        index["fences"].append(compiled)
+        
+        min_lat, min_lng, max_lat, max_lng = geofence_bbox(fence)
+        rows = range(math.floor(min_lat / GEOFENCE_CELL_DEG), math.floor(max_lat / GEOFENCE_CELL_DEG) + 1)
+        cols = range(math.floor(min_lng / GEOFENCE_CELL_DEG), math.floor(max_lng / GEOFENCE_CELL_DEG) + 1)
+        if len(rows) * len(cols) > GEOFENCE_MAX_CELLS:
+            index["everywhere"].append(number)
+            continue
+        for row in rows:
+            for col in cols:
+                index["cells"][(row, col)].append(number)
+    return index
+
+async def company_geofence_index(company_id: str) -> dict:
+    index = geofence_indexes.get(company_id)
+    if index is None:
+        settings = await db.settings.find_one({"company_id": company_id}, {"_id": 0, "geofences": 1})
+        index = geofence_indexes[company_id] = build_geofence_index((settings or {}).get("geofences") or [])
+    return index
+
+def invalidate_geofence_index(company_id: str):
+    geofence_indexes.pop(company_id, None)
+
+def points_in_polygon(lats, lngs, poly_lats, poly_lngs):
+    """Even-odd ray casting for many points against one polygon (numpy arrays)"""
+    import numpy as np
+    inside = np.zeros(len(lats), dtype=bool)
+    j = len(poly_lats) - 1
+    for i in range(len(poly_lats)):
+        yi, xi, yj, xj = poly_lats[i], poly_lngs[i], poly_lats[j], poly_lngs[j]
+        if yi != yj:  # horizontal edges never cross the ray
+            crosses = ((yi > lats) != (yj > lats)) & (lngs < (xj - xi) * (lats - yi) / (yj - yi) + xi)
+            inside ^= crosses
+        j = i
+    return inside
+
+def classify_points(index: dict, lats, lngs) -> List[List[str]]:
+    """Ids of the geofences containing each point"""
+    import numpy as np
+    lats = np.asarray(lats, dtype=np.float64)
+    lngs = np.asarray(lngs, dtype=np.float64)
+    matches = [[] for _ in range(len(lats))]
+    if not index["fences"] or len(lats) == 0:
+        return matches
+    
+    # Which of the distinct cells the points fall in are near each fence
+    cells = np.stack([np.floor(lats / GEOFENCE_CELL_DEG), np.floor(lngs / GEOFENCE_CELL_DEG)], axis=1).astype(np.int64)
+    unique_cells, cell_of_point = np.unique(cells, axis=0, return_inverse=True)
+    cell_of_point = cell_of_point.reshape(-1)
+    cells_near_fence = defaultdict(list)
+    for cell_number, (row, col) in enumerate(unique_cells.tolist()):
+        for number in index["cells"].get((row, col), []):
+            cells_near_fence[number].append(cell_number)
+    
+    candidates = {number: np.isin(cell_of_point, cell_numbers) for number, cell_numbers in cells_near_fence.items()}
+    for number in index["everywhere"]:
+        candidates[number] = np.ones(len(lats), dtype=bool)
+    
+    for number, candidate in candidates.items():
+        point_numbers = np.nonzero(candidate)[0]
+        fence = index["fences"][number]
+        cand_lats, cand_lngs = lats[point_numbers], lngs[point_numbers]
+        if fence["type"] == "circle":
+            phi1, phi2 = np.radians(fence["latitude"]), np.radians(cand_lats)
+            a = (np.sin((phi2 - phi1) / 2) ** 2
+                 + np.cos(phi1) * np.cos(phi2) * np.sin(np.radians(cand_lngs - fence["longitude"]) / 2) ** 2)
+            inside = 2 * EARTH_RADIUS_M * np.arcsin(np.minimum(1.0, np.sqrt(a))) <= fence["radius_m"]
+        else:
+            inside = points_in_polygon(cand_lats, cand_lngs, fence["lats"], fence["lngs"])
+        for point_number in point_numbers[inside].tolist():
+            matches[point_number].append(fence["id"])
+    return matches
+
+def validate_geofence(fence: Geofence):
+    if fence.type == "circle":
+        if fence.latitude is None or fence.longitude is None or not fence.radius_m or fence.radius_m <= 0:
+            raise HTTPException(status_code=400, detail="A circle geofence needs latitude, longitude and a positive radius_m")
+        vertices = [[fence.latitude, fence.longitude]]
+    elif fence.type == "polygon":
+        if len(fence.points) < 3 or any(len(vertex) != 2 for vertex in fence.points):
+            raise HTTPException(status_code=400, detail="A polygon geofence needs at least 3 [latitude, longitude] points")
+        vertices = fence.points
+    else:
+        raise HTTPException(status_code=400, detail="Geofence type must be 'circle' or 'polygon'")
+    if any(not (-90 <= lat <= 90 and -180 <= lng <= 180) for lat, lng in vertices):
+        raise HTTPException(status_code=400, detail="Geofence coordinates out of range")
+
+GEOFENCE_EVALUATION_BATCH = 500
+
+# Every evaluation job takes the next settings.geofences_version. Writes carry that version and
+# never replace a newer one, and a job stops once a newer job has started, so overlapping jobs
+# (two geofence edits in a row) always leave the newest classification behind.
+
+async def evaluate_company_geofences(job: dict):
+    """
+    Background job: re-classify a company's stored tracking points and located attendance
+    against its current geofences, then refresh session counts and location rollups
+    """
+    from pymongo import UpdateOne
+    company_id = job["company_id"]
+    version = job["details"]["geofences_version"]
+    # Check-ins whose location can be classified (free-form edits can leave it null or partial)
+    located = {
+        "company_id": company_id,
+        "location.latitude": {"$type": "number"},
+        "location.longitude": {"$type": "number"}
+    }
+    invalidate_geofence_index(company_id)
+    index = await company_geofence_index(company_id)
+    
+    async def superseded() -> bool:
+        settings = await db.settings.find_one({"company_id": company_id}, {"_id": 0, "geofences_version": 1})
+        return (settings or {}).get("geofences_version", 0) != version
+    
+    def not_newer(field: str) -> dict:
+        return {field: {"$not": {"$gt": version}}}
+    
+    bucket_total, attendance_total = await asyncio.gather(
+        db.location_points.count_documents({"company_id": company_id}),
+        db.attendance.count_documents(located)
+    )
+    await update_job(job["id"], total=bucket_total + attendance_total)
+    processed = 0
+    points_classified = 0
+    
+    # Tracking point buckets - a bucket that grew while being classified is skipped here and
+    # redone below, so a concurrent append is never overwritten
+    async def classify_buckets(query: dict) -> List:
+        nonlocal points_classified
+        changed = []
+        updates = []
+        async for bucket in db.location_points.find({**query, **not_newer("geofences_version")}, {"_id": 1, "count": 1, "points": 1}):
+            points = bucket["points"]
+            matches = classify_points(index, [p["latitude"] for p in points], [p["longitude"] for p in points])
+            for point, ids in zip(points, matches):
+                point["geofence_ids"] = ids
+            updates.append((
+                {"_id": bucket["_id"], "count": bucket["count"], **not_newer("geofences_version")},
+                {"$set": {"points": points, "inside_count": sum(1 for ids in matches if ids), "geofences_version": version}}
+            ))
+            points_classified += len(points)
+            if len(updates) >= GEOFENCE_EVALUATION_BATCH:
+                if await superseded():
+                    return []
+                changed.extend(await apply_bucket_updates(updates))
+                updates = []
+        if updates and not await superseded():
+            changed.extend(await apply_bucket_updates(updates))
+        return changed
+    
+    async def apply_bucket_updates(updates: List[tuple]) -> List:
+        """Write (filter, update) pairs; returns ids of buckets whose count no longer matched"""
+        nonlocal processed
+        result = await db.location_points.bulk_write([UpdateOne(f, u) for f, u in updates], ordered=False)
+        processed += len(updates)
+        await update_job(job["id"], processed=processed)
+        if result.matched_count == len(updates):
+            return []
+        unchanged = await db.location_points.find({"$or": [f for f, _ in updates]}, {"_id": 1}).to_list(length=None)
+        unchanged_ids = {doc["_id"] for doc in unchanged}
+        return [f["_id"] for f, _ in updates if f["_id"] not in unchanged_ids]
+    
+    grown = await classify_buckets({"company_id": company_id})
+    for _ in range(3):
+        if not grown:
+            break
+        grown = await classify_buckets({"_id": {"$in": grown}})
+    
+    if await superseded():
+        return {"superseded": True, "points_classified": points_classified}
+    
+    # Session counts from the buckets. append_location_points bumps a session's point_count and
+    # points_inside together, so a count is only written while point_count still equals the
+    # bucket total it was summed from - otherwise points arrived in between and it is summed again.
+    async def refresh_session_counts(match: dict) -> List[str]:
+        totals = await db.location_points.aggregate([
+            {"$match": match},
+            {"$group": {
+                "_id": "$session_id",
+                "points": {"$sum": "$count"},
+                "inside": {"$sum": {"$ifNull": ["$inside_count", 0]}}
+            }}
+        ], allowDiskUse=True).to_list(length=None)
+        moved = []
+        for i in range(0, len(totals), GEOFENCE_EVALUATION_BATCH):
+            batch = totals[i:i + GEOFENCE_EVALUATION_BATCH]
+            await db.tracking_sessions.bulk_write([
+                UpdateOne({"id": row["_id"], "point_count": row["points"]}, {"$set": {"points_inside": row["inside"]}})
+                for row in batch
+            ], ordered=False)
+            matched = await db.tracking_sessions.find(
+                {"$or": [{"id": row["_id"], "point_count": row["points"]} for row in batch]}, {"_id": 0, "id": 1}
+            ).to_list(length=None)
+            matched_ids = {doc["id"] for doc in matched}
+            moved.extend(row["_id"] for row in batch if row["_id"] not in matched_ids)
+        return moved
+    
+    await db.tracking_sessions.update_many(
+        {"company_id": company_id, "point_count": 0},
+        {"$set": {"points_inside": 0}}
+    )
+    moved = await refresh_session_counts({"company_id": company_id})
+    for _ in range(3):
+        if not moved:
+            break
+        moved = await refresh_session_counts({"session_id": {"$in": moved}})
+    if moved:
+        logging.error(f"Geofence evaluation for {company_id}: points_inside left as is for {len(moved)} session(s) still receiving points")
+    
+    # Check-ins with location
+    attendance_classified = 0
+    records = db.attendance.find(
+        located,
+        {"_id": 1, "location.latitude": 1, "location.longitude": 1}
+    )
+    chunk = []
+    async def classify_attendance(chunk: List[dict]):
+        nonlocal processed, attendance_classified
+        matches = classify_points(index, [r["location"]["latitude"] for r in chunk], [r["location"]["longitude"] for r in chunk])
+        await db.attendance.bulk_write([
+            UpdateOne({"_id": r["_id"], **not_newer("location.geofences_version")}, {"$set": {
+                "location.geofence_ids": ids,
+                "location.inside_geofence": bool(ids) if index["fences"] else None,
+                "location.geofences_version": version
+            }})
+            for r, ids in zip(chunk, matches)
+        ], ordered=False)
+        processed += len(chunk)
+        attendance_classified += len(chunk)
+        await update_job(job["id"], processed=processed)
+    async for record in records:
+        chunk.append(record)
+        if len(chunk) >= GEOFENCE_EVALUATION_BATCH:
+            if await superseded():
+                break
+            await classify_attendance(chunk)
+            chunk = []
+    else:
+        if chunk:
+            await classify_attendance(chunk)
+    
+    if await superseded():
+        return {"superseded": True, "points_classified": points_classified, "attendance_classified": attendance_classified}
+    
+    rollup_keys = await db.location_rollups.find(
+        {"company_id": company_id}, {"_id": 0, "employee_id": 1, "date": 1}
+    ).to_list(length=None)
+    for key in rollup_keys:
+        await refresh_location_rollup(company_id, key["employee_id"], key["date"])
+    
+    return {
+        "geofences": len(index["fences"]),
+        "points_classified": points_classified,
+        "attendance_classified": attendance_classified,
+        "rollups_refreshed": len(rollup_keys)
+    }
+
+async def start_geofence_evaluation(current_user: User) -> str:
+    from pymongo import ReturnDocument
+    settings = await db.settings.find_one_and_update(
+        {"company_id": current_user.company_id},
+        {"$inc": {"geofences_version": 1}},
+        projection={"_id": 0, "geofences_version": 1},
+        return_document=ReturnDocument.AFTER
+    )
+    job = await create_job("geofence_evaluation", current_user.company_id, current_user.id,
+                           {"geofences_version": (settings or {}).get("geofences_version", 0)})
+    start_job(job, evaluate_company_geofences)
+    return job["id"]
+
+
+# ============= LOCATION REPORT ROLLUPS =============
+# One db.location_rollups document per (company, employee, day) so the all-employees report
+# groups a few rollups instead of scanning every session and located attendance record.
+# Refreshed when a session starts or stops (or gets late points), and when located
+# attendance is added or deleted. Days are the UTC date of a session's start_time and the
+# attendance date, matching the from_date/to_date filters of the reports.
+
+async def refresh_location_rollup(company_id: str, employee_id: str, day: str):
+    """Recompute one employee's rollup for one day from its sessions and located attendance"""
+    # "T24" sorts after every time of the day
+    sessions, attendance = await asyncio.gather(
+        db.tracking_sessions.aggregate([
+            {"$match": {
+                "company_id": company_id,
+                "employee_id": employee_id,
+                "start_time": {"$gte": f"{day}T00:00:00", "$lt": f"{day}T24"}
+            }},
+            {"$sort": {"start_time": -1}},
+            {"$group": {
+                "_id": None,
+                "sessions_count": {"$sum": 1},
+                "point_count": {"$sum": {"$ifNull": ["$point_count", 0]}},
+                "points_inside": {"$sum": {"$ifNull": ["$points_inside", 0]}},
+                "distance_m": {"$sum": {"$ifNull": ["$route.distance_m", 0]}},
+                "latest": {"$first": "$$ROOT"}
+            }},
+            {"$project": {"_id": 0, "latest._id": 0, "latest.route.polyline": 0}}
+        ]).to_list(length=1),
+        db.attendance.aggregate([
+            {"$match": {
+                "company_id": company_id,
+                "employee_id": employee_id,
+                "date": day,
+                "location": {"$exists": True}
+            }},
+            {"$sort": {"created_at": -1}},
+            {"$group": {
+                "_id": None,
+                "count": {"$sum": 1},
+                "inside": {"$sum": {"$cond": [{"$eq": ["$location.inside_geofence", True]}, 1, 0]}},
+                "outside": {"$sum": {"$cond": [{"$eq": ["$location.inside_geofence", False]}, 1, 0]}},
+                "latest": {"$first": "$$ROOT"}
+            }},
+            {"$project": {"_id": 0, "latest._id": 0}}
+        ]).to_list(length=1)
+    )
+    
+    key = {"company_id": company_id, "employee_id": employee_id, "date": day}
+    if not sessions and not attendance:
+        await db.location_rollups.delete_one(key)
+        return
+    
+    rollup = {
+        "sessions_count": 0,
+        "point_count": 0,
+        "points_inside_geofence": 0,
+        "distance_m": 0,
+        "attendance_with_location_count": 0,
+        "attendance_inside_geofence": 0,
+        "attendance_outside_geofence": 0,
+        "updated_at": datetime.now(timezone.utc).isoformat()
+    }
+    # Latest records are stored with their sort field first: $max over embedded documents
+    # compares field by field, which is how the report picks the latest across days
+    if sessions:
+        latest = sessions[0]["latest"]
+        rollup.update({
+            "employee_name": latest.get("employee_name"),
+            "sessions_count": sessions[0]["sessions_count"],
+            "point_count": sessions[0]["point_count"],
+            "points_inside_geofence": sessions[0]["points_inside"],
+            "distance_m": round(sessions[0]["distance_m"], 1),
+            "latest_session": {"start_time": latest["start_time"], **latest}
+        })
+    if attendance:
+        latest = attendance[0]["latest"]
+        rollup.setdefault("employee_name", latest.get("employee_name"))
+        rollup.update({
+            "attendance_with_location_count": attendance[0]["count"],
+            "attendance_inside_geofence": attendance[0]["inside"],
+            "attendance_outside_geofence": attendance[0]["outside"],
+            "latest_attendance": {"date": latest["date"], "created_at": latest.get("created_at"), **latest}
+        })
+    
+    unset = {field: "" for field in ["latest_session", "latest_attendance"] if field not in rollup}
+    update = {"$set": rollup}
+    if unset:
+        update["$unset"] = unset
+    await db.location_rollups.update_one(key, update, upsert=True)
+
+
 # ============= LOCATION TRACKING ENDPOINTS =============
 
 @api_router.post("/location/tracking/start")
@@ -5237,11 +7564,13 @@ async def start_location_tracking(current_user: User = Depends(get_current_user)
         "start_time": datetime.now(timezone.utc).isoformat(),
         "end_time": None,
         "status": "active",
-        "locations": [],
+        "point_count": 0,  # first/last point fields are set by append_location_points
+        "points_inside": 0,
         "created_at": datetime.now(timezone.utc).isoformat()
     }
     
     await db.tracking_sessions.insert_one(session)
+    await refresh_location_rollup(session["company_id"], session["employee_id"], session["start_time"][:10])
     await log_activity(
         current_user.company_id,
         current_user.id,
@@ -5279,15 +7608,88 @@ async def update_location(location_data: LocationUpdate, current_user: User = De
         "accuracy": location_data.accuracy
     }
     
-    # Add location to session
-    await db.tracking_sessions.update_one(
-        {"id": location_data.session_id},
-        {"$push": {"locations": location_point}}
-    )
+    # Add location to the session's hourly bucket
+    await append_location_points(session, [location_point])
+    
+    return {
+        "message": "Location updated",
+        "timestamp": location_point["timestamp"]
+    }
+
+LOCATION_BATCH_MAX = 2000
+LOCATION_CLOCK_SKEW = timedelta(minutes=5)
+
+@api_router.post("/location/tracking/batch")
+async def upload_location_batch(batch: LocationBatch, current_user: User = Depends(get_current_user)):
+    """
+    Add GPS fixes a client buffered (e.g. once a minute or on reconnect) to a tracking session
+    - Fixes keep their client time; ones at or before the session's last point were already received and are skipped
+    - A stopped session still accepts fixes taken before it was stopped
+    - Fixes with bad coordinates or outside the session's time span are rejected
+    """
+    if len(batch.points) > LOCATION_BATCH_MAX:
+        raise HTTPException(status_code=400, detail=f"At most {LOCATION_BATCH_MAX} points per batch")
+    
+    session = await db.tracking_sessions.find_one({
+        "id": batch.session_id,
+        "company_id": current_user.company_id,
+        "employee_id": current_user.employee_id or current_user.id
+    }, {"_id": 0})
+    
+    if not session:
+        raise HTTPException(status_code=404, detail="Tracking session not found")
+    
+    latest_allowed = datetime.now(timezone.utc) + LOCATION_CLOCK_SKEW
+    if session.get("end_time"):
+        latest_allowed = min(latest_allowed, datetime.fromisoformat(session["end_time"]) + LOCATION_CLOCK_SKEW)
+    earliest_allowed = datetime.fromisoformat(session["start_time"]) - LOCATION_CLOCK_SKEW
+    last_point_at = session.get("last_point_at")
+    
+    points = []
+    rejected = 0
+    duplicates = 0
+    for fix in batch.points:
+        try:
+            taken_at = datetime.fromisoformat(fix.client_ts.replace("Z", "+00:00"))
+        except ValueError:
+            rejected += 1
+            continue
+        if taken_at.tzinfo is None:
+            taken_at = taken_at.replace(tzinfo=timezone.utc)
+        
+        if not (-90 <= fix.latitude <= 90 and -180 <= fix.longitude <= 180) or not (earliest_allowed <= taken_at <= latest_allowed):
+            rejected += 1
+            continue
+        
+        timestamp = taken_at.astimezone(timezone.utc).isoformat()
+        if last_point_at and timestamp <= last_point_at:
+            duplicates += 1
+            continue
+        points.append({
+            "latitude": fix.latitude,
+            "longitude": fix.longitude,
+            "timestamp": timestamp,
+            "accuracy": fix.accuracy
+        })
+    
+    await append_location_points(session, points)
+    
+    # Late fixes for a stopped session change its stored route and the day's rollup
+    if points and session.get("status") != "active":
+        all_points = await load_location_points([session["id"]])
+        await db.tracking_sessions.update_one(
+            {"id": session["id"]},
+            {"$set": {"route": summarize_route(all_points[session["id"]])}}
+        )
+        await refresh_location_rollup(session["company_id"], session["employee_id"], session["start_time"][:10])
     
     return {
-        "message": "Location updated",
-        "timestamp": location_point["timestamp"]
+        "message": "Locations added",
+        "received": len(batch.points),
+        "added": len(points),
+        "duplicates": duplicates,
+        "rejected": rejected,
+        "last_timestamp": max([p["timestamp"] for p in points] + ([last_point_at] if last_point_at else []), default=None)
     }
 
 @api_router.post("/location/tracking/stop")
@@ -5309,33 +7711,68 @@ async def stop_location_tracking(session_data: dict, current_user: User = Depend
     if not session:
         raise HTTPException(status_code=404, detail="Active tracking session not found")
     
-    # Stop the session
+    # Stop the session; the route no longer changes so its summary is stored with it
     end_time = datetime.now(timezone.utc).isoformat()
+    points = await load_location_points([session_id])
     await db.tracking_sessions.update_one(
         {"id": session_id},
         {
             "$set": {
                 "status": "stopped",
-                "end_time": end_time
+                "end_time": end_time,
+                "route": summarize_route(points[session_id])
             }
         }
     )
+    await refresh_location_rollup(session["company_id"], session["employee_id"], session["start_time"][:10])
     
     await log_activity(
         current_user.company_id,
         current_user.id,
         current_user.name,
         "STOP_LOCATION_TRACKING",
-        f"Stopped location tracking session (Duration: {len(session.get('locations', []))} points)"
+        f"Stopped location tracking session (Duration: {session.get('point_count', 0)} points)"
     )
     
     return {
         "message": "Location tracking stopped",
         "session_id": session_id,
         "end_time": end_time,
-        "total_locations": len(session.get("locations", []))
+        "total_locations": session.get("point_count", 0)
     }
 
+@api_router.get("/location/tracking/sessions/{session_id}/points")
+async def get_session_points(
+    session_id: str,
+    from_time: Optional[str] = None,
+    to_time: Optional[str] = None,
+    tolerance: float = 0,
+    encoding: str = "points",
+    current_user: User = Depends(get_current_user)
+):
+    """
+    Location points of one tracking session - own sessions, or any in the company for admins/managers
+    - tolerance: Douglas-Peucker tolerance in metres (0 returns every point)
+    - encoding: "points" for point objects, "polyline" for a Google encoded polyline with a route summary
+    """
+    if encoding not in ["points", "polyline"]:
+        raise HTTPException(status_code=400, detail="encoding must be 'points' or 'polyline'")
+    if tolerance < 0:
+        raise HTTPException(status_code=400, detail="tolerance must not be negative")
+    
+    query = {"id": session_id, "company_id": current_user.company_id}
+    if current_user.role not in ["admin", "manager", "super_admin"]:
+        query["employee_id"] = current_user.employee_id or current_user.id
+    
+    session = await db.tracking_sessions.find_one(query, {"_id": 0, "id": 1})
+    if not session:
+        raise HTTPException(status_code=404, detail="Tracking session not found")
+    
+    points = (await load_location_points([session_id], from_time, to_time))[session_id]
+    if encoding == "polyline":
+        return {"session_id": session_id, "route": summarize_route(points, tolerance)}
+    return {"session_id": session_id, "point_count": len(points), "locations": simplify_route(points, tolerance)}
+
 @api_router.post("/attendance/mark-with-location")
 async def mark_attendance_with_location(attendance_data: AttendanceWithLocation, current_user: User = Depends(get_current_user)):
     """Mark attendance with location snapshot"""
@@ -5360,20 +7797,7 @@ async def mark_attendance_with_location(attendance_data: AttendanceWithLocation,
                 detail=f"Employee not found. Searched for id={employee_id}, company_id={current_user.company_id}"
             )
     
-    # Check how many attendance records exist for this date (allow up to 10 per day)
-    existing_count = await db.attendance.count_documents({
-        "company_id": current_user.company_id,
-        "employee_id": employee_id,
-        "date": attendance_data.date
-    })
-    
-    if existing_count >= 10:
-        raise HTTPException(
-            status_code=400, 
-            detail=f"Daily limit exceeded. Maximum 10 attendance records per day allowed. Current count: {existing_count}"
-        )
-    
-    # Create attendance record with location
+    # Create attendance record with location (insert_attendance enforces the 10 records per day limit)
     check_in_datetime = None
     check_out_datetime = None
     
@@ -5402,15 +7826,20 @@ async def mark_attendance_with_location(attendance_data: AttendanceWithLocation,
             "longitude": attendance_data.longitude,
             "accuracy": attendance_data.accuracy,
             "address": attendance_data.address,
-            "map_snapshot": attendance_data.map_snapshot,
+            "map_snapshot": await store_data_url(attendance_data.map_snapshot),
             "captured_at": datetime.now(timezone.utc).isoformat()
         },
         "created_by": current_user.id,
         "created_at": datetime.now(timezone.utc).isoformat()
     }
     
-    attendance_response = new_attendance.copy()
-    await db.attendance.insert_one(new_attendance)
+    index = await company_geofence_index(current_user.company_id)
+    geofence_ids = classify_points(index, [attendance_data.latitude], [attendance_data.longitude])[0]
+    new_attendance["location"]["geofence_ids"] = geofence_ids
+    new_attendance["location"]["inside_geofence"] = bool(geofence_ids) if index["fences"] else None
+    
+    attendance_response = await insert_attendance(new_attendance)
+    await refresh_location_rollup(current_user.company_id, employee_id, attendance_data.date)
     
     await log_activity(
         current_user.company_id,
@@ -5422,6 +7851,73 @@ async def mark_attendance_with_location(attendance_data: AttendanceWithLocation,
     
     return {"message": "Attendance marked with location", "attendance": attendance_response}
 
+# ============= FINGERPRINT DIRECTORY =============
+# Devices punch with (company short code, fingerprint id). Both lookups are cached in memory,
+# warmed at startup and dropped by invalidate_user_cache() / short code changes; the TTL bounds
+# staleness across workers. Only hits are cached so a newly enrolled fingerprint works at once.
+SRI_LANKA_TZ = pytz.timezone('Asia/Colombo')
+FINGERPRINT_CACHE_TTL_SECONDS = 300
+fingerprint_companies = TTLCache(maxsize=10000, ttl=FINGERPRINT_CACHE_TTL_SECONDS)  # short_code -> company id
+fingerprint_users = TTLCache(maxsize=200000, ttl=FINGERPRINT_CACHE_TTL_SECONDS)  # (company id, fingerprint id) -> user
+fingerprint_user_keys = {}  # user id -> its key in fingerprint_users
+
+def cache_fingerprint_user(user: dict):
+    key = (user["company_id"], user["fingerprint_id"])
+    fingerprint_users[key] = {"id": user["id"], "name": user["name"]}
+    fingerprint_user_keys[user["id"]] = key
+
+def invalidate_fingerprint_user(user_id: Optional[str] = None):
+    if user_id is None:
+        fingerprint_users.clear()
+        fingerprint_user_keys.clear()
+        return
+    key = fingerprint_user_keys.pop(user_id, None)
+    if key:
+        fingerprint_users.pop(key, None)
+
+def invalidate_fingerprint_company(company_id: str):
+    for short_code in [code for code, cached_id in list(fingerprint_companies.items()) if cached_id == company_id]:
+        fingerprint_companies.pop(short_code, None)
+
+async def resolve_fingerprint(short_code: str, fingerprint_id: str) -> tuple:
+    """Returns (company id, user) for a device punch; either is None when unknown"""
+    company_id = fingerprint_companies.get(short_code)
+    if company_id is None:
+        company = await db.companies.find_one({"short_code": short_code}, {"_id": 0, "id": 1})
+        if not company:
+            return None, None
+        company_id = fingerprint_companies[short_code] = company["id"]
+    
+    return await resolve_fingerprint_in_company(company_id, fingerprint_id)
+
+async def resolve_fingerprint_in_company(company_id: str, fingerprint_id: str) -> tuple:
+    """resolve_fingerprint() for callers that already know the company (registered devices)"""
+    user = fingerprint_users.get((company_id, fingerprint_id))
+    if user is None:
+        user = await db.users.find_one(
+            {"fingerprint_id": fingerprint_id, "company_id": company_id},
+            {"_id": 0, "id": 1, "name": 1, "company_id": 1, "fingerprint_id": 1}
+        )
+        if not user:
+            return company_id, None
+        cache_fingerprint_user(user)
+    return company_id, user
+
+async def warm_fingerprint_directory():
+    """Load every short code and enrolled fingerprint so the first punches of the day skip the database"""
+    companies, users = await asyncio.gather(
+        db.companies.find({"short_code": {"$nin": [None, ""]}}, {"_id": 0, "id": 1, "short_code": 1}).to_list(length=None),
+        db.users.find(
+            {"fingerprint_id": {"$nin": [None, ""]}, "company_id": {"$ne": None}},
+            {"_id": 0, "id": 1, "name": 1, "company_id": 1, "fingerprint_id": 1}
+        ).to_list(length=None)
+    )
+    for company in companies:
+        fingerprint_companies[company["short_code"]] = company["id"]
+    for user in users:
+        cache_fingerprint_user(user)
+    logger.info(f"Fingerprint directory warmed: {len(companies)} companies, {len(users)} fingerprints")
+
 @api_router.get("/attendance/fingerprint/{company_short_code}/{fingerprint_id}")
 async def mark_attendance_by_fingerprint(company_short_code: str, fingerprint_id: str):
     """
@@ -5436,120 +7932,349 @@ async def mark_attendance_by_fingerprint(company_short_code: str, fingerprint_id
     if not company_short_code or company_short_code.strip() == '':
         return {"success": False, "message": "Missing company short code"}
     
-    # Find company by short code
-    company = await db.companies.find_one({"short_code": company_short_code}, {"_id": 0})
+    # Find company and user from the in-memory directory
+    company_id, user = await resolve_fingerprint(company_short_code, fingerprint_id)
     
-    if not company:
+    if not company_id:
         return {"success": False, "message": "Invalid company short code"}
     
-    # Find user by fingerprint_id within this specific company
-    user = await db.users.find_one({
-        "fingerprint_id": fingerprint_id,
-        "company_id": company["id"]
-    }, {"_id": 0})
-    
     if not user:
         return {"success": False, "message": "No User"}
     
-    # Get current time in Sri Lanka timezone (UTC+5:30)
-    sri_lanka_tz = pytz.timezone('Asia/Colombo')
-    current_time_lk = datetime.now(sri_lanka_tz)
-    today = current_time_lk.strftime("%Y-%m-%d")
-    current_time_str = current_time_lk.strftime("%H:%M")
-    
-    # For time comparison, use UTC
-    current_time_utc = datetime.now(timezone.utc)
+    # Punch at the current time in Sri Lanka timezone (UTC+5:30)
+    return await apply_fingerprint_punch(company_id, user, datetime.now(SRI_LANKA_TZ))
+
+async def apply_fingerprint_punch(company_id: str, user: dict, punch_time_lk: datetime) -> dict:
+    """
+    Apply one fingerprint punch taken at punch_time_lk (Sri Lanka time)
+    - No attendance that day: check-in
+    - Earlier than the recorded check-in (an offline punch arriving late): becomes the check-in
+    - Open attendance and >10 minutes since check-in: check-out
+    """
+    today = punch_time_lk.strftime("%Y-%m-%d")
+    current_time_str = punch_time_lk.strftime("%H:%M")
+    punch_datetime = f"{today}T{current_time_str}:00"
+    employee_name = capitalize_name(user["name"])
     
-    # Check if attendance record exists for today
-    attendance = await db.attendance.find_one({
-        "company_id": user.get("company_id"),
-        "employee_id": user["id"],
-        "date": today
-    }, {"_id": 0})
+    # Insert today's check-in unless a record already exists - one round trip for the morning rush
+    today_filter = {"company_id": company_id, "employee_id": user["id"], "date": today}
+    new_attendance = {
+        "id": str(uuid.uuid4()),
+        **today_filter,
+        "employee_name": employee_name,
+        "check_in": punch_datetime,
+        "check_out": None,
+        "status": "present",
+        "leave_type": "",
+        "created_by": user["id"],  # Self-marked via fingerprint
+        "created_at": datetime.now(timezone.utc).isoformat()
+    }
+    attendance = await open_attendance_day(new_attendance)
     
     if not attendance:
-        # No attendance for today - Mark check-in
-        check_in_datetime = f"{today}T{current_time_str}:00"
-        
-        new_attendance = {
-            "id": str(uuid.uuid4()),
-            "company_id": user.get("company_id"),
-            "employee_id": user["id"],
-            "employee_name": capitalize_name(user["name"]),
-            "date": today,
-            "check_in": check_in_datetime,
-            "check_out": None,
-            "status": "present",
-            "leave_type": "",
-            "created_by": user["id"],  # Self-marked via fingerprint
-            "created_at": datetime.now(timezone.utc).isoformat()
-        }
-        
-        await db.attendance.insert_one(new_attendance)
-        
+        # No attendance for today - marked check-in
         return {
             "success": True,
-            "message": f"Attendance Success - {capitalize_name(user['name'])}",
+            "message": f"Attendance Success - {employee_name}",
             "action": "check_in",
             "time": current_time_str
         }
     
-    else:
-        # Attendance exists - Check if we should mark check-out
-        if attendance.get("check_out"):
-            # Already has check-out
+    # Parse check-in time to verify 10-minute difference
+    check_in_str = attendance.get("check_in", "")
+    time_diff = None
+    if check_in_str:
+        try:
+            # Parse check_in datetime (format: "2025-12-26T09:30:00")
+            # The stored time is in Sri Lanka timezone (naive datetime)
+            check_in_dt = datetime.fromisoformat(check_in_str)
+            
+            # Make it timezone-aware in Sri Lanka timezone
+            if check_in_dt.tzinfo is None:
+                check_in_dt = SRI_LANKA_TZ.localize(check_in_dt)
+            
+            # Calculate time difference using Sri Lanka timezone
+            time_diff = (punch_time_lk - check_in_dt).total_seconds() / 60  # in minutes
+        except Exception as e:
+            print(f"Error parsing check_in time: {e}")
+            # Continue to mark check-out even if parsing fails
+    
+    if time_diff is not None and time_diff < 0:
+        # A buffered punch older than the recorded check-in (a later punch reached us first)
+        # is the real arrival time
+        moved = await update_attendance_record(attendance, {"check_in": punch_datetime}, expected={"check_in": check_in_str})
+        if not moved:
             return {
                 "success": False,
-                "message": f"Attendance already completed for {capitalize_name(user['name'])} today"
+                "message": f"Attendance for {employee_name} changed meanwhile - please punch again"
             }
-        
-        # Parse check-in time to verify 10-minute difference
-        check_in_str = attendance.get("check_in", "")
-        if check_in_str:
-            try:
-                # Parse check_in datetime (format: "2025-12-26T09:30:00")
-                # The stored time is in Sri Lanka timezone (naive datetime)
-                check_in_dt = datetime.fromisoformat(check_in_str)
-                
-                # Make it timezone-aware in Sri Lanka timezone
-                if check_in_dt.tzinfo is None:
-                    check_in_dt = sri_lanka_tz.localize(check_in_dt)
-                
-                # Calculate time difference using Sri Lanka timezone
-                time_diff = (current_time_lk - check_in_dt).total_seconds() / 60  # in minutes
-                
-                if time_diff < 10:
-                    return {
-                        "success": False,
-                        "message": f"Please wait {int(10 - time_diff)} more minutes before marking leaving"
-                    }
-                
-            except Exception as e:
-                print(f"Error parsing check_in time: {e}")
-                # Continue to mark check-out even if parsing fails
-        
-        # Mark check-out
-        check_out_datetime = f"{today}T{current_time_str}:00"
-        
-        await db.attendance.update_one(
-            {"id": attendance["id"]},
-            {"$set": {"check_out": check_out_datetime}}
-        )
-        
         return {
             "success": True,
-            "message": f"Leaving Marked Success - {capitalize_name(user['name'])}",
-            "action": "check_out",
+            "message": f"Attendance Success - {employee_name}",
+            "action": "check_in",
             "time": current_time_str
         }
+    
+    # Attendance exists - Check if we should mark check-out
+    if attendance.get("check_out"):
+        # Already has check-out
+        return {
+            "success": False,
+            "message": f"Attendance already completed for {employee_name} today"
+        }
+    
+    if time_diff is not None and time_diff < 10:
+        return {
+            "success": False,
+            "message": f"Please wait {int(10 - time_diff)} more minutes before marking leaving"
+        }
+    
+    # Mark check-out - only if no other punch closed the record in the meantime
+    closed = await update_attendance_record(attendance, {"check_out": punch_datetime}, expected={"check_out": None})
+    if not closed:
+        return {
+            "success": False,
+            "message": f"Attendance already completed for {employee_name} today"
+        }
+    
+    return {
+        "success": True,
+        "message": f"Leaving Marked Success - {employee_name}",
+        "action": "check_out",
+        "time": current_time_str
+    }
+
+# ============= FINGERPRINT DEVICES =============
+# Devices buffer punches while offline and flush them to /attendance/fingerprint/batch. Each
+# request is signed: X-Device-Id plus X-Signature = hex HMAC-SHA256 of the raw body with the
+# device secret. db.device_punches is unique on (device_id, seq) so a re-sent batch is harmless.
+DEVICE_BATCH_MAX_PUNCHES = 1000
+DEVICE_MAX_CLOCK_SKEW_MINUTES = 10
+DEVICE_PUNCH_CLAIM_MINUTES = 5  # a punch claimed longer ago than this by a request that died is applied again
+
+@api_router.post("/devices")
+async def create_fingerprint_device(device_data: FingerprintDeviceCreate, current_user: User = Depends(get_current_user)):
+    if current_user.role not in ["admin", "manager"]:
+        raise HTTPException(status_code=403, detail="Admin or manager access required")
+    
+    import secrets
+    device = {
+        "id": str(uuid.uuid4()),
+        "company_id": current_user.company_id,
+        "name": device_data.name.strip(),
+        "secret": secrets.token_hex(32),
+        "last_seq": None,
+        "last_seen_at": None,
+        "created_by": current_user.id,
+        "created_at": datetime.now(timezone.utc).isoformat()
+    }
+    await db.devices.insert_one(device)
+    await log_activity(current_user.company_id, current_user.id, current_user.name, "CREATE_DEVICE", f"Registered fingerprint device {device['name']}")
+    
+    # The secret is only ever returned here - it has to be flashed onto the device
+    device.pop("_id", None)
+    return device
+
+@api_router.get("/devices")
+async def get_fingerprint_devices(current_user: User = Depends(get_current_user)):
+    if current_user.role not in ["admin", "manager"]:
+        raise HTTPException(status_code=403, detail="Admin or manager access required")
+    
+    return await db.devices.find(
+        {"company_id": current_user.company_id},
+        {"_id": 0, "secret": 0}
+    ).sort("created_at", -1).to_list(length=None)
+
+@api_router.delete("/devices/{device_id}")
+async def delete_fingerprint_device(device_id: str, current_user: User = Depends(get_current_user)):
+    if current_user.role not in ["admin", "manager"]:
+        raise HTTPException(status_code=403, detail="Admin or manager access required")
+    
+    result = await db.devices.delete_one({"id": device_id, "company_id": current_user.company_id})
+    if result.deleted_count == 0:
+        raise HTTPException(status_code=404, detail="Device not found")
+    
+    await log_activity(current_user.company_id, current_user.id, current_user.name, "DELETE_DEVICE", f"Removed fingerprint device {device_id}")
+    return {"message": "Device removed successfully"}
+
+def device_punch_time(device_timestamp: Union[int, str]) -> datetime:
+    """A device timestamp as an aware Sri Lanka datetime"""
+    if isinstance(device_timestamp, int) or str(device_timestamp).isdigit():
+        return datetime.fromtimestamp(int(device_timestamp), timezone.utc).astimezone(SRI_LANKA_TZ)
+    punch_time = datetime.fromisoformat(device_timestamp)
+    if punch_time.tzinfo is None:
+        return SRI_LANKA_TZ.localize(punch_time)
+    return punch_time.astimezone(SRI_LANKA_TZ)
+
+@api_router.post("/attendance/fingerprint/batch")
+async def ingest_fingerprint_batch(request: Request):
+    """
+    Apply punches a device buffered while offline (no user authentication - the body is device signed)
+    - Punches already applied or rejected (same device and seq) are skipped
+    - Punches recorded by an earlier attempt that failed before applying them are applied now
+    - Punches are applied oldest first with the same rules as a live punch
+    - acknowledged_seq only covers punches that reached a final outcome
+    """
+    import hmac
+    import hashlib
+    from pymongo.errors import BulkWriteError
+    
+    device_id = request.headers.get("x-device-id", "")
+    signature = request.headers.get("x-signature", "")
+    body = await request.body()
+    
+    device = await db.devices.find_one({"id": device_id}, {"_id": 0})
+    expected = hmac.new(device["secret"].encode(), body, hashlib.sha256).hexdigest() if device else ""
+    if not device or not signature or not hmac.compare_digest(expected, signature.lower()):
+        raise HTTPException(status_code=401, detail="Invalid device signature")
+    
+    try:
+        batch = DevicePunchBatch.model_validate_json(body)
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f"Invalid punch batch: {str(e)}")
+    
+    if len(batch.punches) > DEVICE_BATCH_MAX_PUNCHES:
+        raise HTTPException(status_code=413, detail=f"At most {DEVICE_BATCH_MAX_PUNCHES} punches per batch")
+    
+    company_id = device["company_id"]
+    received_at = datetime.now(timezone.utc)
+    latest_allowed = received_at + timedelta(minutes=DEVICE_MAX_CLOCK_SKEW_MINUTES)
+    
+    results = []
+    punch_docs = []
+    for punch in batch.punches:
+        try:
+            punch_time = device_punch_time(punch.device_timestamp)
+        except (ValueError, OverflowError, OSError):
+            results.append({"seq": punch.seq, "success": False, "message": "Invalid device timestamp"})
+            continue
+        if punch_time > latest_allowed:
+            results.append({"seq": punch.seq, "success": False, "message": "Device timestamp is in the future"})
+            continue
+        punch_docs.append({
+            "device_id": device_id,
+            "seq": punch.seq,
+            "company_id": company_id,
+            "fingerprint_id": punch.fingerprint_id,
+            "punched_at": punch_time.isoformat(),
+            "received_at": received_at.isoformat(),
+            "status": "pending"
+        })
+    
+    # Record the punches first; the unique (device_id, seq) index rejects ones we already have
+    received_seqs = set()
+    if punch_docs:
+        try:
+            await db.device_punches.insert_many(punch_docs, ordered=False)
+        except BulkWriteError as e:
+            for error in e.details.get("writeErrors", []):
+                if error.get("code") != 11000:
+                    raise
+                received_seqs.add(punch_docs[error["index"]]["seq"])
+    
+    # Already received is only final once applied or rejected - an attempt that failed part way
+    # leaves its punches pending (or claimed by a request that died) and they are applied now
+    duplicate_seqs = set()
+    retry_docs = []
+    if received_seqs:
+        stored = await db.device_punches.find(
+            {"device_id": device_id, "seq": {"$in": list(received_seqs)}},
+            {"_id": 0}
+        ).to_list(length=None)
+        for doc in stored:
+            if doc.get("status") in ["applied", "rejected"]:
+                duplicate_seqs.add(doc["seq"])
+            else:
+                retry_docs.append(doc)
+    
+    new_punches = sorted(
+        [doc for doc in punch_docs if doc["seq"] not in received_seqs] + retry_docs,
+        key=lambda doc: (doc["punched_at"], doc["seq"])
+    )
+    
+    final_seqs = set(duplicate_seqs)
+    applied = 0
+    claim_cutoff = (received_at - timedelta(minutes=DEVICE_PUNCH_CLAIM_MINUTES)).isoformat()
+    for doc in new_punches:
+        # Claim the punch so concurrent retries of the same batch apply it once
+        claimed = await db.device_punches.find_one_and_update(
+            {
+                "device_id": device_id,
+                "seq": doc["seq"],
+                "$or": [{"status": "pending"}, {"status": "applying", "claimed_at": {"$lt": claim_cutoff}}]
+            },
+            {"$set": {"status": "applying", "claimed_at": received_at.isoformat()}}
+        )
+        if not claimed:
+            results.append({"seq": doc["seq"], "success": False, "message": "Being applied by another request"})
+            continue
+        
+        try:
+            _, user = await resolve_fingerprint_in_company(company_id, doc["fingerprint_id"])
+            if not user:
+                outcome = {"success": False, "message": "No User"}
+            else:
+                outcome = await apply_fingerprint_punch(company_id, user, datetime.fromisoformat(doc["punched_at"]))
+            
+            await db.device_punches.update_one(
+                {"device_id": device_id, "seq": doc["seq"]},
+                {"$set": {"status": "applied" if outcome["success"] else "rejected", "result": outcome}}
+            )
+        except Exception as e:
+            logging.error(f"Applying punch {doc['seq']} from device {device_id} failed: {str(e)}")
+            try:
+                await db.device_punches.update_one(
+                    {"device_id": device_id, "seq": doc["seq"]},
+                    {"$set": {"status": "pending"}}
+                )
+            except:
+                pass
+            results.append({"seq": doc["seq"], "success": False, "message": "Not applied - resend"})
+            continue
+        
+        final_seqs.add(doc["seq"])
+        applied += 1
+        results.append({"seq": doc["seq"], **outcome})
+    
+    results.extend({"seq": seq, "success": True, "duplicate": True, "message": "Already received"} for seq in sorted(duplicate_seqs))
+    
+    # Punches rejected before being stored (bad timestamps) are final too
+    stored_seqs = {doc["seq"] for doc in punch_docs}
+    final_seqs.update(punch.seq for punch in batch.punches if punch.seq not in stored_seqs)
+    
+    seqs = [punch.seq for punch in batch.punches]
+    # The device drops everything up to acknowledged_seq, so stop below the first unfinished punch
+    unfinished = [seq for seq in seqs if seq not in final_seqs]
+    acknowledged = [seq for seq in seqs if not unfinished or seq < min(unfinished)]
+    await db.devices.update_one(
+        {"id": device_id},
+        {
+            "$set": {"last_seen_at": received_at.isoformat()},
+            **({"$max": {"last_seq": max(seqs)}} if seqs else {})
+        }
+    )
+    
+    # The device can drop every seq up to acknowledged_seq from its buffer
+    return {
+        "success": True,
+        "received": len(batch.punches),
+        "applied": applied,
+        "duplicates": len(duplicate_seqs),
+        "acknowledged_seq": max(acknowledged) if acknowledged else None,
+        "results": results
+    }
 
 @api_router.get("/location/tracking/history")
 async def get_tracking_history(
+    response: Response,
     from_date: Optional[str] = None,
     to_date: Optional[str] = None,
+    cursor: Optional[str] = None,
+    limit: Optional[int] = None,
+    include_points: bool = False,
     current_user: User = Depends(get_current_user)
 ):
-    """Get location tracking history for current user"""
+    """Get location tracking history for current user (points only with include_points, for this page's sessions)"""
     
     employee_id = current_user.employee_id or current_user.id
     
@@ -5569,12 +8294,15 @@ async def get_tracking_history(
         query["start_time"] = date_filter
     
     # Get tracking sessions
-    sessions = await db.tracking_sessions.find(
-        query,
-        {"_id": 0}
-    ).sort("start_time", -1).to_list(length=None)
+    page = await fetch_page(db.tracking_sessions, query, "start_time", -1, cursor, limit, include_total=True)
+    set_page_headers(response, page)
     
-    return {"sessions": sessions, "total": len(sessions)}
+    if include_points and page["items"]:
+        points = await load_location_points([session["id"] for session in page["items"]])
+        for session in page["items"]:
+            session["locations"] = points[session["id"]]
+    
+    return {"sessions": page["items"], "total": page["total"], "next_cursor": page["next_cursor"]}
 
 @api_router.get("/location/reports/employee/{employee_id}")
 async def get_employee_location_report(
@@ -5632,6 +8360,7 @@ async def get_employee_location_report(
         query,
         {"_id": 0}
     ).sort("start_time", -1).to_list(length=None)
+    await attach_session_routes(tracking_sessions)
     
     # Get attendance records with location
     attendance_query = {
@@ -5666,7 +8395,11 @@ async def get_employee_location_report(
         "summary": {
             "total_tracking_sessions": len(tracking_sessions),
             "total_attendance_with_location": len(attendance_records),
-            "total_location_points": sum(len(session.get("locations", [])) for session in tracking_sessions)
+            "total_location_points": sum(session.get("point_count", 0) for session in tracking_sessions),
+            "total_distance_m": round(sum((session.get("route") or {}).get("distance_m", 0) for session in tracking_sessions), 1),
+            "points_inside_geofence": sum(session.get("points_inside", 0) for session in tracking_sessions),
+            "attendance_inside_geofence": sum(1 for a in attendance_records if (a.get("location") or {}).get("inside_geofence") is True),
+            "attendance_outside_geofence": sum(1 for a in attendance_records if (a.get("location") or {}).get("inside_geofence") is False)
         }
     }
 
@@ -5681,122 +8414,665 @@ async def get_all_location_reports(
     if current_user.role not in ["admin", "manager", "super_admin"]:
         raise HTTPException(status_code=403, detail="Admin or manager access required")
     
-    # Build date filter for tracking (start_time is ISO datetime string)
-    tracking_date_filter = {}
-    if from_date or to_date:
-        if from_date:
-            tracking_date_filter["$gte"] = f"{from_date}T00:00:00"
-        if to_date:
-            tracking_date_filter["$lte"] = f"{to_date}T23:59:59"
-    
-    # Get all tracking sessions for the company
-    tracking_query = {"company_id": current_user.company_id}
-    if tracking_date_filter:
-        tracking_query["start_time"] = tracking_date_filter
-    
-    all_tracking_sessions = await db.tracking_sessions.find(
-        tracking_query,
-        {"_id": 0}
-    ).sort("start_time", -1).to_list(length=None)
-    
-    # Build date filter for attendance (date is YYYY-MM-DD string)
-    attendance_date_filter = {}
+    # Per employee totals from the daily rollups (see refresh_location_rollup)
+    rollup_query = {"company_id": current_user.company_id}
     if from_date or to_date:
+        date_filter = {}
         if from_date:
-            attendance_date_filter["$gte"] = from_date
+            date_filter["$gte"] = from_date
         if to_date:
-            attendance_date_filter["$lte"] = to_date
-    
-    # Get all attendance with location for the company
-    attendance_query = {
-        "company_id": current_user.company_id,
-        "location": {"$exists": True}
-    }
-    if attendance_date_filter:
-        attendance_query["date"] = attendance_date_filter
-    
-    all_attendance = await db.attendance.find(
-        attendance_query,
-        {"_id": 0}
-    ).sort("date", -1).to_list(length=None)
-    
-    # Extract unique employee_ids from tracking sessions and attendance
-    employee_ids = set()
-    for session in all_tracking_sessions:
-        if session.get("employee_id"):
-            employee_ids.add(session["employee_id"])
-    for att in all_attendance:
-        if att.get("employee_id"):
-            employee_ids.add(att["employee_id"])
-    
-    print(f"DEBUG: Unique employee_ids with location data: {employee_ids}")
+            date_filter["$lte"] = to_date
+        rollup_query["date"] = date_filter
+    
+    grouped = await db.location_rollups.aggregate([
+        {"$match": rollup_query},
+        {"$sort": {"date": -1}},
+        {"$group": {
+            "_id": "$employee_id",
+            "employee_name": {"$first": "$employee_name"},
+            "tracking_sessions_count": {"$sum": "$sessions_count"},
+            "attendance_with_location_count": {"$sum": "$attendance_with_location_count"},
+            "total_location_points": {"$sum": "$point_count"},
+            "points_inside_geofence": {"$sum": {"$ifNull": ["$points_inside_geofence", 0]}},
+            "attendance_inside_geofence": {"$sum": {"$ifNull": ["$attendance_inside_geofence", 0]}},
+            "attendance_outside_geofence": {"$sum": {"$ifNull": ["$attendance_outside_geofence", 0]}},
+            "total_distance_m": {"$sum": "$distance_m"},
+            "latest_tracking": {"$max": "$latest_session"},
+            "latest_attendance": {"$max": "$latest_attendance"}
+        }}
+    ]).to_list(length=None)
     
-    # Fetch user information for all these employee_ids
-    users_with_data = await db.users.find(
-        {"id": {"$in": list(employee_ids)}},
+    users = await db.users.find(
+        {"id": {"$in": [row["_id"] for row in grouped]}},
         {"_id": 0, "id": 1, "name": 1, "office_mobile": 1, "position": 1, "role": 1}
     ).to_list(length=None)
+    users_by_id = {user["id"]: user for user in users}
     
-    print(f"DEBUG: Found {len(users_with_data)} users from database")
-    
-    # For any employee_ids not found in users, create placeholder from session data
-    found_ids = {user["id"] for user in users_with_data}
-    missing_ids = employee_ids - found_ids
-    
-    if missing_ids:
-        print(f"DEBUG: Missing user IDs: {missing_ids}")
-        # Add placeholder users from tracking session data
-        for emp_id in missing_ids:
-            # Find a session with this employee_id to get the name
-            session_with_name = next((s for s in all_tracking_sessions if s.get("employee_id") == emp_id), None)
-            if session_with_name:
-                users_with_data.append({
-                    "id": emp_id,
-                    "name": session_with_name.get("employee_name", "Unknown User"),
-                    "office_mobile": "N/A",
-                    "position": "Super Admin" if emp_id == "SUPER-ADMIN" else "Unknown",
-                    "role": "super_admin" if emp_id == "SUPER-ADMIN" else "unknown"
-                })
-    
-    print(f"DEBUG: Total users with location data (including placeholders): {len(users_with_data)}")
-    print(f"DEBUG: Total tracking sessions: {len(all_tracking_sessions)}")
-    print(f"DEBUG: Total attendance records: {len(all_attendance)}")
-    
-    # Group by employee
     employee_reports = []
-    
-    for user in users_with_data:
-        # Match by employee_id
-        emp_tracking = [s for s in all_tracking_sessions if s.get("employee_id") == user["id"]]
-        emp_attendance = [a for a in all_attendance if a.get("employee_id") == user["id"]]
-        
-        print(f"DEBUG: User {user.get('name')} (id={user['id']}, role={user.get('role')}): {len(emp_tracking)} tracking, {len(emp_attendance)} attendance")
-        
-        if emp_tracking or emp_attendance:
-            employee_reports.append({
-                "employee": {
-                    "id": user["id"],
-                    "name": capitalize_name(user["name"]),
-                    "mobile": user.get("office_mobile", "N/A"),
-                    "position": user.get("position", user.get("role", "").title())
-                },
-                "tracking_sessions_count": len(emp_tracking),
-                "attendance_with_location_count": len(emp_attendance),
-                "total_location_points": sum(len(s.get("locations", [])) for s in emp_tracking),
-                "latest_tracking": emp_tracking[0] if emp_tracking else None,
-                "latest_attendance": emp_attendance[0] if emp_attendance else None
-            })
+    for row in grouped:
+        # Employees without a user record (e.g. super admin testing) get a placeholder
+        user = users_by_id.get(row["_id"]) or {
+            "id": row["_id"],
+            "name": row.get("employee_name") or "Unknown User",
+            "office_mobile": "N/A",
+            "position": "Super Admin" if row["_id"] == "SUPER-ADMIN" else "Unknown",
+            "role": "super_admin" if row["_id"] == "SUPER-ADMIN" else "unknown"
+        }
+        employee_reports.append({
+            "employee": {
+                "id": user["id"],
+                "name": capitalize_name(user["name"]),
+                "mobile": user.get("office_mobile", "N/A"),
+                "position": user.get("position", user.get("role", "").title())
+            },
+            "tracking_sessions_count": row["tracking_sessions_count"],
+            "attendance_with_location_count": row["attendance_with_location_count"],
+            "total_location_points": row["total_location_points"],
+            "points_inside_geofence": row["points_inside_geofence"],
+            "attendance_inside_geofence": row["attendance_inside_geofence"],
+            "attendance_outside_geofence": row["attendance_outside_geofence"],
+            "total_distance_m": round(row["total_distance_m"], 1),
+            "latest_tracking": row.get("latest_tracking"),
+            "latest_attendance": row.get("latest_attendance")
+        })
+    employee_reports.sort(key=lambda report: report["employee"]["name"])
     
     return {
         "employees": employee_reports,
         "summary": {
             "total_employees_with_data": len(employee_reports),
-            "total_tracking_sessions": len(all_tracking_sessions),
-            "total_attendance_with_location": len(all_attendance),
-            "total_location_points": sum(len(s.get("locations", [])) for s in all_tracking_sessions)
+            "total_tracking_sessions": sum(row["tracking_sessions_count"] for row in grouped),
+            "total_attendance_with_location": sum(row["attendance_with_location_count"] for row in grouped),
+            "total_location_points": sum(row["total_location_points"] for row in grouped),
+            "points_inside_geofence": sum(row["points_inside_geofence"] for row in grouped),
+            "attendance_outside_geofence": sum(row["attendance_outside_geofence"] for row in grouped)
         }
     }
 
+# ============= DATABASE INDEXES & MIGRATIONS =============
+# Every index the API relies on, per collection: (keys, options)
+# Reconciled on startup by ensure_indexes() and by migrate_database.py
+INDEX_SPECS = {
+    "users": [
+        ([("id", 1)], {"unique": True}),
+        ([("office_mobile", 1)], {}),
+        ([("company_id", 1), ("fingerprint_id", 1)], {}),
+        ([("company_id", 1), ("role", 1)], {}),
+        ([("company_id", 1), ("created_at", 1), ("id", 1)], {}),
+    ],
+    "companies": [
+        ([("id", 1)], {"unique": True}),
+        ([("short_code", 1)], {}),
+        ([("admin_mobile", 1)], {}),
+        ([("created_at", -1)], {}),
+    ],
+    "settings": [
+        ([("company_id", 1)], {}),
+    ],
+    "otps": [
+        ([("mobile", 1), ("otp", 1), ("created_at", -1)], {}),
+    ],
+    "activity_logs": [
+        ([("company_id", 1), ("timestamp", -1)], {}),
+    ],
+    "attendance": [
+        ([("id", 1)], {"unique": True}),
+        ([("company_id", 1), ("employee_id", 1), ("date", 1), ("seq", 1)], {"unique": True}),
+        ([("company_id", 1), ("date", 1)], {}),
+    ],
+    "attendance_history": [
+        ([("attendance_id", 1), ("company_id", 1), ("edited_at", -1)], {}),
+    ],
+    "deleted_attendance": [
+        ([("company_id", 1), ("deleted_at", -1)], {}),
+    ],
+    "tracking_sessions": [
+        ([("id", 1)], {"unique": True}),
+        ([("company_id", 1), ("employee_id", 1), ("status", 1)], {}),
+        ([("company_id", 1), ("start_time", -1)], {}),
+        ([("company_id", 1), ("employee_id", 1), ("start_time", -1), ("id", -1)], {}),
+    ],
+    "location_rollups": [
+        ([("company_id", 1), ("employee_id", 1), ("date", 1)], {"unique": True}),
+        ([("company_id", 1), ("date", -1)], {}),
+    ],
+    "location_points": [
+        ([("session_id", 1), ("hour", 1), ("count", 1)], {}),
+        ([("company_id", 1), ("session_id", 1)], {}),
+        ([("company_id", 1), ("employee_id", 1), ("hour", 1)], {}),
+    ],
+    "increments": [
+        ([("employee_id", 1), ("effective_from", -1)], {}),
+        ([("company_id", 1), ("status", 1), ("effective_from", 1)], {}),
+    ],
+    "advances": [
+        ([("company_id", 1), ("employee_id", 1), ("request_date", -1)], {}),
+        ([("company_id", 1), ("status", 1)], {}),
+    ],
+    "leaves": [
+        ([("company_id", 1), ("employee_id", 1), ("applied_date", -1)], {}),
+        ([("company_id", 1), ("status", 1)], {}),
+    ],
+    "extra_payments": [
+        ([("company_id", 1), ("month", 1), ("employee_id", 1)], {}),
+    ],
+    "loans": [
+        ([("company_id", 1), ("employee_id", 1), ("status", 1)], {}),
+        ([("company_id", 1), ("created_at", -1), ("id", -1)], {}),
+    ],
+    "payroll": [
+        ([("company_id", 1), ("month", 1), ("employee_id", 1)], {"unique": True}),
+        ([("company_id", 1), ("generated_at", -1), ("id", -1)], {}),
+    ],
+    "payroll_aggregates": [
+        ([("company_id", 1), ("month", 1), ("employee_id", 1)], {"unique": True}),
+    ],
+    "company_stats": [
+        ([("company_id", 1)], {"unique": True}),
+    ],
+    "payroll_month_totals": [
+        ([("company_id", 1), ("month", 1)], {"unique": True}),
+    ],
+    "customers": [
+        ([("company_id", 1), ("created_at", -1)], {}),
+    ],
+    "products": [
+        ([("company_id", 1), ("name", 1)], {}),
+    ],
+    "invoices": [
+        ([("company_id", 1), ("created_at", -1)], {}),
+    ],
+    "invoice_payments": [
+        ([("invoice_id", 1)], {}),
+    ],
+    "estimates": [
+        ([("company_id", 1), ("created_at", -1)], {}),
+        ([("share_token", 1)], {"sparse": True}),
+    ],
+    "jobs": [
+        ([("id", 1)], {"unique": True}),
+    ],
+    "blobs": [
+        ([("hash", 1)], {"unique": True}),
+    ],
+    "devices": [
+        ([("id", 1)], {"unique": True}),
+        ([("company_id", 1), ("created_at", -1)], {}),
+    ],
+    "device_punches": [
+        ([("device_id", 1), ("seq", 1)], {"unique": True}),
+    ],
+    "device_imports": [
+        ([("id", 1)], {"unique": True}),
+        ([("expires_at", 1)], {"expireAfterSeconds": 0}),
+    ],
+    "device_import_records": [
+        ([("import_id", 1), ("vendor_id", 1), ("date", 1)], {}),
+        ([("expires_at", 1)], {"expireAfterSeconds": 0}),
+    ],
+    "stream_tickets": [
+        ([("ticket", 1)], {"unique": True}),
+        ([("expires_at", 1)], {"expireAfterSeconds": 0}),
+    ],
+    "sms_outbox": [
+        ([("id", 1)], {"unique": True}),
+        ([("status", 1), ("next_attempt_at", 1)], {}),
+        ([("finished_at", 1)], {"expireAfterSeconds": SMS_OUTBOX_RETENTION_DAYS * 86400}),
+    ],
+}
+
+# Hot query shapes: (collection, fields in equality -> sort/range order, where it comes from)
+# ensure_indexes() warns about any shape that no existing index can serve
+QUERY_SHAPES = [
+    ("users", ["id"], "get_current_user"),
+    ("users", ["office_mobile"], "send_otp / verify_otp"),
+    ("users", ["company_id", "fingerprint_id"], "mark_attendance_by_fingerprint"),
+    ("users", ["company_id", "role"], "payroll / employee lists"),
+    ("companies", ["short_code"], "mark_attendance_by_fingerprint"),
+    ("settings", ["company_id"], "settings / payroll"),
+    ("otps", ["mobile", "otp", "created_at"], "verify_otp"),
+    ("activity_logs", ["company_id", "timestamp"], "get_activity_logs"),
+    ("attendance", ["company_id", "employee_id", "date"], "attendance writes / payroll"),
+    ("attendance", ["company_id", "date"], "get_attendance_by_date / dashboard"),
+    ("attendance_history", ["attendance_id", "company_id"], "get_attendance_history"),
+    ("tracking_sessions", ["company_id", "employee_id", "status"], "location tracking"),
+    ("tracking_sessions", ["company_id", "start_time"], "location reports"),
+    ("increments", ["employee_id", "effective_from"], "get_effective_salary"),
+    ("advances", ["company_id", "employee_id"], "payroll"),
+    ("extra_payments", ["company_id", "month"], "payroll"),
+    ("loans", ["company_id", "employee_id", "status"], "payroll"),
+    ("payroll", ["company_id", "month"], "get_payroll / dashboard"),
+    ("payroll_aggregates", ["company_id", "month", "employee_id"], "load_attendance_summaries / record_attendance_change"),
+    ("payroll_aggregates", ["company_id"], "get_payroll_months"),
+    ("payroll_month_totals", ["company_id", "month"], "get_payroll_months"),
+    ("company_stats", ["company_id"], "get_superadmin_stats / adjust_company_stats"),
+    ("companies", ["created_at"], "get_superadmin_stats"),
+    ("sms_outbox", ["status", "next_attempt_at"], "sms_outbox_worker"),
+    ("users", ["company_id", "created_at"], "get_employees (paged)"),
+    ("loans", ["company_id", "created_at"], "get_loans (paged)"),
+    ("payroll", ["company_id", "generated_at"], "get_payroll (paged)"),
+    ("tracking_sessions", ["company_id", "employee_id", "start_time"], "get_tracking_history (paged)"),
+    ("jobs", ["id"], "get_job / update_job"),
+    ("blobs", ["hash"], "get_blob / store_blob"),
+    ("devices", ["id"], "ingest_fingerprint_batch"),
+    ("device_punches", ["device_id", "seq"], "ingest_fingerprint_batch"),
+    ("device_imports", ["id"], "import_device_data"),
+    ("device_import_records", ["import_id", "vendor_id"], "import_device_data"),
+    ("payroll", ["company_id", "month", "employee_id"], "run_payroll_generation"),
+    ("location_points", ["session_id", "hour"], "append_location_points / load_location_points"),
+    ("location_rollups", ["company_id", "date"], "get_all_location_reports"),
+    ("location_points", ["company_id"], "evaluate_company_geofences"),
+    ("location_rollups", ["company_id", "employee_id", "date"], "refresh_location_rollup"),
+    ("tracking_sessions", ["company_id", "employee_id", "start_time"], "refresh_location_rollup"),
+]
+
+# Indexes that used to be declared above and are now redundant (served by a longer index with
+# the same prefix); ensure_indexes() drops them so they stop costing every write
+RETIRED_INDEXES = {
+    "attendance": [
+        [("company_id", 1), ("employee_id", 1), ("date", 1)],  # prefix of (..., date, seq)
+    ],
+}
+
+# Index options compared by ensure_indexes(), whether or not a spec sets them
+INDEX_OPTIONS = ("unique", "sparse", "expireAfterSeconds", "partialFilterExpression")
+
+def _index_options_drifted(info: dict, options: dict) -> bool:
+    """Whether a live index's options differ from its spec (unique/sparse False = not set)"""
+    for opt in set(INDEX_OPTIONS) | set(options):
+        live, wanted = info.get(opt), options.get(opt)
+        if opt in ("unique", "sparse"):
+            live, wanted = bool(live), bool(wanted)
+        if live != wanted:
+            return True
+    return False
+
+def _index_serves_shape(index_keys: List[tuple], shape_fields: List[str]) -> bool:
+    """An index serves a query shape when its leading keys are exactly the shape's fields (any order)"""
+    index_fields = [field for field, _ in index_keys]
+    if len(index_fields) < len(shape_fields):
+        return False
+    return set(index_fields[:len(shape_fields)]) == set(shape_fields)
+
+async def ensure_indexes(dry_run: bool = False) -> dict:
+    """
+    Reconcile INDEX_SPECS against the database (idempotent)
+    - Missing indexes are created, indexes whose options drifted are rebuilt
+    - RETIRED_INDEXES are dropped; other indexes not declared here are reported but never dropped
+    - QUERY_SHAPES that no index serves are reported as uncovered
+
+    Returns:
+        Report dict with created / rebuilt / dropped / unchanged / failed / unmanaged / uncovered lists
+    """
+    from pymongo.errors import PyMongoError
+
+    report = {"created": [], "rebuilt": [], "dropped": [], "unchanged": [], "failed": [], "unmanaged": [], "uncovered": []}
+    total = sum(len(specs) for specs in INDEX_SPECS.values())
+    position = 0
+    live_indexes = {}
+
+    for collection_name, specs in INDEX_SPECS.items():
+        collection = db[collection_name]
+        existing = await collection.index_information()
+        existing_by_keys = {tuple(info["key"]): (name, info) for name, info in existing.items()}
+        declared_keys = set()
+
+        for keys, options in specs:
+            position += 1
+            key_tuple = tuple((field, direction) for field, direction in keys)
+            declared_keys.add(key_tuple)
+            label = f"{collection_name}.{'_'.join(field for field, _ in keys)}"
+            current = existing_by_keys.get(key_tuple)
+
+            try:
+                if current:
+                    name, info = current
+                    if not _index_options_drifted(info, options):
+                        report["unchanged"].append(label)
+                        continue
+                    logging.info(f"[indexes {position}/{total}] rebuilding {label} (options changed)")
+                    if not dry_run:
+                        await collection.drop_index(name)
+                        await collection.create_index(keys, **options)
+                    report["rebuilt"].append(label)
+                else:
+                    logging.info(f"[indexes {position}/{total}] building {label}")
+                    if not dry_run:
+                        await collection.create_index(keys, **options)
+                    report["created"].append(label)
+            except PyMongoError as e:
+                logging.error(f"[indexes {position}/{total}] failed to build {label}: {str(e)}")
+                report["failed"].append(label)
+
+        retired_keys = {tuple(keys) for keys in RETIRED_INDEXES.get(collection_name, [])}
+        for name, info in existing.items():
+            if name == "_id_" or tuple(info["key"]) in declared_keys:
+                continue
+            if tuple(info["key"]) in retired_keys:
+                label = f"{collection_name}.{name}"
+                try:
+                    logging.info(f"[indexes] dropping retired index {label}")
+                    if not dry_run:
+                        await collection.drop_index(name)
+                    report["dropped"].append(label)
+                except PyMongoError as e:
+                    logging.error(f"[indexes] failed to drop {label}: {str(e)}")
+                    report["failed"].append(label)
+                continue
+            report["unmanaged"].append(f"{collection_name}.{name}")
+
+        # Coverage is checked against what is actually in the database after reconciling
+        if not dry_run:
+            existing = await collection.index_information()
+        live_indexes[collection_name] = [info["key"] for info in existing.values()]
+
+    for collection_name, fields, origin in QUERY_SHAPES:
+        indexes = live_indexes.get(collection_name, [])
+        if not any(_index_serves_shape(index_keys, fields) for index_keys in indexes):
+            shape = f"{collection_name}({', '.join(fields)}) from {origin}"
+            logging.warning(f"No index covers query shape {shape}")
+            report["uncovered"].append(shape)
+
+    logging.info(
+        f"Index reconcile done: {len(report['created'])} created, {len(report['rebuilt'])} rebuilt, {len(report['dropped'])} dropped, "
+        f"{len(report['unchanged'])} unchanged, {len(report['failed'])} failed, {len(report['uncovered'])} uncovered shapes"
+    )
+    return report
+
+async def migrate_office_mobile():
+    """Rename legacy 'mobile' -> 'office_mobile' on users (same as migrate_mobile_fields.py)"""
+    result = await db.users.update_many(
+        {"mobile": {"$exists": True}, "office_mobile": {"$exists": False}},
+        [{"$set": {"office_mobile": "$mobile"}}, {"$unset": "mobile"}]
+    )
+    invalidate_user_cache()
+    return f"{result.modified_count} user(s) migrated"
+
+async def migrate_payroll_aggregates():
+    """Build payroll_aggregates for attendance recorded before aggregates existed"""
+    rebuilt = await rebuild_all_payroll_aggregates()
+    return f"{len(rebuilt)} company month(s) aggregated"
+
+async def migrate_dedupe_payroll():
+    """
+    Keep only the newest payroll row per (company, employee, month) so it can be uniquely indexed
+    The older rows are moved to db.payroll_duplicates (with their original _id) rather than dropped
+    """
+    from pymongo import ReplaceOne
+    duplicates = await db.payroll.aggregate([
+        {"$sort": {"generated_at": -1}},
+        {"$group": {
+            "_id": {"company_id": "$company_id", "employee_id": "$employee_id", "month": "$month"},
+            "ids": {"$push": "$_id"},
+            "count": {"$sum": 1}
+        }},
+        {"$match": {"count": {"$gt": 1}}}
+    ], allowDiskUse=True).to_list(length=None)
+    
+    removed = 0
+    archived_at = datetime.now(timezone.utc).isoformat()
+    for duplicate in duplicates:
+        rows = await db.payroll.find({"_id": {"$in": duplicate["ids"][1:]}}).to_list(length=None)
+        if not rows:
+            continue
+        # Upserts by _id, so a re-run after a partial failure doesn't archive a row twice
+        await db.payroll_duplicates.bulk_write(
+            [ReplaceOne({"_id": row["_id"]}, {**row, "archived_at": archived_at}, upsert=True) for row in rows],
+            ordered=False
+        )
+        result = await db.payroll.delete_many({"_id": {"$in": [row["_id"] for row in rows]}})
+        removed += result.deleted_count
+    
+    # The unique payroll index could not be built while duplicates existed
+    await ensure_indexes()
+    return f"{removed} duplicate payroll row(s) moved to payroll_duplicates"
+
+async def migrate_company_stats():
+    """Materialize company_stats for companies created before it existed"""
+    stats = await refresh_company_stats()
+    return f"{len(stats)} company stat document(s) written"
+
+async def migrate_blob_images():
+    """Move inline base64 images (profile pictures, logos, favicons, map snapshots) into the blob store"""
+    inline = {"$regex": "^data:"}
+    moved = 0
+    
+    for collection, fields in [
+        (db.users, ["profile_pic"]),
+        (db.settings, ["company_logo", "favicon"]),
+        (db.attendance, ["location.map_snapshot"]),
+        (db.deleted_attendance, ["location.map_snapshot"]),
+    ]:
+        for field in fields:
+            async for doc in collection.find({field: inline}, {"_id": 1, field: 1}):
+                value = doc
+                for part in field.split("."):
+                    value = value.get(part) if isinstance(value, dict) else None
+                url = await store_data_url(value)
+                if url != value:
+                    await collection.update_one({"_id": doc["_id"], field: value}, {"$set": {field: url}})
+                    moved += 1
+    
+    invalidate_user_cache()
+    return f"{moved} inline image(s) moved to the blob store"
+
+async def migrate_image_variants():
+    """Generate thumbnail variants for profile pictures, logos and favicons uploaded before thumbnailing"""
+    processed = 0
+    failed = 0
+    
+    for collection, field in [(db.users, "profile_pic"), (db.settings, "company_logo"), (db.settings, "favicon")]:
+        variants_field = f"{field}_variants"
+        async for doc in collection.find({field: {"$nin": [None, ""]}, variants_field: {"$exists": False}}, {"_id": 1, field: 1}):
+            data = await load_image_source(doc[field])
+            try:
+                if data is None:
+                    raise HTTPException(status_code=404, detail="Image source not found")
+                variants = await store_image(data, allow_svg=field != "profile_pic")
+            except HTTPException as e:
+                logging.error(f"Thumbnailing {field} of {doc['_id']} failed: {e.detail}")
+                failed += 1
+                continue
+            
+            image_url = image_variant(variants, "128" if field == "favicon" else "512")
+            await collection.update_one({"_id": doc["_id"]}, {"$set": {field: image_url, variants_field: variants}})
+            processed += 1
+    
+    invalidate_user_cache()
+    return f"{processed} image(s) thumbnailed, {failed} failed"
+
+async def migrate_attendance_seq():
+    """Give attendance recorded before per-day slots a seq (in creation order) so it can be uniquely indexed"""
+    from pymongo import UpdateOne
+    groups = db.attendance.aggregate([
+        {"$sort": {"created_at": 1}},
+        {"$group": {
+            "_id": {"company_id": "$company_id", "employee_id": "$employee_id", "date": "$date"},
+            "max_seq": {"$max": "$seq"},
+            "unsequenced": {"$push": {"$cond": [{"$eq": [{"$ifNull": ["$seq", None]}, None]}, "$_id", "$$REMOVE"]}}
+        }},
+        {"$match": {"unsequenced.0": {"$exists": True}}}
+    ], allowDiskUse=True)
+    
+    operations = []
+    sequenced = 0
+    async for group in groups:
+        first_seq = (group.get("max_seq") or 0) + 1
+        for offset, object_id in enumerate(group["unsequenced"]):
+            operations.append(UpdateOne({"_id": object_id}, {"$set": {"seq": first_seq + offset}}))
+        if len(operations) >= 1000:
+            await db.attendance.bulk_write(operations, ordered=False)
+            sequenced += len(operations)
+            operations = []
+    if operations:
+        await db.attendance.bulk_write(operations, ordered=False)
+        sequenced += len(operations)
+    
+    # The unique slot index could not be built while records had no seq
+    await ensure_indexes()
+    return f"{sequenced} attendance record(s) given a seq"
+
+async def migrate_location_buckets():
+    """Move points embedded in tracking_sessions.locations into hourly location_points buckets"""
+    moved_sessions = 0
+    moved_points = 0
+    sessions = db.tracking_sessions.find({"locations": {"$exists": True}}, {"_id": 0})
+    async for session in sessions:
+        points = [p for p in session.get("locations") or [] if p.get("timestamp")]
+        # A re-run after a partial failure starts this session's buckets over
+        await db.location_points.delete_many({"session_id": session["id"]})
+        await db.tracking_sessions.update_one(
+            {"id": session["id"]},
+            {"$set": {"point_count": 0}, "$unset": {"first_point_at": "", "last_point_at": "", "last_location": ""}}
+        )
+        for i in range(0, len(points), LOCATION_BUCKET_MAX):
+            await append_location_points(session, points[i:i + LOCATION_BUCKET_MAX])
+        await db.tracking_sessions.update_one({"id": session["id"]}, {"$unset": {"locations": ""}})
+        moved_sessions += 1
+        moved_points += len(points)
+    
+    await db.tracking_sessions.update_many({"point_count": {"$exists": False}}, {"$set": {"point_count": 0}})
+    return f"{moved_points} point(s) from {moved_sessions} session(s) moved to location_points"
+
+async def migrate_location_rollups():
+    """Store missing routes of stopped sessions and build location_rollups from existing data"""
+    sessions = await db.tracking_sessions.find(
+        {"status": {"$ne": "active"}, "point_count": {"$gt": 0}, "route": None},
+        {"_id": 0}
+    ).to_list(length=None)
+    for i in range(0, len(sessions), 100):
+        await attach_session_routes(sessions[i:i + 100])
+    
+    keys, located = await asyncio.gather(
+        db.tracking_sessions.aggregate([
+            {"$group": {"_id": {
+                "company_id": "$company_id",
+                "employee_id": "$employee_id",
+                "date": {"$substrCP": ["$start_time", 0, 10]}
+            }}}
+        ], allowDiskUse=True).to_list(length=None),
+        db.attendance.aggregate([
+            {"$match": {"location": {"$exists": True}}},
+            {"$group": {"_id": {"company_id": "$company_id", "employee_id": "$employee_id", "date": "$date"}}}
+        ], allowDiskUse=True).to_list(length=None)
+    )
+    days = {(k["_id"]["company_id"], k["_id"]["employee_id"], k["_id"]["date"]) for k in keys + located}
+    for company_id, employee_id, day in days:
+        await refresh_location_rollup(company_id, employee_id, day)
+    return f"{len(sessions)} route(s) stored, {len(days)} rollup day(s) built"
+
+async def migrate_sms_outbox_retention():
+    """Redact OTPs in finished outbox messages and give them a finished_at so the TTL index removes them"""
+    finished = {"status": {"$in": ["sent", "failed", "skipped"]}}
+    redacted = await db.sms_outbox.update_many(
+        {**finished, "message": {"$regex": "^Your OTP for "}},
+        {"$set": {"message": SMS_REDACTED}}
+    )
+    dated = await db.sms_outbox.update_many(
+        {**finished, "finished_at": {"$exists": False}},
+        {"$set": {"finished_at": datetime.now(timezone.utc)}}
+    )
+    return f"{redacted.modified_count} OTP message(s) redacted, {dated.modified_count} message(s) set to expire"
+
+# Data migrations, applied once each in order and recorded in db.schema_migrations
+# Every migration must be idempotent - it may be re-run if it fails part way
+MIGRATIONS = [
+    ("0001_office_mobile", migrate_office_mobile),
+    ("0002_payroll_aggregates", migrate_payroll_aggregates),
+    ("0003_dedupe_payroll", migrate_dedupe_payroll),
+    ("0004_company_stats", migrate_company_stats),
+    ("0005_blob_images", migrate_blob_images),
+    ("0006_image_variants", migrate_image_variants),
+    ("0007_attendance_seq", migrate_attendance_seq),
+    ("0008_location_buckets", migrate_location_buckets),
+    ("0009_location_rollups", migrate_location_rollups),
+    ("0010_sms_outbox_retention", migrate_sms_outbox_retention),
+]
+
+# Only one process applies migrations at a time: it holds the "lock" document in
+# db.schema_migrations and renews it while it works. A lock that is not renewed (the process
+# died) can be taken over once it expires.
+MIGRATION_LOCK_ID = "lock"
+MIGRATION_LOCK_LEASE = timedelta(minutes=2)
+
+class MigrationLocked(Exception):
+    pass
+
+async def acquire_migration_lock(owner: str) -> bool:
+    from pymongo.errors import DuplicateKeyError
+    now = datetime.now(timezone.utc)
+    try:
+        await db.schema_migrations.update_one(
+            {"_id": MIGRATION_LOCK_ID, "$or": [{"owner": owner}, {"expires_at": {"$lt": now}}]},
+            {"$set": {"owner": owner, "expires_at": now + MIGRATION_LOCK_LEASE}},
+            upsert=True
+        )
+        return True
+    except DuplicateKeyError:
+        # The lock exists and belongs to another live process
+        return False
+
+async def renew_migration_lock(owner: str):
+    while True:
+        await asyncio.sleep(MIGRATION_LOCK_LEASE.total_seconds() / 4)
+        await db.schema_migrations.update_one(
+            {"_id": MIGRATION_LOCK_ID, "owner": owner},
+            {"$set": {"expires_at": datetime.now(timezone.utc) + MIGRATION_LOCK_LEASE}}
+        )
+
+async def run_migrations(dry_run: bool = False) -> List[dict]:
+    """
+    Apply pending MIGRATIONS in order and return what was (or would be) applied
+    Raises MigrationLocked when another process is applying them
+    """
+    applied_ids = {
+        doc["_id"] for doc in await db.schema_migrations.find({"_id": {"$ne": MIGRATION_LOCK_ID}}, {"_id": 1}).to_list(length=None)
+    }
+    pending = [(migration_id, migrate) for migration_id, migrate in MIGRATIONS if migration_id not in applied_ids]
+    if dry_run or not pending:
+        return [{"id": migration_id, "outcome": "pending"} for migration_id, _ in pending]
+
+    owner = str(uuid.uuid4())
+    if not await acquire_migration_lock(owner):
+        raise MigrationLocked("Migrations are being applied by another process")
+    renewal = asyncio.create_task(renew_migration_lock(owner))
+    applied = []
+    try:
+        # Re-read under the lock - the previous holder may have applied some of them
+        applied_ids = {doc["_id"] for doc in await db.schema_migrations.find({}, {"_id": 1}).to_list(length=None)}
+        for migration_id, migrate in pending:
+            if migration_id in applied_ids:
+                continue
+
+            logging.info(f"Applying migration {migration_id}")
+            outcome = await migrate()
+            await db.schema_migrations.update_one(
+                {"_id": migration_id},
+                {"$set": {"applied_at": datetime.now(timezone.utc).isoformat(), "outcome": outcome}},
+                upsert=True
+            )
+            logging.info(f"Migration {migration_id}: {outcome}")
+            applied.append({"id": migration_id, "outcome": outcome})
+    finally:
+        renewal.cancel()
+        await db.schema_migrations.delete_one({"_id": MIGRATION_LOCK_ID, "owner": owner})
+
+    return applied
+
+async def run_startup_migrations():
+    """
+    Apply pending migrations in the background so large ones don't hold up startup, then
+    reconcile indexes again - some (unique attendance slots, unique payroll rows) can only be
+    built once the migrations have cleaned up the data
+    """
+    try:
+        await run_migrations()
+        await ensure_indexes()
+    except MigrationLocked:
+        logging.info("Skipping migrations on startup - another process is applying them")
+    except Exception as e:
+        logging.error(f"Migrations failed: {str(e)}")
+
 
 # Include router
 app.include_router(api_router)
@@ -5807,6 +9083,7 @@ app.add_middleware(
     allow_origins=os.environ.get('CORS_ORIGINS', '*').split(','),
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", "X-Total-Count"],
 )
 
 logging.basicConfig(
@@ -5815,6 +9092,35 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+background_tasks = []
+
+@app.on_event("startup")
+async def startup_db_client():
+    # Never block the API from starting on index/migration problems - they are logged
+    try:
+        await ensure_indexes()
+        await warm_fingerprint_directory()
+    except Exception as e:
+        logger.error(f"Database bootstrap failed: {str(e)}")
+    
+    # Pending data migrations (some rewrite whole collections) run alongside the API;
+    # run migrate_database.py before a deploy to apply them ahead of time instead
+    background_tasks.append(asyncio.create_task(run_startup_migrations()))
+    background_tasks.append(asyncio.create_task(sms_outbox_worker()))
+    background_tasks.append(asyncio.create_task(activity_log_flusher()))
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    for task in background_tasks:
+        task.cancel()
+    for channel in list(live_payroll_channels.values()):
+        channel["task"].cancel()
+    for task in list(running_jobs):
+        task.cancel()
+    await asyncio.gather(*running_jobs, return_exceptions=True)
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    await asyncio.gather(*activity_log_flushes, return_exceptions=True)
+    await flush_activity_logs()
+    await close_sms_clients()
+    image_executor.shutdown(wait=False, cancel_futures=True)
     client.close()
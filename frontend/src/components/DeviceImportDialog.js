@@ -8,12 +8,14 @@ import axios from 'axios';
 const DeviceImportDialog = ({ open, onClose, employees, onImportComplete }) => {
   const [step, setStep] = useState(1); // 1: Upload, 2: Parsing, 3: Mapping, 4: Duplicate, 5: Importing
   const [fileContent, setFileContent] = useState('');
+  const [logFile, setLogFile] = useState(null);
   const [fileName, setFileName] = useState('');
   const [parsedData, setParsedData] = useState(null);
   const [mappings, setMappings] = useState({});
   const [duplicateAction, setDuplicateAction] = useState('skip');
   const [importing, setImporting] = useState(false);
   const [result, setResult] = useState(null);
+  const [progress, setProgress] = useState(null);
 
   const backendUrl = process.env.REACT_APP_BACKEND_URL;
 
@@ -27,6 +29,7 @@ const DeviceImportDialog = ({ open, onClose, employees, onImportComplete }) => {
     const isExcel = file.name.endsWith('.xlsx') || file.name.endsWith('.xls');
     
     if (isExcel) {
+      setLogFile(null);
       // For Excel files, read as binary and convert to base64
       const reader = new FileReader();
       reader.onload = (event) => {
@@ -35,17 +38,14 @@ const DeviceImportDialog = ({ open, onClose, employees, onImportComplete }) => {
       };
       reader.readAsDataURL(file);
     } else {
-      // For text files, read as text
-      const reader = new FileReader();
-      reader.onload = (event) => {
-        setFileContent(event.target.result);
-      };
-      reader.readAsText(file);
+      // Text device logs are uploaded as-is and parsed on the server while streaming
+      setFileContent('');
+      setLogFile(file);
     }
   };
 
   const handleParse = async () => {
-    if (!fileContent) {
+    if (!fileContent && !logFile) {
       alert('Please upload a file first');
       return;
     }
@@ -57,14 +57,26 @@ const DeviceImportDialog = ({ open, onClose, employees, onImportComplete }) => {
       const userStr = localStorage.getItem('user');
       const currentUser = userStr ? JSON.parse(userStr) : null;
 
-      const response = await axios.post(
-        `${backendUrl}/api/attendance/parse-device-import`,
-        {
-          file_content: fileContent,
-          company_id: currentUser.company_id
-        },
-        { headers: { Authorization: `Bearer ${token}` } }
-      );
+      let response;
+      if (logFile) {
+        // Records stay staged on the server; only a summary comes back
+        const formData = new FormData();
+        formData.append('file', logFile);
+        response = await axios.post(
+          `${backendUrl}/api/attendance/device-import/upload`,
+          formData,
+          { headers: { Authorization: `Bearer ${token}` } }
+        );
+      } else {
+        response = await axios.post(
+          `${backendUrl}/api/attendance/parse-device-import`,
+          {
+            file_content: fileContent,
+            company_id: currentUser.company_id
+          },
+          { headers: { Authorization: `Bearer ${token}` } }
+        );
+      }
 
       setParsedData(response.data.data);
       
@@ -124,23 +136,42 @@ const DeviceImportDialog = ({ open, onClose, employees, onImportComplete }) => {
         {
           company_id: currentUser.company_id,
           mappings: mappingsArray,
-          parsed_records: parsedData.records,
+          import_id: parsedData.import_id,
+          parsed_records: parsedData.records || [],
           duplicate_action: duplicateAction
         },
         { headers: { Authorization: `Bearer ${token}` } }
       );
 
-      setResult(response.data);
+      // The import runs as a background job - poll it until it finishes
+      let job;
+      do {
+        await new Promise((resolve) => setTimeout(resolve, 1000));
+        const jobResponse = await axios.get(
+          `${backendUrl}/api/jobs/${response.data.job_id}`,
+          { headers: { Authorization: `Bearer ${token}` } }
+        );
+        job = jobResponse.data;
+        setProgress({ processed: job.processed, total: job.total });
+      } while (job.status === 'queued' || job.status === 'running');
+
+      if (job.status === 'failed') {
+        throw new Error(job.error || 'Import failed');
+      }
+
+      setResult(job.result);
       setImporting(false);
+      setProgress(null);
       
       // Call parent callback
       if (onImportComplete) {
-        onImportComplete(response.data);
+        onImportComplete(job.result);
       }
     } catch (error) {
       console.error('Import error:', error);
       alert('Failed to import: ' + (error.response?.data?.detail || error.message));
       setImporting(false);
+      setProgress(null);
       setStep(4);
     }
   };
@@ -148,6 +179,7 @@ const DeviceImportDialog = ({ open, onClose, employees, onImportComplete }) => {
   const handleClose = () => {
     setStep(1);
     setFileContent('');
+    setLogFile(null);
     setFileName('');
     setParsedData(null);
     setMappings({});
@@ -190,7 +222,7 @@ const DeviceImportDialog = ({ open, onClose, employees, onImportComplete }) => {
             </div>
             <div className="flex justify-end space-x-2">
               <Button variant="outline" onClick={handleClose}>Cancel</Button>
-              <Button onClick={handleParse} disabled={!fileContent}>
+              <Button onClick={handleParse} disabled={!fileContent && !logFile}>
                 Continue
               </Button>
             </div>
@@ -231,7 +263,9 @@ const DeviceImportDialog = ({ open, onClose, employees, onImportComplete }) => {
               <h3 className="font-semibold mb-4">Map Device IDs to Employees</h3>
               <div className="space-y-3 max-h-96 overflow-y-auto">
                 {parsedData.unique_vendor_ids?.map(vendorId => {
-                  const recordCount = parsedData.records.filter(r => r.vendor_id === vendorId).length;
+                  const recordCount = parsedData.vendor_counts
+                    ? parsedData.vendor_counts[vendorId] || 0
+                    : parsedData.records.filter(r => r.vendor_id === vendorId).length;
                   return (
                     <div key={vendorId} className="flex items-center space-x-4 p-3 bg-gray-50 rounded-lg">
                       <div className="flex-shrink-0 w-24">
@@ -327,6 +361,11 @@ const DeviceImportDialog = ({ open, onClose, employees, onImportComplete }) => {
               <div className="text-center py-12">
                 <Loader className="w-16 h-16 mx-auto text-blue-600 animate-spin mb-4" />
                 <p className="text-lg font-medium">Importing attendance records...</p>
+                {progress?.total > 0 && (
+                  <p className="text-sm text-gray-600 mt-2">
+                    {progress.processed} of {progress.total} employee-days processed
+                  </p>
+                )}
               </div>
             ) : result ? (
               <div className="space-y-4">
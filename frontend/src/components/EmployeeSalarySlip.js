@@ -5,6 +5,7 @@ import { User, Download, X } from 'lucide-react';
 import html2canvas from 'html2canvas';
 import jsPDF from 'jspdf';
 import { useRef } from 'react';
+import { assetUrl } from '../utils/helpers';
 
 export default function EmployeeSalarySlip({ employee, month, onClose }) {
   const slipRef = useRef(null);
@@ -107,7 +108,7 @@ export default function EmployeeSalarySlip({ employee, month, onClose }) {
                     <div className="w-16 h-16 rounded-full flex-shrink-0">
                       {employee.profile_picture && employee.profile_picture.trim() !== '' ? (
                         <img 
-                          src={employee.profile_picture} 
+                          src={assetUrl(employee.profile_picture)} 
                           alt={employee.employee_name} 
                           className="w-16 h-16 rounded-full object-cover"
                         />
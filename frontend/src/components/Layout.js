@@ -20,6 +20,7 @@ import {
 import ImpersonationBanner from './ImpersonationBanner';
 import { getImpersonationState, clearImpersonationState } from '../utils/impersonation';
 import { api } from '../App';
+import { assetUrl } from '../utils/helpers';
 
 export default function Layout({ children }) {
   const navigate = useNavigate();
@@ -96,7 +97,7 @@ export default function Layout({ children }) {
     const link = document.createElement('link');
     link.rel = 'icon';
     link.type = 'image/png';
-    link.href = faviconUrl;
+    link.href = assetUrl(faviconUrl);
     document.head.appendChild(link);
 
     // Add styles to favicon container if possible
@@ -296,7 +297,7 @@ export default function Layout({ children }) {
           <div className="flex flex-col items-center justify-center px-0 py-0 border-b border-gray-200 bg-gradient-to-r from-blue-600 to-indigo-600">
             {companyInfo?.logo ? (
               <img
-                src={companyInfo.logo}
+                src={assetUrl(companyInfo.logo)}
                 alt={`${companyInfo.name} Logo`}
                 className="w-full h-24 object-cover"
               />
@@ -352,7 +353,7 @@ export default function Layout({ children }) {
           <div className="flex items-center gap-2">
             {companyInfo?.logo ? (
               <img 
-                src={companyInfo.logo} 
+                src={assetUrl(companyInfo.logo)} 
                 alt={`${companyInfo.name} Logo`} 
                 className="h-8 w-auto object-contain rounded"
                 style={{ borderRadius: '4px' }}
@@ -379,7 +380,7 @@ export default function Layout({ children }) {
                 <div className="flex flex-col items-center justify-center px-0 py-0 border-b border-gray-200 bg-gradient-to-r from-blue-600 to-indigo-600">
                   {companyInfo?.logo ? (
                     <img
-                      src={companyInfo.logo}
+                      src={assetUrl(companyInfo.logo)}
                       alt={`${companyInfo.name} Logo`}
                       className="w-full h-20 object-cover"
                     />
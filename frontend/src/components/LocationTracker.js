@@ -2,6 +2,15 @@ import React, { useState, useEffect, useRef } from 'react';
 import axios from 'axios';
 import { MapPin, Radio, Clock, Play, Square } from 'lucide-react';
 
+const PENDING_POINTS_KEY = 'pendingLocationPoints';
+const CAPTURE_INTERVAL_MS = 10000; // 10 seconds for testing (300000 for 5 minutes in production)
+const UPLOAD_INTERVAL_MS = 60000;
+const UPLOAD_CHUNK_SIZE = 2000; // the server's per-request limit (LOCATION_BATCH_MAX)
+
+// Fixes waiting to be uploaded survive reloads and offline periods in localStorage
+const loadPendingPoints = () => JSON.parse(localStorage.getItem(PENDING_POINTS_KEY) || '[]');
+const savePendingPoints = (points) => localStorage.setItem(PENDING_POINTS_KEY, JSON.stringify(points));
+
 const LocationTracker = () => {
   const [isTracking, setIsTracking] = useState(false);
   const [sessionId, setSessionId] = useState(null);
@@ -11,6 +20,8 @@ const LocationTracker = () => {
   const [permissionDenied, setPermissionDenied] = useState(false);
   
   const locationIntervalRef = useRef(null);
+  const uploadIntervalRef = useRef(null);
+  const uploadingRef = useRef(false);
   const timerIntervalRef = useRef(null);
   const startTimeRef = useRef(null);
 
@@ -19,12 +30,19 @@ const LocationTracker = () => {
   useEffect(() => {
     // Check if there's an active session on component mount
     checkActiveSession();
+    // Fixes left over from an earlier page load (including stopped sessions)
+    uploadAllPendingPoints();
+    window.addEventListener('online', handleOnline);
     
     return () => {
+      window.removeEventListener('online', handleOnline);
       // Cleanup intervals on unmount
       if (locationIntervalRef.current) {
         clearInterval(locationIntervalRef.current);
       }
+      if (uploadIntervalRef.current) {
+        clearInterval(uploadIntervalRef.current);
+      }
       if (timerIntervalRef.current) {
         clearInterval(timerIntervalRef.current);
       }
@@ -95,10 +113,10 @@ const LocationTracker = () => {
         startTime: startTime
       }));
 
-      // Send first location immediately
-      captureAndSendLocation(newSessionId);
+      // Capture and send the first location immediately
+      captureLocation(newSessionId, true);
 
-      // Start periodic location updates (every 5 minutes)
+      // Start periodic location capture and batched uploads
       startLocationUpdates(newSessionId);
       
       // Start timer display
@@ -112,6 +130,10 @@ const LocationTracker = () => {
 
   const stopTracking = async () => {
     try {
+      // Upload buffered fixes before the session closes; if that fails they stay buffered and
+      // are sent later - the server still accepts fixes taken before a session was stopped
+      await uploadPendingPoints(sessionId);
+
       const token = localStorage.getItem('token');
       await axios.post(
         `${backendUrl}/api/location/tracking/stop`,
@@ -131,6 +153,10 @@ const LocationTracker = () => {
         clearInterval(locationIntervalRef.current);
         locationIntervalRef.current = null;
       }
+      if (uploadIntervalRef.current) {
+        clearInterval(uploadIntervalRef.current);
+        uploadIntervalRef.current = null;
+      }
       if (timerIntervalRef.current) {
         clearInterval(timerIntervalRef.current);
         timerIntervalRef.current = null;
@@ -146,25 +172,71 @@ const LocationTracker = () => {
     }
   };
 
-  const captureAndSendLocation = (currentSessionId) => {
-    navigator.geolocation.getCurrentPosition(
-      async (position) => {
+  // Returns true once nothing is left in the buffer for the session
+  const uploadPendingPoints = async (currentSessionId) => {
+    if (uploadingRef.current) return false;
+
+    uploadingRef.current = true;
+    try {
+      const token = localStorage.getItem('token');
+      let pending = loadPendingPoints().filter((point) => point.session_id === currentSessionId);
+      while (pending.length > 0) {
+        const chunk = pending.slice(0, UPLOAD_CHUNK_SIZE);
         try {
-          const token = localStorage.getItem('token');
           await axios.post(
-            `${backendUrl}/api/location/tracking/update`,
+            `${backendUrl}/api/location/tracking/batch`,
             {
               session_id: currentSessionId,
-              latitude: position.coords.latitude,
-              longitude: position.coords.longitude,
-              accuracy: position.coords.accuracy
+              points: chunk.map(({ session_id, ...point }) => point)
             },
             { headers: { Authorization: `Bearer ${token}` } }
           );
-          
-          setLocationCount(prev => prev + 1);
         } catch (err) {
-          console.error('Error sending location:', err);
+          if (err.response?.status !== 404) throw err;
+          // The session no longer exists - its fixes can never be stored
+        }
+
+        // Keep anything captured while the upload was in flight
+        const sent = new Set(chunk.map((point) => point.client_ts));
+        savePendingPoints(loadPendingPoints().filter(
+          (point) => point.session_id !== currentSessionId || !sent.has(point.client_ts)
+        ));
+        pending = pending.slice(UPLOAD_CHUNK_SIZE);
+      }
+      return true;
+    } catch (err) {
+      // Left in the buffer and retried on the next upload or when back online
+      console.error('Error sending locations:', err);
+      return false;
+    } finally {
+      uploadingRef.current = false;
+    }
+  };
+
+  const uploadAllPendingPoints = async () => {
+    const sessionIds = [...new Set(loadPendingPoints().map((point) => point.session_id))];
+    for (const pendingSessionId of sessionIds) {
+      if (!(await uploadPendingPoints(pendingSessionId))) return;
+    }
+  };
+
+  const captureLocation = (currentSessionId, uploadNow = false) => {
+    navigator.geolocation.getCurrentPosition(
+      (position) => {
+        savePendingPoints([
+          ...loadPendingPoints(),
+          {
+            session_id: currentSessionId,
+            latitude: position.coords.latitude,
+            longitude: position.coords.longitude,
+            accuracy: position.coords.accuracy,
+            client_ts: new Date(position.timestamp).toISOString()
+          }
+        ]);
+        setLocationCount(prev => prev + 1);
+
+        if (uploadNow) {
+          uploadPendingPoints(currentSessionId);
         }
       },
       (error) => {
@@ -174,11 +246,20 @@ const LocationTracker = () => {
     );
   };
 
+  const handleOnline = () => {
+    uploadAllPendingPoints();
+  };
+
   const startLocationUpdates = (currentSessionId) => {
-    // Update location every 10 seconds for TESTING (change to 300000 ms for 5 minutes in production)
     locationIntervalRef.current = setInterval(() => {
-      captureAndSendLocation(currentSessionId);
-    }, 10000); // 10 seconds for testing
+      captureLocation(currentSessionId);
+    }, CAPTURE_INTERVAL_MS);
+
+    // Buffered fixes go up in one request per minute, and as soon as the connection returns
+    uploadIntervalRef.current = setInterval(() => {
+      uploadPendingPoints(currentSessionId);
+    }, UPLOAD_INTERVAL_MS);
+    uploadPendingPoints(currentSessionId);
   };
 
   const startTimer = () => {
@@ -260,7 +341,7 @@ const LocationTracker = () => {
           </div>
 
           <p className="text-sm text-gray-600 mb-4 text-center">
-            Location is updated every 10 seconds (testing mode)
+            Location is captured every 10 seconds and uploaded every minute (testing mode)
           </p>
 
           <button
@@ -0,0 +1,128 @@
+import { useState, useEffect, useRef } from 'react';
+import axios from 'axios';
+import { API } from '../App';
+
+const round2 = (value) => Math.round(value * 100) / 100;
+
+// Move a payroll snapshot forward by `seconds` using the per-employee rates sent by the server
+export function advanceLivePayroll(snapshot, seconds) {
+  const employees = snapshot.employees.map((emp) => {
+    const earned = (emp.earnings_per_second || 0) * seconds;
+    const allowance = (emp.allowances_per_second || 0) * seconds;
+    if (!earned && !allowance) return emp;
+    return {
+      ...emp,
+      earnings: round2(emp.earnings + earned),
+      allowances: round2(emp.allowances + allowance),
+      gross_salary: round2(emp.gross_salary + earned),
+      net_salary: round2(emp.net_salary + earned + allowance),
+    };
+  });
+
+  // Only attendance-based (non-fixed) salaries count towards today's earnings
+  const todayRate = snapshot.employees.reduce(
+    (sum, emp) => sum + (emp.fixed_salary ? 0 : emp.earnings_per_second || 0),
+    0
+  );
+
+  return {
+    ...snapshot,
+    timestamp: new Date(new Date(snapshot.timestamp).getTime() + seconds * 1000).toISOString(),
+    employees,
+    total_gross: round2(employees.reduce((sum, emp) => sum + emp.gross_salary, 0)),
+    total_net: round2(employees.reduce((sum, emp) => sum + emp.net_salary, 0)),
+    total_deductions: round2(employees.reduce((sum, emp) => sum + emp.total_deductions, 0)),
+    total_allowances: round2(employees.reduce((sum, emp) => sum + emp.allowances, 0)),
+    today_total_earnings: round2(snapshot.today_total_earnings + todayRate * seconds),
+  };
+}
+
+// Subscribes to /payroll/live/stream (Server-Sent Events) and ticks the figures locally every second.
+// The server only pushes when attendance changes or on its periodic resync.
+export default function useLivePayroll(enabled = true) {
+  const [livePayroll, setLivePayroll] = useState(null);
+  const [connectionError, setConnectionError] = useState(false);
+  const baseRef = useRef(null);
+
+  useEffect(() => {
+    if (!enabled) return undefined;
+
+    let source = null;
+    let reconnectId = null;
+    let closed = false;
+
+    const applySnapshot = (snapshot, message) => {
+      // Snapshot age measured on the server's clock, so client clock skew doesn't matter
+      const ageMs = Math.max(0, new Date(message.sent_at) - new Date(message.timestamp));
+      baseRef.current = { snapshot, receivedAt: Date.now() - ageMs };
+      setLivePayroll(advanceLivePayroll(snapshot, ageMs / 1000));
+      setConnectionError(false);
+    };
+
+    const onSnapshot = (event) => {
+      const { type, sent_at, ...snapshot } = JSON.parse(event.data);
+      applySnapshot(snapshot, { sent_at, timestamp: snapshot.timestamp });
+    };
+
+    const onDelta = (event) => {
+      if (!baseRef.current) return;
+      const { type, sent_at, removed = [], employees: changed, ...totals } = JSON.parse(event.data);
+      const changedById = new Map(changed.map((emp) => [emp.employee_id, emp]));
+      const previous = baseRef.current.snapshot.employees;
+      const previousIds = new Set(previous.map((emp) => emp.employee_id));
+
+      const employees = previous
+        .filter((emp) => !removed.includes(emp.employee_id))
+        .map((emp) => changedById.get(emp.employee_id) || emp)
+        .concat(changed.filter((emp) => !previousIds.has(emp.employee_id)));
+
+      applySnapshot({ ...totals, employees }, { sent_at, timestamp: totals.timestamp });
+    };
+
+    // EventSource can't send headers, so each connection uses a single-use ticket instead of the JWT.
+    // A ticket can't be reused by EventSource's own reconnect, so reconnect by hand with a new one.
+    const connect = async () => {
+      try {
+        const token = localStorage.getItem('token');
+        const { data } = await axios.post(`${API}/payroll/live/ticket`, {}, {
+          headers: { Authorization: `Bearer ${token}` }
+        });
+        if (closed) return;
+        source = new EventSource(`${API}/payroll/live/stream?ticket=${encodeURIComponent(data.ticket)}`);
+        source.addEventListener('snapshot', onSnapshot);
+        source.addEventListener('delta', onDelta);
+        // The server sends a fresh snapshot on every new connection
+        source.onerror = () => {
+          source.close();
+          scheduleReconnect();
+        };
+      } catch (err) {
+        scheduleReconnect();
+      }
+    };
+
+    const scheduleReconnect = () => {
+      setConnectionError(true);
+      if (!closed) reconnectId = setTimeout(connect, 3000);
+    };
+
+    connect();
+
+    const tickId = setInterval(() => {
+      if (baseRef.current) {
+        const { snapshot, receivedAt } = baseRef.current;
+        setLivePayroll(advanceLivePayroll(snapshot, (Date.now() - receivedAt) / 1000));
+      }
+    }, 1000);
+
+    return () => {
+      closed = true;
+      clearInterval(tickId);
+      clearTimeout(reconnectId);
+      if (source) source.close();
+      baseRef.current = null;
+    };
+  }, [enabled]);
+
+  return { livePayroll, connectionError };
+}
@@ -11,6 +11,7 @@ import { Calendar, Clock, CheckCircle, XCircle, Plus, Trash2, Archive, Edit, Use
 import DeviceImportDialog from '../components/DeviceImportDialog';
 import { useNavigate, useLocation, useParams } from 'react-router-dom';
 import { canEditInImpersonation, isImpersonating } from '../utils/impersonation';
+import { assetUrl } from '../utils/helpers';
 
 export default function Attendance() {
   const navigate = useNavigate();
@@ -949,7 +950,7 @@ export default function Attendance() {
                                     <div className="w-8 h-8 rounded-full flex-shrink-0">
                                       {record.profile_pic && record.profile_pic.trim() !== '' ? (
                                         <img 
-                                          src={record.profile_pic} 
+                                          src={assetUrl(record.profile_pic)} 
                                           alt={record.employee_name} 
                                           className="w-8 h-8 rounded-full object-cover"
                                           onError={(e) => {
@@ -1068,7 +1069,7 @@ export default function Attendance() {
                             <div className="w-8 h-8 rounded-full flex-shrink-0">
                               {record.profile_pic && record.profile_pic.trim() !== '' ? (
                                 <img 
-                                  src={record.profile_pic} 
+                                  src={assetUrl(record.profile_pic)} 
                                   alt={record.employee_name} 
                                   className="w-8 h-8 rounded-full object-cover"
                                   onError={(e) => {
@@ -10,6 +10,7 @@ import { Switch } from '../components/ui/switch';
 import { Badge } from '../components/ui/badge';
 import { toast } from 'sonner';
 import { Settings, Clock, Calendar, Plus, Trash2 } from 'lucide-react';
+import { assetUrl } from '../utils/helpers';
 
 export default function CompanySettings() {
   const [settings, setSettings] = useState(null);
@@ -301,7 +302,7 @@ export default function CompanySettings() {
               <div className="space-y-3">
                 {settings?.company_logo && (
                   <div className="flex items-center justify-center p-4 bg-gray-50 rounded-lg border-2 border-dashed">
-                    <img src={settings.company_logo} alt="Company Logo" className="max-h-24 object-contain" />
+                    <img src={assetUrl(settings.company_logo)} alt="Company Logo" className="max-h-24 object-contain" />
                   </div>
                 )}
                 <Input
@@ -332,7 +333,7 @@ export default function CompanySettings() {
               <div className="space-y-3">
                 {settings?.favicon && (
                   <div className="flex items-center justify-center p-4 bg-gray-50 rounded-lg border-2 border-dashed">
-                    <img src={settings.favicon} alt="Favicon" className="max-h-16 object-contain rounded-lg" style={{ borderRadius: '8px' }} />
+                    <img src={assetUrl(settings.favicon)} alt="Favicon" className="max-h-16 object-contain rounded-lg" style={{ borderRadius: '8px' }} />
                   </div>
                 )}
                 <Input
@@ -8,6 +8,7 @@ import { toast } from 'sonner';
 import { Users, Calendar, FileText, DollarSign, Clock, CheckCircle, XCircle, AlertCircle, Radio } from 'lucide-react';
 import LocationTracker from '../components/LocationTracker';
 import AttendanceWithLocation from '../components/AttendanceWithLocation';
+import useLivePayroll from '../hooks/useLivePayroll';
 
 export default function Dashboard() {
   const navigate = useNavigate();
@@ -15,40 +16,18 @@ export default function Dashboard() {
   const [loading, setLoading] = useState(true);
   const [user, setUser] = useState(null);
   const [checkingIn, setCheckingIn] = useState(false);
-  const [livePayroll, setLivePayroll] = useState(null);
-  const [displayTodaySalary, setDisplayTodaySalary] = useState(0);
   const [companyInfo, setCompanyInfo] = useState(null);
 
+  // Live payroll is pushed by the server and ticked locally - no polling
+  const storedRole = JSON.parse(localStorage.getItem('user'))?.role;
+  const { livePayroll } = useLivePayroll(storedRole === 'admin' || storedRole === 'manager');
+  const displayTodaySalary = livePayroll?.today_total_earnings || 0;
+
   useEffect(() => {
     const userData = JSON.parse(localStorage.getItem('user'));
     setUser(userData);
     fetchStats();
     fetchCompanyInfo();
-    
-    if (userData?.role === 'admin' || userData?.role === 'manager') {
-      // Initial fetch
-      fetchLivePayroll();
-      
-      // Fetch from backend every 5 seconds for accuracy
-      const fetchIntervalId = setInterval(() => {
-        fetchLivePayroll();
-      }, 5000);
-      
-      // Increment display every second for live feel
-      const displayIntervalId = setInterval(() => {
-        setDisplayTodaySalary(prev => {
-          // Increment by estimated per-second rate
-          // Assuming average Rs 0.5 per second across all employees
-          return prev + 0.5;
-        });
-      }, 1000);
-      
-      // Cleanup on unmount
-      return () => {
-        clearInterval(fetchIntervalId);
-        clearInterval(displayIntervalId);
-      };
-    }
   }, []);
 
   const fetchCompanyInfo = async () => {
@@ -71,19 +50,6 @@ export default function Dashboard() {
     }
   };
 
-  const fetchLivePayroll = async () => {
-    try {
-      const response = await api.get('/payroll/live-current-month');
-      setLivePayroll(response.data);
-      // Sync display value with backend data
-      if (response.data.today_total_earnings) {
-        setDisplayTodaySalary(response.data.today_total_earnings);
-      }
-    } catch (error) {
-      console.error('Failed to fetch live payroll:', error);
-    }
-  };
-
   const handleCheckIn = async () => {
     setCheckingIn(true);
     try {
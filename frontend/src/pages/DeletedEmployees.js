@@ -6,6 +6,7 @@ import { Card, CardContent, CardHeader, CardTitle } from '../components/ui/card'
 import { toast } from 'sonner';
 import { ArrowLeft, UserCheck, User } from 'lucide-react';
 import { useNavigate } from 'react-router-dom';
+import { assetUrl } from '../utils/helpers';
 
 export default function DeletedEmployees() {
   const navigate = useNavigate();
@@ -103,7 +104,7 @@ export default function DeletedEmployees() {
                             <div className="w-10 h-10 rounded-full flex-shrink-0">
                               {employee.profile_pic && employee.profile_pic.trim() !== '' ? (
                                 <img 
-                                  src={employee.profile_pic} 
+                                  src={assetUrl(employee.profile_pic)} 
                                   alt={employee.name} 
                                   className="w-10 h-10 rounded-full object-cover"
                                   onError={(e) => {
@@ -10,7 +10,7 @@ import { Card, CardContent } from '../components/ui/card';
 import { Textarea } from '../components/ui/textarea';
 import { toast } from 'sonner';
 import { Plus, Edit, Trash2, Search, TrendingUp, History, Upload, Pencil, ArrowUpDown, ArrowUp, ArrowDown } from 'lucide-react';
-import { capitalizeName } from '../utils/helpers';
+import { capitalizeName, assetUrl } from '../utils/helpers';
 import { canEditInImpersonation, isImpersonating } from '../utils/impersonation';
 
 export default function Employees() {
@@ -710,7 +710,7 @@ export default function Employees() {
                     <div className="sm:col-span-2">
                       <div className="flex items-center gap-4 p-3 bg-gray-50 rounded-lg">
                         <img 
-                          src={editingEmployee.profile_pic} 
+                          src={assetUrl(editingEmployee.profile_pic)} 
                           alt="Current Profile" 
                           className="w-16 h-16 rounded-full object-cover"
                           style={{ borderRadius: '50%' }}
@@ -770,7 +770,7 @@ export default function Employees() {
                 <div className="flex items-start gap-4 mb-4">
                   {employee.profile_pic ? (
                     <img 
-                      src={employee.profile_pic} 
+                      src={assetUrl(employee.profile_pic)} 
                       alt={employee.name} 
                       className="w-16 h-16 rounded-full object-cover"
                       style={{ borderRadius: '50%' }}
@@ -984,7 +984,7 @@ export default function Employees() {
                       <div className="flex items-center">
                         {employee.profile_pic ? (
                           <img 
-                            src={employee.profile_pic} 
+                            src={assetUrl(employee.profile_pic)} 
                             alt={employee.name} 
                             className="w-10 h-10 rounded-full object-cover mr-3"
                           />
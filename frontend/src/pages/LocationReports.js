@@ -5,6 +5,7 @@ import 'leaflet/dist/leaflet.css';
 import L from 'leaflet';
 import { MapPin, Clock, Calendar, User, Filter, Download, Eye } from 'lucide-react';
 import Layout from '../components/Layout';
+import { assetUrl } from '../utils/helpers';
 
 // Fix Leaflet default marker icon issue
 delete L.Icon.Default.prototype._getIconUrl;
@@ -107,9 +108,20 @@ const LocationReports = () => {
     }
   };
 
-  const viewSessionOnMap = (session) => {
-    setSelectedSession(session);
+  const viewSessionOnMap = async (session) => {
+    setSelectedSession({ ...session, locations: [] });
     setShowMapModal(true);
+    try {
+      // Points are stored apart from the session and loaded only when a route is opened
+      const token = localStorage.getItem('token');
+      const response = await axios.get(`${backendUrl}/api/location/tracking/sessions/${session.id}/points`, {
+        headers: { Authorization: `Bearer ${token}` },
+        params: { tolerance: 10 } // metres - drops points that don't change the drawn route
+      });
+      setSelectedSession({ ...session, locations: response.data.locations });
+    } catch (error) {
+      console.error('Error fetching session points:', error);
+    }
   };
 
   const formatDate = (isoString) => {
@@ -348,10 +360,16 @@ const LocationReports = () => {
                                 Duration: {formatDuration(session.start_time, session.end_time)}
                               </p>
                               <p className="text-sm text-gray-600">
-                                Location Points: {session.locations ? session.locations.length : 0}
+                                Location Points: {session.point_count || 0}
                               </p>
+                              {session.route && (
+                                <p className="text-sm text-gray-600">
+                                  Distance: {(session.route.distance_m / 1000).toFixed(2)} km
+                                  {' · '}Stopped: {Math.round(session.route.dwell_seconds / 60)} min
+                                </p>
+                              )}
                             </div>
-                            {session.locations && session.locations.length > 0 && (
+                            {session.point_count > 0 && (
                               <button
                                 onClick={() => viewSessionOnMap(session)}
                                 className="flex items-center space-x-1 px-3 py-2 bg-blue-600 text-white rounded-md hover:bg-blue-700 transition-colors"
@@ -390,11 +408,17 @@ const LocationReports = () => {
                               {attendance.location?.address && (
                                 <p className="text-sm text-gray-600">Address: {attendance.location.address}</p>
                               )}
+                              {attendance.location?.inside_geofence === true && (
+                                <span className="inline-block mt-1 px-2 py-1 text-xs bg-green-100 text-green-700 rounded-full">Inside geofence</span>
+                              )}
+                              {attendance.location?.inside_geofence === false && (
+                                <span className="inline-block mt-1 px-2 py-1 text-xs bg-red-100 text-red-700 rounded-full">Outside geofence</span>
+                              )}
                             </div>
                             {attendance.location?.map_snapshot && (
                               <div>
                                 <img
-                                  src={attendance.location.map_snapshot}
+                                  src={assetUrl(attendance.location.map_snapshot)}
                                   alt="Location Map"
                                   className="w-full h-32 object-cover rounded border border-gray-300"
                                 />
@@ -434,7 +458,7 @@ const LocationReports = () => {
                   <p className="text-sm text-gray-600">Ended: {formatDate(selectedSession.end_time)}</p>
                 )}
                 <p className="text-sm text-gray-600">
-                  Location Points: {selectedSession.locations ? selectedSession.locations.length : 0}
+                  Location Points: {selectedSession.point_count || 0}
                 </p>
               </div>
               {selectedSession.locations && selectedSession.locations.length > 0 && (
@@ -1,4 +1,4 @@
-import { useState, useEffect, useRef } from 'react';
+import { useState, useEffect } from 'react';
 import { useParams, useNavigate } from 'react-router-dom';
 import { api } from '../App';
 import Layout from '../components/Layout';
@@ -7,6 +7,8 @@ import { Card, CardContent } from '../components/ui/card';
 import { toast } from 'sonner';
 import { ArrowLeft, User, Radio, Calendar, FileText } from 'lucide-react';
 import EmployeeSalarySlip from '../components/EmployeeSalarySlip';
+import useLivePayroll from '../hooks/useLivePayroll';
+import { assetUrl } from '../utils/helpers';
 
 export default function Payroll() {
   const { month } = useParams();
@@ -15,14 +17,17 @@ export default function Payroll() {
   const [detailedPayroll, setDetailedPayroll] = useState(null);
   const [loading, setLoading] = useState(true);
   const [user, setUser] = useState(null);
-  const [livePayroll, setLivePayroll] = useState(null);
-  const liveIntervalRef = useRef(null);
   const [viewingSalarySlip, setViewingSalarySlip] = useState(null);
   const [viewMode, setViewMode] = useState('table'); // Default to table
 
   // Determine view mode based on URL
   const isLiveView = !month; // If no month param, show live view
   const isMonthView = !!month; // If month param exists, show month detail
+  const currentMonth = new Date().toISOString().slice(0, 7); // YYYY-MM format
+  const isCurrentMonthView = month === currentMonth;
+
+  // Live view and the current month's detail are pushed by the server (ticked locally every second)
+  const { livePayroll, connectionError } = useLivePayroll(isLiveView || isCurrentMonthView);
 
   useEffect(() => {
     const userData = JSON.parse(localStorage.getItem('user'));
@@ -32,50 +37,28 @@ export default function Payroll() {
 
   // Handle month parameter changes
   useEffect(() => {
-    if (month) {
-      // Initial load with loading state
+    if (month && !isCurrentMonthView) {
       fetchDetailedPayroll(month, false);
-      
-      // Check if this is the current month
-      const currentMonth = new Date().toISOString().slice(0, 7); // YYYY-MM format
-      
-      if (month === currentMonth) {
-        // Fetch from backend every 1 second (same as Dashboard) for perfect sync
-        const refreshIntervalId = setInterval(() => {
-          fetchDetailedPayroll(month, true); // true = silent update, no page refresh
-        }, 1000); // Changed from 5000 to 1000 to match Dashboard
-        
-        // Clean up interval when month changes or component unmounts
-        return () => clearInterval(refreshIntervalId);
-      }
     }
   }, [month]);
 
-  // Live payroll update effect
+  // Current month detail comes from the live stream
   useEffect(() => {
-    if (isLiveView) {
-      // Fetch immediately
-      fetchLivePayroll();
-      
-      // Set up interval to fetch every second
-      liveIntervalRef.current = setInterval(() => {
-        fetchLivePayroll();
-      }, 1000);
-    } else {
-      // Clear interval when exiting live view
-      if (liveIntervalRef.current) {
-        clearInterval(liveIntervalRef.current);
-        liveIntervalRef.current = null;
-      }
+    if (isCurrentMonthView && livePayroll) {
+      setDetailedPayroll(livePayroll);
     }
+  }, [isCurrentMonthView, livePayroll]);
 
-    // Cleanup on unmount
-    return () => {
-      if (liveIntervalRef.current) {
-        clearInterval(liveIntervalRef.current);
-      }
-    };
-  }, [isLiveView]);
+  useEffect(() => {
+    if (livePayroll && loading) setLoading(false);
+  }, [livePayroll]);
+
+  useEffect(() => {
+    if (connectionError && !livePayroll && (isLiveView || isCurrentMonthView)) {
+      toast.error('Failed to fetch live payroll');
+      setLoading(false);
+    }
+  }, [connectionError]);
 
   const fetchMonths = async () => {
     try {
@@ -107,20 +90,6 @@ export default function Payroll() {
     }
   };
 
-  const fetchLivePayroll = async () => {
-    try {
-      const response = await api.get('/payroll/live-current-month');
-      setLivePayroll(response.data);
-      if (loading) setLoading(false);
-    } catch (error) {
-      if (loading) {
-        toast.error('Failed to fetch live payroll');
-        setLoading(false);
-      }
-      // Don't show toast on every update failure to avoid spam
-    }
-  };
-
   const handleMonthClick = (monthStr) => {
     navigate(`/payroll/month/${monthStr}`);
   };
@@ -336,7 +305,7 @@ export default function Payroll() {
                           <div className="flex items-center gap-3">
                             {emp.profile_picture && emp.profile_picture.trim() !== '' ? (
                               <img 
-                                src={emp.profile_picture} 
+                                src={assetUrl(emp.profile_picture)} 
                                 alt={emp.employee_name} 
                                 className="w-12 h-12 rounded-full object-cover"
                               />
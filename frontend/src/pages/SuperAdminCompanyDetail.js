@@ -10,7 +10,7 @@ import { Badge } from '../components/ui/badge';
 import { Dialog, DialogContent, DialogDescription, DialogFooter, DialogHeader, DialogTitle } from '../components/ui/dialog';
 import { toast } from 'sonner';
 import { ArrowLeft, Save, Building2, MessageSquare, CheckCircle, XCircle, Send } from 'lucide-react';
-import { capitalizeName } from '../utils/helpers';
+import { capitalizeName, assetUrl } from '../utils/helpers';
 
 export default function SuperAdminCompanyDetail() {
   const { companyId } = useParams();
@@ -399,7 +399,7 @@ export default function SuperAdminCompanyDetail() {
                 <label className="text-sm font-medium">Company Logo</label>
                 {company?.logo && (
                   <div className="flex items-center justify-center p-4 bg-gray-50 rounded-lg border-2 border-dashed">
-                    <img src={company.logo} alt="Company Logo" className="max-h-24 object-contain" />
+                    <img src={assetUrl(company.logo)} alt="Company Logo" className="max-h-24 object-contain" />
                   </div>
                 )}
                 <Input
@@ -436,7 +436,7 @@ export default function SuperAdminCompanyDetail() {
                 <label className="text-sm font-medium">Favicon</label>
                 {company?.favicon && (
                   <div className="flex items-center justify-center p-4 bg-gray-50 rounded-lg border-2 border-dashed">
-                    <img src={company.favicon} alt="Favicon" className="max-h-16 object-contain rounded-lg" style={{ borderRadius: '8px' }} />
+                    <img src={assetUrl(company.favicon)} alt="Favicon" className="max-h-16 object-contain rounded-lg" style={{ borderRadius: '8px' }} />
                   </div>
                 )}
                 <Input
@@ -24,3 +24,10 @@ export const capitalizeName = (name) => {
     })
     .join(' ');
 };
+
+// Uploaded images are stored as backend-relative blob URLs (/api/blobs/<hash>);
+// older inline data: URLs and absolute URLs are returned unchanged
+export const assetUrl = (url) => {
+  if (!url || !url.startsWith('/api/')) return url;
+  return `${process.env.REACT_APP_BACKEND_URL}${url}`;
+};